@@ -3,10 +3,37 @@
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
 index = {"init_available_projects": "00_Create Project.ipynb",
+         "summary_name": "00_Create Project.ipynb",
+         "summary_names": "00_Create Project.ipynb",
+         "resample_summary": "00_Create Project.ipynb",
          "summarize_h5": "00_Create Project.ipynb",
+         "profile_dir": "00_Create Project.ipynb",
+         "profile_path": "00_Create Project.ipynb",
+         "summarize_records": "00_Create Project.ipynb",
          "pgrid_to_run_parameters": "00_Create Project.ipynb",
+         "summary_statistics": "00_Create Project.ipynb",
          "collect_statistics": "00_Create Project.ipynb",
+         "PERCENTILES": "00_Create Project.ipynb",
+         "SKETCH_PERCENTILES": "00_Create Project.ipynb",
+         "run_statistics": "00_Create Project.ipynb",
+         "merge_statistics": "00_Create Project.ipynb",
+         "file_hash": "00_Create Project.ipynb",
+         "record_fingerprint": "00_Create Project.ipynb",
+         "load_manifest": "00_Create Project.ipynb",
+         "save_manifest": "00_Create Project.ipynb",
+         "records_to_summarize": "00_Create Project.ipynb",
+         "remove_stale_runs": "00_Create Project.ipynb",
+         "write_aggregates": "00_Create Project.ipynb",
+         "write_cubes": "00_Create Project.ipynb",
+         "remove_cubes": "00_Create Project.ipynb",
+         "largest_polygons": "00_Create Project.ipynb",
          "fix_geojson": "00_Create Project.ipynb",
+         "simplify_shared": "00_Create Project.ipynb",
+         "GEO_LEVELS": "00_Create Project.ipynb",
+         "geo_levels": "00_Create Project.ipynb",
+         "write_geojson": "00_Create Project.ipynb",
+         "staging_dir": "00_Create Project.ipynb",
+         "publish_project": "00_Create Project.ipynb",
          "main": "00_Create Project.ipynb"}
 
 modules = ["create_project.py"]
@@ -0,0 +1,205 @@
+"""Benchmarks of the stages of the summarization pipeline on synthetic records (see `junevis.synthetic`).
+
+Every stage runs in a fresh process, to measure its time and peak resident memory independently of the others. Results are
+written as JSON, to compare against a baseline from another commit:
+
+    python -m junevis.benchmark --sizes 100000 1000000 --out benchmarks/new.json --baseline benchmarks/old.json
+
+`--imports` instead checks that the command line tools start within `IMPORT_BUDGETS` (run by `make test`):
+
+    python -m junevis.benchmark --imports
+"""
+
+from pathlib import Path
+from typing import *
+import argparse
+import datetime
+import json
+import multiprocessing
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+STAGES = ["table_to_df", "combine_start_end", "get_regional_intervals", "regional_outputs", "collect_statistics"]
+N_STATISTICS_RUNS = 20  # Summaries that `collect_statistics` merges
+
+# Seconds that importing each module may take in a fresh interpreter, on top of starting the interpreter itself. Heavy
+# dependencies that only some commands need (pandas, geopandas, tables, uvicorn) are imported where they are used to
+# stay within them: the command line of `junevis_create` answers `--help` and the server starts without loading pandas.
+# Importing pandas alone takes about 0.25s, so loading it at import again goes over budget
+IMPORT_BUDGETS = {"junevis.create_project": 0.6, "junevis.server": 0.5}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024  # Bytes on macOS, KB on Linux
+
+
+def _hospital_stays(record_f: Path):
+    """Inputs of `combine_start_end` for the stays in hospital, as in the original pandas pipeline"""
+    import pandas as pd
+    from junevis.record_reader import RecordReader
+
+    read = RecordReader(record_f)
+    admissions = read.get_table_with_extras("hospital_admissions", "patient_ids")
+    discharges = read.get_table_with_extras("discharges", "patient_ids", with_people=False)
+    deaths = read.get_table_with_extras("deaths", "dead_person_ids", with_people=False)
+    ends = pd.concat([deaths[deaths["location_specs"] == "hospital"]["timestamp"], discharges["timestamp"]])
+    return admissions, ends
+
+
+def _run_stage(stage: str, record_f: str, workdir: str) -> dict:
+    """Run `stage` on `record_f` and measure it. Inputs are prepared before the clock (and `base_rss_mb`) start"""
+    record_f, workdir = Path(record_f), Path(workdir)
+    if stage == "table_to_df":
+        from junevis.record_reader import RecordReader
+
+        read = RecordReader(record_f)
+        run = lambda: [read.table_to_df("population"), read.table_to_df("infections", index="infected_ids")]
+    elif stage in ("combine_start_end", "get_regional_intervals"):
+        from junevis import process_loggers
+
+        admissions, ends = _hospital_stays(record_f)
+        if stage == "combine_start_end":
+            run = lambda: process_loggers.combine_start_end(admissions, ends)
+        else:
+            run = lambda: process_loggers.get_regional_intervals(admissions, ends, (0, 12, 25, 65, 101), "currently_in_hospital")
+    elif stage == "regional_outputs":
+        from junevis import process_loggers
+
+        run = lambda: process_loggers.regional_outputs(record_f)
+    elif stage == "collect_statistics":
+        from junevis.create_project import collect_statistics, summarize_h5, summary_name
+
+        project = workdir / "project"
+        project.mkdir(exist_ok=True)
+        summarize_h5(record_f, project)
+        for i in range(1, N_STATISTICS_RUNS):
+            shutil.copy(project / summary_name(record_f), project / f"summary_{i:03}.csv")
+        run = lambda: collect_statistics(project)
+    else:
+        raise ValueError(f"Unknown stage '{stage}'. Choose from {STAGES}")
+
+    base_rss = _peak_rss_mb()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "base_rss_mb": base_rss, "peak_rss_mb": _peak_rss_mb()}
+
+
+def run_benchmarks(sizes: Sequence[int], stages: Sequence[str] = STAGES, repeat: int = 1, n_regions: int = 20) -> dict:
+    """Time every stage on a synthetic record of each population size in `sizes`, keeping the fastest of `repeat` runs"""
+    from junevis.synthetic import write_record
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_people in sizes:
+            record_f = Path(tmp) / f"record_{n_people}.h5"
+            write_record(record_f, n_people=n_people, n_regions=n_regions)
+            for stage in stages:
+                runs = []
+                for _ in range(repeat):
+                    workdir = Path(tempfile.mkdtemp(dir=tmp))
+                    with ctx.Pool(1) as pool:
+                        runs.append(pool.apply(_run_stage, (stage, str(record_f), str(workdir))))
+                    shutil.rmtree(workdir)
+                best = min(runs, key=lambda r: r["seconds"])
+                results.append({"stage": stage, "n_people": n_people, **best})
+                print(f"{stage:>24} {n_people:>10} people: {best['seconds']:8.3f}s, peak {best['peak_rss_mb'] or 0:8.1f} MB")
+    return {"environment": environment(), "results": results}
+
+
+def import_times(modules: Sequence[str] = tuple(IMPORT_BUDGETS), repeat: int = 3) -> Dict[str, float]:
+    """Seconds to import each of `modules` in a fresh interpreter (the fastest of `repeat` times), less the time to start
+    an interpreter that imports nothing"""
+    def fastest(code: str) -> float:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-W", "ignore", "-c", code], check=True)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    base = fastest("pass")
+    return {m: round(fastest(f"import {m}") - base, 3) for m in modules}
+
+
+def over_budget(times: Dict[str, float], budgets: Dict[str, float] = IMPORT_BUDGETS) -> List[str]:
+    return [f"{m}: {t:.3f}s > {budgets[m]:.3f}s" for m, t in times.items() if m in budgets and t > budgets[m]]
+
+
+def environment() -> dict:
+    import numpy, pandas, tables
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "tables": tables.__version__,
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.2) -> List[str]:
+    """Stages and sizes that are more than `tolerance` (relative) slower or use more memory than in `baseline`"""
+    before = {(r["stage"], r["n_people"]): r for r in baseline["results"]}
+    regressions = []
+    for r in current["results"]:
+        old = before.get((r["stage"], r["n_people"]))
+        if old is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if old.get(metric) and r.get(metric) and r[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{r['stage']} ({r['n_people']} people): {metric} {old[metric]:.3f} -> {r[metric]:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000], help="Population sizes to benchmark")
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="Stages to benchmark")
+    parser.add_argument("--repeat", type=int, default=1, help="Keep the fastest of this many runs of each stage")
+    parser.add_argument("--out", type=str, default=None, help="JSON file to write the results to")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown reported as a regression")
+    parser.add_argument("--imports", action="store_true", help="Only check the import times against `IMPORT_BUDGETS`")
+    args = parser.parse_args()
+
+    if args.imports:
+        times = import_times()
+        for m, t in times.items():
+            print(f"{m:>24}: {t:.3f}s (budget {IMPORT_BUDGETS[m]:.3f}s)")
+        slow = over_budget(times)
+        print("\n".join(["Over budget:"] + slow) if slow else "All imports within budget")
+        sys.exit(1 if slow else 0)
+
+    current = run_benchmarks(args.sizes, args.stages, repeat=args.repeat)
+    if args.out is not None:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out, "w") as fp:
+            json.dump(current, fp, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            regressions = compare(json.load(fp), current, args.tolerance)
+        print("\n".join(["Regressions:"] + regressions) if regressions else "No regressions")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Build projects in the background of `junevis.server`.
+
+Every job runs `junevis_create` on a folder of records in a process of its own, at most `max_jobs` at a time, so the
+server keeps answering requests while records are summarized and a job that runs out of memory only takes itself down.
+Jobs build their project in a staging folder and move it to the projects folder once complete (`--staging`), so the
+server never sees a project half written. Jobs only read records in `records_dir`, and can only update an existing
+project (`incremental`), not replace it.
+
+A job reports its progress by appending JSON lines to a file (`--progress`), one per stage it starts or finishes and per
+record it summarizes, which `BuildQueue.status` folds into:
+
+    {"id", "project_name", "record_path", "status": "queued" | "running" | "complete" | "failed" | "cancelled",
+     "created", "started", "finished", "returncode", "stage": current stage, "stages": [{"name", "started", "finished"}],
+     "records": {"done", "total", "last"}, "log": last lines of the output of the job}
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import *
+import itertools
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from junevis.profiling import stage, Stage
+
+logger = logging.getLogger(__name__)
+
+# Options of `junevis_create` that a job may set, and the kind of value each takes
+BUILD_OPTIONS = {
+    "description": str,
+    "incremental": bool,
+    "workers": int,
+    "max_worker_memory": float,
+    "max_memory": float,
+    "summary_format": str,
+    "aggregates": bool,
+    "compress": bool,
+    "levels": list,
+    "time_steps": list,
+    "cube": bool,
+    "profile": bool,
+}
+
+N_LOG_LINES = 20
+
+
+class BuildProgress:
+    """Reports the progress of a build as JSON lines appended to `path`, or nowhere if it is None"""
+
+    def __init__(self, path: Union[Path, str, None] = None):
+        self.path = None if path is None else Path(path)
+
+    def report(self, **event):
+        if self.path is None:
+            return
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps({"time": time.time(), **event}) + "\n")
+
+    @contextmanager
+    def stage(self, name: str, **info) -> Iterator[Stage]:
+        """Profile the code in this context as stage `name` (see `profiling.stage`), reporting when it starts and ends"""
+        self.report(stage=name, status="started", **info)
+        with stage(name) as s:
+            yield s
+        self.report(stage=name, status="finished")
+
+
+def read_progress(path: Union[Path, str]) -> dict:
+    """The stages and records that the build reporting to `path` went through so far"""
+    progress = {"stage": None, "stages": [], "records": {"done": 0, "total": None, "last": None}}
+    try:
+        with open(path) as fp:
+            lines = fp.readlines()
+    except FileNotFoundError:
+        return progress
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:  # The line being written
+            continue
+        if "record" in event:
+            progress["records"] = {"done": event["done"], "total": event["total"], "last": event["record"]}
+        elif event.get("status") == "started":
+            progress["stages"].append({"name": event["stage"], "started": event["time"], "finished": None})
+            progress["stage"] = event["stage"]
+            if "records" in event:
+                progress["records"]["total"] = event["records"]
+        elif event.get("status") == "finished":
+            for s in progress["stages"]:
+                if s["name"] == event["stage"] and s["finished"] is None:
+                    s["finished"] = event["time"]
+            progress["stage"] = None
+    return progress
+
+
+def build_args(record_path: str, project_name: str, options: dict) -> List[str]:
+    """Command line options of `junevis_create` for a job. Raises ValueError for options a job may not set"""
+    unknown = [k for k in options if k not in BUILD_OPTIONS]
+    if unknown:
+        raise ValueError(f"Unknown build options {unknown}. Choose from {list(BUILD_OPTIONS)}")
+    args = [str(record_path), "--project_name", project_name]
+    for k, v in options.items():
+        kind = BUILD_OPTIONS[k]
+        if v is None or v is False:
+            continue
+        if kind is bool:
+            if v is not True:
+                raise ValueError(f"Build option '{k}' takes true or false, not {v!r}")
+            args.append(f"--{k}")
+        elif kind is list:
+            values = [v] if isinstance(v, str) else list(v)
+            args += [f"--{k}", *[str(x) for x in values]]
+        else:
+            try:
+                args += [f"--{k}", str(kind(v))]
+            except (TypeError, ValueError):
+                raise ValueError(f"Build option '{k}' takes a {kind.__name__}, not {v!r}")
+    return args
+
+
+class BuildQueue:
+    """Runs the build jobs submitted to it in order, at most `max_jobs` at the same time, on the records in folders of
+    `records_dir`. Each job may use at most `max_job_memory` GB (address space of the main process of the job, and of
+    each of its workers) and `max_job_workers` processes to summarize records. The progress and output of every job are
+    kept in `jobs_dir`"""
+
+    def __init__(self, records_dir: Union[Path, str], jobs_dir: Union[Path, str, None] = None, max_jobs: int = 1,
+                 max_job_memory: Optional[float] = None, max_job_workers: int = 1):
+        self.records_dir = Path(records_dir).resolve()
+        self.jobs_dir = Path(tempfile.mkdtemp(prefix="junevis-builds-") if jobs_dir is None else jobs_dir)
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.max_job_memory = max_job_memory
+        if max_job_memory is not None and os.name != "posix":
+            logger.warning("Cannot limit the memory of build jobs on this platform")
+        self.max_job_workers = max_job_workers
+        self.jobs = {}
+        self._queue = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._runners = [threading.Thread(target=self._run_jobs, daemon=True, name=f"build-{i}") for i in range(max_jobs)]
+        for t in self._runners:
+            t.start()
+
+    def submit(self, record_path: Union[Path, str], project_name: Optional[str] = None, **options) -> dict:
+        """Queue a job to build `project_name` (the name of the folder `record_path` if not given) with the `options`
+        of `junevis_create` in `BUILD_OPTIONS`. `record_path` is relative to `records_dir`, and may not lead out of it.
+        Raises ValueError for invalid options, or if a job for that project is already queued or running. Returns the
+        status of the job"""
+        record_path = (self.records_dir / record_path).resolve()
+        if record_path != self.records_dir and self.records_dir not in record_path.parents:
+            raise ValueError(f"Records must be in '{self.records_dir}'")
+        if not (record_path / "parameter_grid.json").exists():
+            raise ValueError(f"No records and parameter grid in '{record_path}'")
+        project_name = record_path.stem if project_name is None else project_name
+        if Path(project_name).name != project_name or project_name.startswith("."):
+            raise ValueError(f"Invalid project name '{project_name}'")
+        build_args(str(record_path), project_name, options)  # Fail early on invalid options
+        options = dict(options)
+        if int(options.get("workers") or 1) > self.max_job_workers:
+            raise ValueError(f"A job may use at most {self.max_job_workers} workers")
+        if self.max_job_memory is not None:
+            options["max_worker_memory"] = min(float(options.get("max_worker_memory") or self.max_job_memory), self.max_job_memory)
+            if options.get("max_memory") is None:
+                options["max_memory"] = self.max_job_memory / 2  # Read records in chunks that fit the limit
+        args = build_args(str(record_path), project_name, options)
+        if self.max_job_memory is not None and os.name == "posix":
+            # The job caps its own memory as it starts: the server has threads, which rules out `preexec_fn`
+            args += ["--memory_limit", str(self.max_job_memory)]
+
+        with self._lock:
+            busy = [j for j in self.jobs.values() if j["project_name"] == project_name and j["status"] in ("queued", "running")]
+            if busy:
+                raise ValueError(f"Project '{project_name}' is already being built by job {busy[0]['id']}")
+            job_id = f"{next(self._ids):04}-{os.getpid()}"
+            folder = self.jobs_dir / job_id
+            folder.mkdir()
+            job = {
+                "id": job_id,
+                "project_name": project_name,
+                "record_path": str(record_path),
+                "options": options,
+                "status": "queued",
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+                "returncode": None,
+                "args": args + ["--staging", "--progress", str(folder / "progress.jsonl")],
+                "folder": folder,
+                "process": None,
+            }
+            self.jobs[job_id] = job
+            self._queue.append(job_id)
+            self._ready.notify()
+        logger.info(f"Queued job {job_id} to build '{project_name}' from {record_path}")
+        return self.status(job_id)
+
+    def _run_jobs(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    self._ready.wait()
+                job = self.jobs[self._queue.pop(0)]
+                job["status"], job["started"] = "running", time.time()
+                # Started under the lock, so that a job cancelled meanwhile is never started. Each job leads a process
+                # group of its own, which `cancel` stops along with the workers of the job
+                with open(job["folder"] / "output.log", "wb") as log:
+                    job["process"] = subprocess.Popen(
+                        [sys.executable, "-m", "junevis.create_project", *job["args"]],
+                        stdout=log,
+                        stderr=subprocess.STDOUT,
+                        start_new_session=True,
+                    )
+            returncode = job["process"].wait()
+            with self._lock:
+                job["returncode"], job["finished"] = returncode, time.time()
+                if job["status"] == "running":
+                    job["status"] = "complete" if returncode == 0 else "failed"
+            logger.info(f"Job {job['id']} building '{job['project_name']}' {job['status']}")
+
+    def cancel(self, job_id: str) -> dict:
+        """Stop the job `job_id` if it is queued or running. Raises KeyError for unknown jobs"""
+        with self._lock:
+            job = self.jobs[job_id]
+            if job["status"] == "queued":
+                self._queue.remove(job_id)
+                job["status"], job["finished"] = "cancelled", time.time()
+            elif job["status"] == "running":
+                job["status"] = "cancelled"
+                try:
+                    if hasattr(os, "killpg"):
+                        os.killpg(job["process"].pid, signal.SIGTERM)
+                    else:
+                        job["process"].terminate()
+                except ProcessLookupError:  # Finished meanwhile
+                    pass
+        return self.status(job_id)
+
+    def status(self, job_id: str) -> dict:
+        """Status of the job `job_id` (see the module). Raises KeyError for unknown jobs"""
+        job = self.jobs[job_id]
+        status = {k: v for k, v in job.items() if k not in ("args", "folder", "process")}
+        status.update(read_progress(job["folder"] / "progress.jsonl"))
+        try:
+            with open(job["folder"] / "output.log", errors="replace") as fp:
+                status["log"] = [l.rstrip("\n") for l in fp.readlines()[-N_LOG_LINES:]]
+        except FileNotFoundError:
+            status["log"] = []
+        return status
+
+    def list(self) -> List[dict]:
+        """Summary of every job, in the order they were submitted"""
+        keys = ["id", "project_name", "status", "created", "started", "finished", "returncode"]
+        return [{k: job[k] for k in keys} for job in list(self.jobs.values())]
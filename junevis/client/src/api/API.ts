@@ -6,13 +6,14 @@
  * the data they need
  */
 
-import {text} from "d3-fetch"
+import {text, json} from "d3-fetch"
 import { memoize } from "@/utils/cacher"
 import { JuneProject } from "@/logic/JuneProject"
-import { JuneSim } from "@/logic/JuneSimulation"
+import { JuneSim, toDate } from "@/logic/JuneSimulation"
 import * as tp from "@/types"
 import { ExtendedFeatureCollection } from "d3-geo";
 import { formatValDisplay } from "@/logic/display"
+import Config from "@/logic/ui_config"
 
 export const allProjectNames: () => Promise<string[]> = memoize(async () => {
     // Fix this
@@ -69,6 +70,31 @@ export async function getRegionTrace(p_id: string, run_id: string, region: strin
     return run.aggregateByRegion(region)
 }
 
+/**
+ * The values by day of each of `fields` in a region (or "all" and "average" of them), from a slice of the run if the
+ * API of `junevis.server` is available
+ */
+export async function getFieldTraces(p_id: string, run_id: string, region: string, fields: string[]): Promise<{ [field: string]: number[] }> {
+    if (await hasRunApi()) {
+        const slice = await getRunSlice(p_id, run_id, { fields, ...regionQuery(region) })
+        return Object.fromEntries(fields.map(f => [f, slice.fields[f][0] as number[]]))
+    }
+    const trace = await getRegionTrace(p_id, run_id, region)
+    return Object.fromEntries(fields.map(f => [f, trace.map(t => +(t[f] as number))]))
+}
+
+/**
+ * The values by day of `field` in every region of a run, keyed by region
+ */
+export async function getRegionFieldTraces(p_id: string, run_id: string, field: string): Promise<{ [region: string]: number[] }> {
+    if (await hasRunApi()) {
+        const slice = await getRunSlice(p_id, run_id, { fields: [field] })
+        return Object.fromEntries(slice.regions.map((r, i) => [r, slice.fields[field][i] as number[]]))
+    }
+    const run = await getRun(p_id, run_id)
+    return Object.fromEntries(run.allRegions.map(r => [r, run.aggregateByRegion(r).map(t => +(t[field] as number))]))
+}
+
 export async function getParamSelection(p_id: string): Promise<tp.ParamOptions[]> {
     const project = await getProject(p_id)
     return project.paramList
@@ -78,16 +104,30 @@ export async function getParamSelection(p_id: string): Promise<tp.ParamOptions[]
  * Return the trace for a single region, given a particular field
  */
 export async function getTraceWithField(p_id: string, run_id: string, region: string, field: string): Promise<{ x: Date | number, y: any }[]> {
+    if (await hasRunApi()) {
+        return slicePoints(await getRunSlice(p_id, run_id, { fields: [field], ...regionQuery(region) }), field)
+    }
     const run = await getRun(p_id, run_id)
     return run.getTraceWithField(region, field)
 }
 
+/**
+ * The traces of `getTraceWithField` for several runs, fetched in one request if the API of `junevis.server` is available
+ */
+export async function getTracesWithField(p_id: string, run_ids: string[], region: string, field: string): Promise<{ x: Date | number, y: any }[][]> {
+    if (run_ids.length > 0 && await hasRunApi()) {
+        const slices = await getRunSlices(p_id, run_ids, { fields: [field], ...regionQuery(region) })
+        return run_ids.map(r => slicePoints(slices[r], field))
+    }
+    return Promise.all(run_ids.map(r => getTraceWithField(p_id, r, region, field)))
+}
+
 /**
  * Extract default run-parameters for project
  */
 export async function getRunParameters(p_id: string, run_id: string): Promise<tp.RunParameters> {
-    const run = await getRun(p_id, run_id)
-    return run.run_parameters
+    const project = await getProject(p_id)
+    return project.run_parameters[run_id]
 }
 
 /**
@@ -138,15 +178,36 @@ export async function filterByParamSelection(p_id: string, query: tp.ParamQuery)
     return project.filterBySelection(query)
 }
 
+/**
+ * The runs matching a parameter selection as in `filterByParamSelection`, along with the mean and percentiles of `field`
+ * in `region` across them. With the API of `junevis.server` both come from one request to `getAggregate`, which the
+ * server computes and caches, instead of downloading and averaging every run. Without it, `band` is null
+ */
+export async function aggregateSelection(p_id: string, query: tp.ParamQuery, region: string, field: string): Promise<{ runIds: string[], band: tp.TraceBand | null }> {
+    if (await hasRunApi()) {
+        const agg = await getAggregate(p_id, query, { fields: [field], ...regionQuery(region) })
+        const runIds = agg.runs.map(String)
+        if (runIds.length == 0) return { runIds, band: null }
+
+        const stats = agg.fields[field]
+        const band = {
+            x: agg.timestamps.map((t, i) => Config.showRealDate ? toDate(t) : i),
+            stats: <tp.TraceBand["stats"]>Object.fromEntries(Object.entries(stats).map(([stat, values]) => [stat, values[0]]))
+        }
+        return { runIds, band }
+    }
+    return { runIds: await filterByParamSelection(p_id, query), band: null }
+}
+
 /**
  *  Get legend values across paramName
  */
 export async function getLegend(p_id: string, run_ids: string[], paramName: string): Promise<string[]> {
-    const runs = await getRuns(p_id, run_ids)
-    return runs.map(run => {
-        let v = run.run_parameters[paramName]
+    const project = await getProject(p_id)
+    return run_ids.map(run_id => {
+        let v = project.run_parameters[run_id][paramName]
         if (paramName == "") {
-            return `run-${run.runId}`
+            return `run-${run_id}`
         }
         return `${paramName}=${formatValDisplay(v)}`
     })
@@ -156,4 +217,71 @@ export async function baseNumericFields(p_id: string) {
     const project = await getProject(p_id)
     const out = project.baseNumericFields
     return out
-}
\ No newline at end of file
+}
+
+/**
+ * Whether the frontend is served by `junevis.server`, whose API sends slices of the runs. Without it (e.g. with
+ * `npm run serve`) the views fetch whole summaries instead
+ */
+export const hasRunApi: () => Promise<boolean> = memoize(async () => {
+    try {
+        await json("api/projects?limit=1")
+        return true
+    } catch (e) {
+        return false
+    }
+})
+
+/**
+ * The slice query of a region, including the "all" and "average" regions of `JuneSim` that combine every region
+ */
+function regionQuery(region: string): tp.RunSliceQuery {
+    if (region == "all") return { combine: "sum" }
+    if (region == "average") return { combine: "mean" }
+    return { regions: [region] }
+}
+
+/**
+ * The points of `field` in a slice of a single region, like `JuneSim.getTraceWithField`
+ */
+function slicePoints(slice: tp.RunSlice, field: string): { x: Date | number, y: any }[] {
+    return slice.timestamps.map((t, i) => ({ x: Config.showRealDate ? toDate(t) : i, y: slice.fields[field][0][i] }))
+}
+
+function sliceParams(query: tp.RunSliceQuery, extra: { [key: string]: string } = {}): string {
+    const params = new URLSearchParams(extra)
+    if (query.fields) params.set("fields", query.fields.join(","))
+    if (query.regions) params.set("regions", query.regions.join(","))
+    if (query.start) params.set("start", query.start)
+    if (query.end) params.set("end", query.end)
+    if (query.level) params.set("level", query.level)
+    if (query.step) params.set("step", query.step)
+    if (query.max_points) params.set("max_points", String(query.max_points))
+    if (query.combine) params.set("combine", query.combine)
+    return params.toString()
+}
+
+/**
+ * Fetch only a slice of a run from the API of `junevis.server` instead of its whole summary file.
+ * Only available when the frontend is served by `junevis.server`
+ */
+export async function getRunSlice(p_id: string, run_id: string, query: tp.RunSliceQuery = {}): Promise<tp.RunSlice> {
+    return json(`api/projects/${p_id}/runs/${run_id}?${sliceParams(query)}`) as Promise<tp.RunSlice>
+}
+
+/**
+ * The same slice of several runs (all runs of the project if `run_ids` is not given), keyed by run id
+ */
+export async function getRunSlices(p_id: string, run_ids?: string[], query: tp.RunSliceQuery = {}): Promise<{ [run_id: string]: tp.RunSlice }> {
+    const extra = run_ids ? { run_ids: run_ids.join(",") } : {}
+    const out = await json(`api/projects/${p_id}/runs?${sliceParams(query, extra)}`) as { runs: { [run_id: string]: tp.RunSlice } }
+    return out.runs
+}
+
+/**
+ * Mean, min, max and percentiles across the runs matching a parameter selection, computed (and cached) by the server
+ * instead of fetching every run
+ */
+export async function getAggregate(p_id: string, selection: tp.ParamQuery, query: tp.RunSliceQuery = {}): Promise<tp.RunAggregate> {
+    return json(`api/projects/${p_id}/aggregate?${sliceParams(query, { selection: JSON.stringify(selection) })}`) as Promise<tp.RunAggregate>
+}
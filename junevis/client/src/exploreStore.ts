@@ -9,6 +9,10 @@ import {
 import * as tp from "@/types"
 import * as api from "@/api/API"
 import * as R from "ramda"
+import { lineColor } from "@/logic/display"
+
+// Selections of more runs than this are drawn as the band of their percentiles, if the server sent it
+const MAX_RUN_TRACES = 10
 
 interface StateI {
     selectedRunIds: string[]
@@ -23,6 +27,7 @@ interface StateI {
     xTrace: any[]
     overviewYTraces: any[][]
     overviewTraces: tp.Trace[]
+    selectionBand: tp.TraceBand | null
     paramOptions: tp.ParamOptions[]
     selectedParamIdxs: (number | null)[]
     freeIdx: number | null
@@ -44,6 +49,7 @@ const state = reactive(<StateI>{
     xTrace: [],
     overviewYTraces: [[]],
     overviewTraces: [],
+    selectionBand: null,
     paramOptions: [],
     freeIdx: null,
     selectedParamIdxs: [], // Update this to start with the empty list
@@ -146,21 +152,45 @@ const store = {
     },
 }
 
-watch(() => [state.freeIdx, state.selectedParamIdxs, state.paramOptions], async () => {
-    state.selectedRunIds = await api.filterByParamSelection(state.projectId, store.paramSelectionQuery.value)
-    state.legend = await api.getLegend(state.projectId, state.selectedRunIds, store.freeParamName.value)
+function drawsBand(): boolean {
+    return state.selectionBand != null && state.selectedRunIds.length > MAX_RUN_TRACES
+}
+
+/**
+ * Traces of the mean of the selected runs over the bands of their 5th to 95th and 25th to 75th percentiles
+ */
+function bandTraces(band: tp.TraceBand): tp.Trace[] {
+    const color = lineColor(0)
+    const edge = { width: 0, color }
+    const fill = (lo: tp.AggregateStatistic, hi: tp.AggregateStatistic, opacity: string): tp.Trace[] => [
+        { x: band.x, y: band.stats[lo], line: edge, showlegend: false, hoverinfo: "skip" },
+        { x: band.x, y: band.stats[hi], line: edge, fill: "tonexty", fillcolor: color + opacity, name: `${lo}-${hi}` },
+    ]
+    return [
+        ...fill("p5", "p95", "33"),
+        ...fill("p25", "p75", "55"),
+        { x: band.x, y: band.stats.mean, line: { color }, name: `mean of ${state.selectedRunIds.length} runs` },
+    ]
+}
+
+watch(() => [state.freeIdx, state.selectedParamIdxs, state.paramOptions, state.selectedField, state.selectedRegion], async () => {
+    const selection = await api.aggregateSelection(state.projectId, store.paramSelectionQuery.value, state.selectedRegion, state.selectedField)
+    state.selectedRunIds = selection.runIds
+    state.selectionBand = selection.band
+    state.legend = drawsBand() ? [] : await api.getLegend(state.projectId, state.selectedRunIds, store.freeParamName.value)
 })
 
-watch(() => [state.selectedRunIds, state.selectedField, state.selectedRegion, state.baselineRunId], async () => {
-    Promise.all(state.selectedRunIds.map(runId => api.getTraceWithField(state.projectId, runId, state.selectedRegion, state.selectedField))).then(r => {
-        const selectedOverviewTraces = r.map(rawTrace => {
+watch(() => [state.selectedRunIds, state.selectionBand, state.baselineRunId], async () => {
+    const selectedTraces: Promise<tp.Trace[]> = drawsBand()
+        ? Promise.resolve(bandTraces(<tp.TraceBand>state.selectionBand))
+        : api.getTracesWithField(state.projectId, state.selectedRunIds, state.selectedRegion, state.selectedField).then(r => r.map(rawTrace => {
             const x = rawTrace.map(t => t.x)
             const y = rawTrace.map(t => t.y)
             return { x, y }
-        });
-
+        }))
+    selectedTraces.then(selectedOverviewTraces => {
         if (state.baselineRunId != "") {
-            api.getRun(state.projectId, state.baselineRunId).then(baseRun => {
+            api.getRunParameters(state.projectId, state.baselineRunId).then(baseParams => {
                 api.getTraceWithField(state.projectId, state.baselineRunId, state.selectedRegion, state.selectedField).then(trace => {
                     const x = trace.map(t => t.x)
                     const y = trace.map(t => t.y)
@@ -168,7 +198,7 @@ watch(() => [state.selectedRunIds, state.selectedField, state.selectedRegion, st
                         dash: 'dash',
                         color: "black",
                     }
-                    const name = state.selectedRunIds.length <= 1 ? `run-${state.baselineRunId}` : `${freeParamName.value}=${baseRun.run_parameters[freeParamName.value]}`
+                    const name = state.selectedRunIds.length <= 1 ? `run-${state.baselineRunId}` : `${freeParamName.value}=${baseParams[freeParamName.value]}`
                     let baselineOverviewTrace = {
                         x, y, line, name
                     }
@@ -1,9 +1,10 @@
-import { json, csv } from "d3-fetch"
+import { json, csv, buffer } from "d3-fetch"
 import { format } from "d3-format";
 import { ascending } from "d3-array";
 import * as tp from "@/types"
 import * as R from "ramda"
 import { JuneSim } from "./JuneSimulation"
+import { parseSummary } from "./summaryFormat"
 import { ExtendedFeatureCollection, geoMercator, GeoProjection } from "d3-geo";
 import { SiteGeo } from "@/logic/GeoTypes";
 
@@ -43,7 +44,7 @@ export class JuneProject {
     _baseCache: typeof LRU // for fetching statistics about project
     _runCache: typeof LRU // No typescript implemented for this...
 
-    _geoData: (Promise<tp.GeoJson> | null) = null
+    _geoData: Map<string, Promise<tp.GeoJson>> = new Map()
 
 
     // Use `.build(projectName)` to initialize this class
@@ -195,11 +196,18 @@ export class JuneProject {
         }, [Number.POSITIVE_INFINITY, Number.NEGATIVE_INFINITY])
     }
 
-    async geoFile(): Promise<tp.GeoJson> {
-        if (this._geoData == null) {
-            this._geoData = json(`${this.path}/sites.geojson`);
+    /**
+     * Geography of the project, in the coarsest simplified level that still looks exact on a map `pixels` wide
+     * (the finest level for larger maps, and the full `sites.geojson` for projects without levels)
+     */
+    async geoFile(pixels: number = 1200): Promise<tp.GeoJson> {
+        const levels = this.metadata.geo_levels || []
+        const level = levels.find(l => l.pixels >= pixels) || levels[levels.length - 1]
+        const fname = level ? level.file : "sites.geojson"
+        if (!this._geoData.has(fname)) {
+            this._geoData.set(fname, json(`${this.path}/${fname}`));
         }
-        return this._geoData;
+        return this._geoData.get(fname);
     }
 
     async geoProjection(width: number, height: number): Promise<GeoProjection> {
@@ -270,13 +278,17 @@ export class JuneProject {
 
     async getRun(run_id: string): Promise<JuneSim> {
         const f3 = format('03i')
-        const fname = this.path + `/summary_${f3(Number(run_id))}.csv`
+        const summaryFormat = this.metadata.summary_format || "csv"
+        const fname = this.path + `/summary_${f3(Number(run_id))}.${summaryFormat}`
 
         if (!this._runCache.has(fname)) {
             console.log("Setting cache of run... -- ", fname);
+            const rows: Promise<tp.RawRunData[]> = summaryFormat == "bin"
+                ? buffer(fname).then(parseSummary)
+                : <Promise<any>>csv(fname)
 
             // Add run parameters to object
-            this._runCache.set(fname, (<Promise<any>>csv(fname)).then((data: tp.RawRunData[]) => {
+            this._runCache.set(fname, rows.then((data: tp.RawRunData[]) => {
                 const run_parameters = this.run_parameters[run_id]
                 return new JuneSim(data, run_parameters, run_id)
             }))
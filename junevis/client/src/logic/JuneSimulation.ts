@@ -7,7 +7,7 @@ const stringFields = new Set(["timestamp", "region", "date_time"])
 /**
  * Convert provided time string into javascript Date
  */
-function toDate(day: string): Date {
+export function toDate(day: string): Date {
     const dateArgs = <[number, number, number]>day.split("-").slice(0, 3).map(Number)
     dateArgs[1] = dateArgs[1] - 1; // Months are 0 indexed. Why?
 
@@ -0,0 +1,69 @@
+import * as tp from "@/types"
+
+/**
+ * Reader for the binary run summaries (`summary_XXX.bin`) written by `junevis/summary_format.py`.
+ *
+ * Every field is stored as a dense region x day array in a typed format, so no text needs to be parsed
+ */
+
+const MAGIC = "JUNESUM1"
+
+interface SummaryField {
+    name: string
+    dtype: string
+    integer: boolean
+    offset: number
+}
+
+interface SummaryHeader {
+    regions: string[]
+    timestamps: string[]
+    index_names: string[]
+    fields: SummaryField[]
+    mask_offset: number | null
+}
+
+// Numpy dtype strings to typed arrays. Typed arrays use the platform byte order, which is little endian in every browser
+const typedArrays: { [dtype: string]: any } = {
+    "|u1": Uint8Array,
+    "|i1": Int8Array,
+    "<u2": Uint16Array,
+    "<i2": Int16Array,
+    "<u4": Uint32Array,
+    "<i4": Int32Array,
+    "<f8": Float64Array,
+}
+
+function readHeader(buffer: ArrayBuffer): SummaryHeader {
+    const decoder = new TextDecoder("utf-8")
+    if (decoder.decode(new Uint8Array(buffer, 0, MAGIC.length)) != MAGIC) {
+        throw new Error("Not a binary run summary")
+    }
+    const headerLength = new DataView(buffer).getUint32(MAGIC.length, true)
+    return JSON.parse(decoder.decode(new Uint8Array(buffer, MAGIC.length + 4, headerLength)))
+}
+
+/**
+ * Convert a binary summary into the rows that parsing the equivalent CSV would give
+ */
+export function parseSummary(buffer: ArrayBuffer): tp.RawRunData[] {
+    const header = readHeader(buffer)
+    const nDays = header.timestamps.length
+    const nRows = header.regions.length * nDays
+    const columns = header.fields.map(f => new typedArrays[f.dtype](buffer, f.offset, nRows))
+    const mask = header.mask_offset == null ? null : new Uint8Array(buffer, header.mask_offset, nRows)
+    const [regionName, timestampName] = header.index_names
+
+    const rows: tp.RawRunData[] = []
+    for (let i = 0; i < nRows; i++) {
+        if (mask != null && mask[i] == 0) continue
+        const row: any = {}
+        row[regionName] = header.regions[Math.floor(i / nDays)]
+        row[timestampName] = header.timestamps[i % nDays]
+        header.fields.forEach((f, j) => {
+            row[f.name] = columns[j][i]
+        })
+        rows.push(row)
+    }
+    return rows
+}
@@ -11,6 +11,14 @@ export interface RunParametersRecord {
 export interface FieldStatistic {
   min: number
   max: number
+  // Over all regions, days and runs. Missing in projects created before they were recorded
+  sum?: number
+  mean?: number
+  p5?: number
+  p25?: number
+  p50?: number
+  p75?: number
+  p95?: number
 }
 
 export interface ProjectDescription {
@@ -22,6 +30,56 @@ export interface ProjectDescription {
   all_timestamps: string[]
   all_fields: string[]
   field_statistics: { [key: string]: FieldStatistic }
+  summary_format?: "csv" | "bin" // Format of the `summary_XXX` files, "csv" if missing
+  summary_levels?: SummaryLevel[] // Levels of the geography the runs are summarized at, only "region" if missing
+  time_steps?: TimeStep[] // Time steps the runs are summarized per, only "day" if missing
+  geo_levels?: GeoLevel[] // Simplified geographies, coarsest first. Missing in projects created before they were written
+}
+
+// Groups of the geography a summary counts per. Summaries of finer levels than regions are in a folder of that name
+export type SummaryLevel = "region" | "super_area" | "area"
+
+// Periods a summary counts per, each named by its first day. Flows (e.g. `infected`) are summed over the period and
+// stocks (the `currently_` fields) take their value on its last day
+export type TimeStep = "day" | "week" | "month"
+
+// A copy of `sites.geojson` simplified to draw on maps up to `pixels` wide
+export interface GeoLevel {
+  file: string
+  pixels: number
+  tolerance: number
+  precision: number
+}
+
+// Slice of a run summary sent by the `/api/projects/{project}/runs` endpoints of `junevis/server.py`.
+// `fields[name][i][j]` is the value for `regions[i]` on `timestamps[j]`, null for missing rows
+export interface RunSlice {
+  regions: string[]
+  timestamps: string[]
+  fields: { [name: string]: (number | null)[][] }
+  time_step: TimeStep
+}
+
+export interface RunSliceQuery {
+  fields?: string[]
+  regions?: string[] // Names of the groups of `level`
+  start?: string
+  end?: string
+  level?: SummaryLevel // "region" if not given
+  step?: TimeStep // Chosen from `max_points` if not given, else "day"
+  max_points?: number // Use the finest time step with at most this many points between `start` and `end`
+  combine?: "sum" | "mean" // Combine the regions into one, named "all" or "average" like in `JuneSim`
+}
+
+// Statistics across runs sent by `/api/projects/{project}/aggregate`, as `fields[name][statistic][i][j]`
+export type AggregateStatistic = "mean" | "min" | "max" | "p5" | "p25" | "p50" | "p75" | "p95"
+
+export interface RunAggregate {
+  runs: number[]
+  time_step: TimeStep
+  regions: string[]
+  timestamps: string[]
+  fields: { [name: string]: { [stat in AggregateStatistic]: (number | null)[][] } }
 }
 
 // Columns for each simulated run
@@ -108,6 +166,16 @@ export interface Trace {
   y: any[]
   name?: string
   line?: any
+  fill?: string
+  fillcolor?: string
+  showlegend?: boolean
+  hoverinfo?: string
+}
+
+// Statistics across the runs of a selection of one field in one region, see `aggregateSelection`
+export interface TraceBand {
+  x: (Date | number)[]
+  stats: { [stat in AggregateStatistic]: (number | null)[] }
 }
 
 export interface TraceStatistics {
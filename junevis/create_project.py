@@ -1,63 +1,200 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_Create Project.ipynb (unless otherwise specified).
 
-__all__ = ['init_available_projects', 'summarize_h5', 'pgrid_to_run_parameters', 'collect_statistics', 'fix_geojson',
-           'main']
+__all__ = ['init_available_projects', 'summary_name', 'summary_names', 'resample_summary', 'summarize_h5',
+           'profile_dir', 'profile_path', 'summarize_records', 'pgrid_to_run_parameters', 'summary_statistics',
+           'collect_statistics', 'PERCENTILES', 'SKETCH_PERCENTILES', 'run_statistics', 'merge_statistics', 'file_hash',
+           'record_fingerprint', 'load_manifest', 'save_manifest', 'records_to_summarize', 'remove_stale_runs',
+           'write_aggregates', 'write_cubes', 'remove_cubes', 'largest_polygons', 'fix_geojson', 'simplify_shared',
+           'GEO_LEVELS', 'geo_levels', 'write_geojson', 'staging_dir', 'publish_project', 'main']
 
 # Cell
 from pathlib import Path
 import shutil
 import os
-import pandas as pd
-import geopandas as gpd
-import shapely
-from shapely.geometry.polygon import Polygon
-from shapely.ops import cascaded_union, unary_union
 import numpy as np
+import hashlib
 from time import time
+from functools import partial
+from multiprocessing import Pool
 from typing import *
 import junevis.path_fixes as pf
 import json
+import logging
 
-import junevis.process_loggers as process_loggers
+from junevis.table_cache import TableCache
+from junevis.summary_format import summary_suffix, write_summary, read_summary
+from junevis.run_store import RunStore, filter_by_selection, aggregate_runs, run_to_bytes, TIME_STEPS
+from junevis.project_cube import write_cube, remove_cube, CUBE_HEADER
+from junevis.project_catalog import ProjectCatalog
+from junevis.profiling import Profiler, stage, write_profile, read_profile
+from junevis.build_queue import BuildProgress
+
+logger = logging.getLogger(__name__)
+
+# pandas, and `process_loggers` which needs it, are imported where they are used: only summarizing records needs them
 
 # Cell
-def init_available_projects(project_name: str):
-    pf.AVAILABLE_PROJECTS.touch()
-
-    with open(str(pf.AVAILABLE_PROJECTS), 'r+') as fp:
-        available_projects = set([p.strip() for p in fp.readlines()])
-        if project_name in available_projects:
-            if not force_add_project:
-                raise ValueError(f"Cannot create project of name '{project_name}': Project already exists in {pf.AVAILABLE_PROJECTS}"
-    )
-            else:
-                shutil.rmtree(outdir) # Delete existing project of that name
-                fp.truncate(0); fp.seek(0); # Delete file contents
-                available_projects.remove(project_name)
-        return available_projects
+def init_available_projects(project_name: str, outdir: Path, force_add_project: bool=False, keep_existing: bool=False,
+                            catalog: Optional[ProjectCatalog]=None, staging: bool=False) -> Optional[dict]:
+    """Reserve `project_name` in the project catalog for this build and return the entry of an existing project of that
+    name, deleting it first if `force_add_project`. Raises ValueError if another build is creating a project of that
+    name.
+
+    With `keep_existing` (incremental updates), an existing project is kept in place so its summaries can be reused.
+    With `staging`, the project is built in another folder and an existing one is served until the new one replaces
+    it"""
+    catalog = ProjectCatalog() if catalog is None else catalog
+    delete = force_add_project and not keep_existing and not staging
+    existing = catalog.reserve(project_name, replace=force_add_project, keep_existing=keep_existing, withdraw=delete)
+    if existing is not None and delete:
+        shutil.rmtree(outdir, ignore_errors=True) # Delete existing project of that name
+    return existing
 
 # Cell
-def summarize_h5(record_f, outdir):
-    """Dependent on the context variable `output_dir`. The actual summarized output is much smaller than the record file itself"""
+def summary_name(record_f, fmt="csv", level="region", step="day"):
+    """Name of the summary file for `record_f` in format `fmt`, e.g. `record_07.h5` -> `summary_007.csv`. Summaries per
+    group of a finer `level` of the geography or per longer time `step` are in a folder of that level and step, e.g.
+    `area/summary_007.csv` or `area/week/summary_007.csv`"""
+    runId = Path(record_f).stem.split("_")[1]
+    folders = [f for f in [level, step] if f not in ("region", "day")]
+    return "/".join(folders + [f"summary_{int(runId):03}{summary_suffix(fmt)}"])
+
+def summary_names(record_f, fmt="csv", levels=("region",), steps=("day",)):
+    "Names of the summaries of `record_f` at every level of the geography in `levels` and time step in `steps`"
+    return [summary_name(record_f, fmt, level, step) for level in levels for step in steps]
+
+def resample_summary(df: "pd.DataFrame", step: str) -> "pd.DataFrame":
+    """Summary per time `step` (see `run_store.TIME_STEPS`) of a daily summary indexed by region and timestamp, every
+    period named by its first day.
+
+    Flows, like new infections and deaths, are summed over each period. Stocks, the `currently_` fields (including the
+    cumulative deaths and recoveries), take their value on the last day of the period that the region has a row for"""
+    import pandas as pd
+    import junevis.process_loggers as process_loggers
+    df = df.sort_index()
+    periods = pd.DatetimeIndex(df.index.get_level_values(1)).to_period(TIME_STEPS[step]).start_time
+    keys = [df.index.get_level_values(0), periods.rename(df.index.names[1])]
+    stocks = [c for c in df.columns if c.startswith("currently_")]
+    flows = [c for c in df.columns if c not in stocks]
+    out = pd.concat([df[flows].groupby(keys).sum(), df[stocks].groupby(keys).last()], axis=1)
+    compact = lambda col: process_loggers.compact_counts(col) if col.dtype.kind in "iu" else col
+    return pd.DataFrame({c: compact(out[c]) for c in df.columns}, index=out.index)
+
+def summarize_h5(record_f, outdir, cache:Optional[TableCache]=None, fmt="csv", max_memory:Optional[float]=None,
+                 levels:Sequence[str]=("region",), steps:Sequence[str]=("day",)):
+    """Dependent on the context variable `output_dir`. The actual summarized output is much smaller than the record
+    file itself.
+
+    With `max_memory` (in GB), the record is read in chunks to stay within about that much memory. Besides the daily
+    summary per region, which is returned, a summary is written for every finer level of the geography in `levels` (see
+    `process_loggers.multilevel_outputs`) and every longer time step in `steps` (see `resample_summary`)"""
+    import junevis.process_loggers as process_loggers
     start = time()
     runId = record_f.stem.split("_")[1]
-    print(f"Processing {runId}: ")
-    df = process_loggers.regional_outputs(record_f)
-
-    # Add cumulative columns
-    region_grouped_df = df.groupby(level=0)
-    df['currently_dead'] = region_grouped_df.deaths.cumsum()
-    df['currently_recovered'] = region_grouped_df.recovered.cumsum()
-
-    # Rename region
-    df = df.rename_axis(index=["region", "timestamp"])
+    logger.info(f"Processing {runId}")
+    with stage("regional_outputs"):
+        dfs = process_loggers.multilevel_outputs(record_f, ["region"] + [l for l in levels if l != "region"],
+                                                 cache=cache,
+                                                 max_memory=None if max_memory is None else max_memory * 1024 ** 3)
+
+    for level, df in dfs.items():
+        # Add cumulative columns, which pandas sums in 64 bits, as small as the other counts
+        region_grouped_df = df.groupby(level=0)
+        df['currently_dead'] = process_loggers.compact_counts(region_grouped_df.deaths.cumsum())
+        df['currently_recovered'] = process_loggers.compact_counts(region_grouped_df.recovered.cumsum())
+
+        # Rename region
+        dfs[level] = df = df.rename_axis(index=["region", "timestamp"])
+
+        for step in ["day"] + [s for s in steps if s != "day"]:
+            if step != "day":
+                with stage(f"resample to {step}s"):
+                    step_df = resample_summary(df, step)
+            else:
+                step_df = df
+            outfile = outdir / summary_name(record_f, fmt, level, step)
+            outfile.parent.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Saving to {str(outfile)}")
+            with stage("write summary") as s:
+                write_summary(step_df, outfile, fmt)
+                s.add_rows(len(step_df))
+    logger.info(f"Took {time() - start:.1f} seconds")
+    return dfs["region"]
 
-    outfile = outdir / f"summary_{int(runId):03}.csv"
-    print(f"Saving to {str(outfile)}")
-    df.to_csv(str(outfile))
-    print(f"\nTook {time() - start} seconds")
-    print("\n-------\n")
-    return df
+# Cell
+def profile_dir(project_name):
+    "Folder of the profiles of building `project_name`, in the data folder so they are neither compressed nor published"
+    return pf.PROFILES / project_name
+
+def profile_path(profile_dir, name):
+    "Where the profile of `name` (a record's summary or `project`) is written in `profile_dir`, without a suffix"
+    return Path(profile_dir) / Path(name).stem
+
+def _summarize_record(record_f, outdir, cache=None, fmt="csv", max_memory=None, levels=("region",), steps=("day",),
+                      profile=None):
+    """Summarize and fingerprint a record, sending back only its manifest entry instead of the whole summary.
+
+    With a folder to `profile` to, the stages of summarizing it are written to
+    `profile_path(profile, summary_name(record_f))`"""
+    if profile is not None:
+        with Profiler(record=Path(summary_name(record_f)).stem) as profiler:
+            result = _summarize_record(record_f, outdir, cache=cache, fmt=fmt, max_memory=max_memory, levels=levels,
+                                       steps=steps)
+        write_profile(profiler.stages, profile_path(profile, summary_name(record_f)))
+        return result
+
+    df = summarize_h5(record_f, outdir, cache=cache, fmt=fmt, max_memory=max_memory, levels=levels, steps=steps)
+    with stage("fingerprint"):
+        fingerprint = record_fingerprint(record_f)
+    with stage("run statistics") as s:
+        statistics = run_statistics(df)
+        s.add_rows(len(df))
+    summary = summary_name(record_f, fmt)
+    extra_summaries = [n for n in summary_names(record_f, fmt, levels, steps) if n != summary]
+    return record_f, {**fingerprint, "summary": summary, "extra_summaries": extra_summaries, "statistics": statistics}
+
+def _limit_memory(max_gb):
+    "Cap the address space of this process (and those it starts) so one oversized record cannot take down the machine"
+    import resource
+    limit = int(max_gb * 1024 ** 3)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def summarize_records(record_names, outdir, workers=1, max_worker_memory=None, cache:Optional[TableCache]=None,
+                      fmt="csv", max_memory=None, levels=("region",), steps=("day",), profile=None,
+                      progress:Optional[BuildProgress]=None):
+    """Summarize every record in `record_names` into `outdir`, using a pool of `workers` processes if `workers` > 1.
+    Returns the manifest entry of each record (see `load_manifest`).
+
+    Each worker summarizes a single record before it is replaced (`maxtasksperchild=1`), so the memory held for one
+    record is returned to the OS before the next one starts. Every run writes its own `summary_XXX.<fmt>`, so the output
+    is identical to a serial run no matter which order the runs finish in.
+
+    The static world tables are read once and shared through `cache`. Worker processes each keep their own in-memory
+    copy, so give the cache a `cache_dir` to share them across workers. `max_memory` (in GB) bounds the memory used to
+    summarize each record, and summaries are also written for the finer levels of the geography in `levels` and the
+    longer time steps in `steps` (see `summarize_h5`). With a folder to `profile` to, the stages of each record are
+    profiled (see `_summarize_record`). Every finished record is reported to `progress`."""
+    progress = BuildProgress() if progress is None else progress
+    n_records = len(record_names)
+    entries = {}
+    if workers <= 1:
+        for i, r in enumerate(record_names):
+            logger.info(f"Summarizing {r} ({i+1}/{n_records})")
+            _, entries[r] = _summarize_record(r, outdir, cache=cache, fmt=fmt, max_memory=max_memory, levels=levels,
+                                              steps=steps, profile=profile)
+            progress.report(stage="summarize records", record=Path(r).name, done=i+1, total=n_records)
+        return entries
+
+    initializer = None if max_worker_memory is None else _limit_memory
+    with Pool(workers, initializer=initializer, initargs=(max_worker_memory,), maxtasksperchild=1) as pool:
+        finished = pool.imap_unordered(partial(_summarize_record, outdir=outdir, cache=cache, fmt=fmt,
+                                               max_memory=max_memory, levels=levels, steps=steps, profile=profile),
+                                       record_names)
+        for i, (r, entry) in enumerate(finished):
+            logger.info(f"Finished {r} ({i+1}/{n_records})")
+            progress.report(stage="summarize records", record=Path(r).name, done=i+1, total=n_records)
+            entries[r] = entry
+    return {r: entries[r] for r in record_names}
 
 # Cell
 def pgrid_to_run_parameters(parameter_grid: dict) -> dict:
@@ -79,48 +216,300 @@ def pgrid_to_run_parameters(parameter_grid: dict) -> dict:
     }
 
 # Cell
+def summary_statistics(summary_f: Union[str, Path]) -> dict:
+    "`run_statistics` of a summary file written by `summarize_h5`"
+    df = read_summary(summary_f).drop(columns="Unnamed: 0", errors="ignore")
+    return run_statistics(df.set_index(["region", "timestamp"]))
+
 def collect_statistics(project: Union[str, Path]):
+    """Statistics of every summary in `project`, read one file at a time so only a single run is ever held in memory"""
     project = Path(project)
-    csvfs = list(project.glob("summary*.csv"))
-    dfs = [pd.read_csv(csvf) for csvf in csvfs]
-    big_df = pd.concat(dfs, ignore_index=True)
+    summary_fs = sorted(f for f in project.glob("summary*") if f.suffix in (".csv", ".bin"))
+    return merge_statistics(summary_statistics(f) for f in summary_fs)
 
-    all_regions = list(set(big_df.region))
-    all_fields = [f for f in big_df.columns if f != "Unnamed: 0"]
-    all_timestamps = list(set(big_df.timestamp))
-
-    string_fields = ["timestamp", "region", "Unnamed: 0"]
-    numerical_fields = [f for f in all_fields if f not in string_fields]
-    big_df_num = big_df.loc[:, numerical_fields]
-    max_vals = big_df_num.max(axis=0)
-    min_vals = big_df_num.min(axis=0)
+# Cell
+PERCENTILES = [5, 25, 50, 75, 95]
+SKETCH_PERCENTILES = np.linspace(0, 100, 21) # Every 5%, so a single run reproduces `PERCENTILES` exactly
+
+def run_statistics(df: "pd.DataFrame") -> dict:
+    """Statistics of a single summary (indexed by region and timestamp) that can be merged across runs with
+    `merge_statistics`.
+
+    Besides the extent of each field, keep its `count` and `sum` and a small sketch of its distribution (the values at
+    `SKETCH_PERCENTILES`) from which the percentiles over all runs are estimated"""
+    timestamps = df.index.unique(level="timestamp").astype(str) # Only the distinct labels, not those of every row
+    values = df.to_numpy(dtype=float)
+    sketches = np.nanpercentile(values, SKETCH_PERCENTILES, axis=0) if len(df) else np.zeros((0, df.shape[1]))
+    return {
+        "regions": sorted(set(df.index.unique(level="region"))),
+        "timestamps": sorted(set(timestamps)),
+        "fields": list(df.index.names) + list(df.columns),
+        "max": dict(zip(df.columns, df.max(axis=0).tolist())),
+        "min": dict(zip(df.columns, df.min(axis=0).tolist())),
+        "count": dict(zip(df.columns, df.count(axis=0).tolist())),
+        "sum": dict(zip(df.columns, df.sum(axis=0).tolist())),
+        "sketch": dict(zip(df.columns, sketches.T.tolist())),
+    }
 
-    df_minmax = pd.DataFrame([max_vals, min_vals], index=["max", "min"])
-    field_minmaxes = df_minmax.to_dict(orient="dict")
+def _sketch_cdf(sketch: np.ndarray, xs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Fraction of a run below (left) and at or below (right) each of the sorted `xs`, from its `sketch`.
+
+    The distribution is linear between the distinct values of the sketch, and a value repeated in the sketch is a point
+    mass spanning the percentiles it is repeated over"""
+    q = SKETCH_PERCENTILES / 100
+    values, first = np.unique(sketch, return_index=True)
+    _, last = np.unique(sketch[::-1], return_index=True)
+    lo, hi = q[first], q[len(sketch) - 1 - last]
+    left = np.interp(xs, np.repeat(values, 2), np.ravel([lo, hi], order="F"), left=0, right=1)
+    right = left.copy()
+    at = np.searchsorted(values, xs)
+    is_value = (at < len(values)) & (values[np.minimum(at, len(values) - 1)] == xs)
+    left[is_value], right[is_value] = lo[at[is_value]], hi[at[is_value]]
+    return left, right
+
+def _merge_percentiles(sketches: List[List[float]], counts: List[int]) -> List[float]:
+    """Estimate `PERCENTILES` of the union of several runs from their sketches by inverting the average of their
+    distributions, weighting each run by its `count`. For a single run this gives its exact percentiles"""
+    sketches, weights = [np.asarray(s) for s in sketches], np.asarray(counts) / np.sum(counts)
+    xs = np.unique(np.concatenate(sketches))
+    left, right = np.zeros(len(xs)), np.zeros(len(xs))
+    for sketch, weight in zip(sketches, weights):
+        l, r = _sketch_cdf(sketch, xs)
+        left += weight * l; right += weight * r
+    cdf, x = np.ravel([left, right], order="F"), np.repeat(xs, 2)
+    return [float(np.interp(p / 100, cdf, x)) for p in PERCENTILES]
+
+def merge_statistics(partials: Iterable[dict]) -> dict:
+    """Combine `run_statistics` of every run into the project statistics returned by `collect_statistics`.
+
+    `partials` can be a generator, so the statistics of a project are computed in a single pass over its runs. Partials
+    written before `count`, `sum` and `sketch` were recorded only contribute to the extent of each field"""
+    all_regions, all_timestamps, all_fields = set(), set(), set()
+    max_vals, min_vals, counts, sums, sketches = {}, {}, {}, {}, {}
+    complete = True
+    for p in partials:
+        all_regions.update(p["regions"])
+        all_timestamps.update(p["timestamps"])
+        all_fields.update(p["fields"])
+        for f, v in p["max"].items():
+            max_vals[f] = v if f not in max_vals else max(max_vals[f], v)
+        for f, v in p["min"].items():
+            min_vals[f] = v if f not in min_vals else min(min_vals[f], v)
+        if "sketch" not in p:
+            complete = False
+            continue
+        for f, n in p["count"].items():
+            if n == 0: continue
+            counts.setdefault(f, []).append(n)
+            sums[f] = sums.get(f, 0) + p["sum"][f]
+            sketches.setdefault(f, []).append(p["sketch"][f])
+
+    field_statistics = {f: {"max": max_vals[f], "min": min_vals[f]} for f in max_vals}
+    if complete:
+        for f, stats in field_statistics.items():
+            if f not in counts: continue
+            stats["sum"] = sums[f]
+            stats["mean"] = sums[f] / sum(counts[f])
+            stats.update(zip([f"p{p}" for p in PERCENTILES], _merge_percentiles(sketches[f], counts[f])))
 
     return {
         "all_regions": sorted(all_regions),
         "all_timestamps": sorted(all_timestamps),
         "all_fields": sorted(all_fields),
-        "field_statistics": field_minmaxes
+        "field_statistics": field_statistics
     }
 
 # Cell
+def file_hash(path: Union[str, Path], chunksize: int=8 * 1024 ** 2) -> str:
+    "Hash the full contents of `path` without loading it into memory"
+    h = hashlib.blake2b()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunksize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def record_fingerprint(record_f: Path) -> dict:
+    stat = record_f.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash(record_f)}
+
+def load_manifest(outdir: Path) -> Dict[str, dict]:
+    """Load `manifest.json` of a project: for each record file name, its fingerprint (`size`, `mtime`, `hash`), the name
+    of its daily `summary` per region (and of its `extra_summaries` at other levels of the geography and time steps) and
+    its `run_statistics`"""
+    manifest_f = outdir / "manifest.json"
+    if not manifest_f.exists(): return {}
+    with open(manifest_f) as fp:
+        return json.load(fp)
+
+def save_manifest(outdir: Path, manifest: Dict[str, dict]):
+    tmp_f = outdir / "manifest.json.tmp"
+    with open(tmp_f, "w") as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(tmp_f, outdir / "manifest.json")
+
+def records_to_summarize(record_names: List[Path], manifest: Dict[str, dict], outdir: Path, fmt: str="csv",
+                         levels: Sequence[str]=("region",), steps: Sequence[str]=("day",)) -> List[Path]:
+    """Records that are new, whose contents changed or whose summary at one of the `levels` of the geography and time
+    `steps` is missing (or not in format `fmt`) since `manifest` was written.
+
+    Records are only hashed if their size or modification time changed, so unchanged records cost one `stat` each."""
+    changed = []
+    for r in record_names:
+        entry = manifest.get(r.name)
+        summaries = [] if entry is None else [entry["summary"], *entry.get("extra_summaries", [])]
+        if any(n not in summaries or not (outdir / n).exists() for n in summary_names(r, fmt, levels, steps)):
+            changed.append(r)
+            continue
+        stat = r.stat()
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            continue
+        if entry["size"] == stat.st_size and entry["hash"] == file_hash(r):
+            entry["mtime"] = stat.st_mtime # Touched, but the contents are the same
+            continue
+        changed.append(r)
+    return changed
+
+def remove_stale_runs(outdir: Path, manifest: Dict[str, dict], record_names: List[Path]) -> List[str]:
+    "Delete the summaries of records that are no longer in `record_names` and drop them from `manifest`"
+    current = {r.name for r in record_names}
+    stale = [name for name in manifest if name not in current]
+    for name in stale:
+        entry = manifest.pop(name)
+        for summary in [entry["summary"], *entry.get("extra_summaries", [])]:
+            if (outdir / summary).exists(): (outdir / summary).unlink()
+    return stale
+
+# Cell
+def write_aggregates(outdir: Path, run_parameters: dict, fmt: str="csv") -> List[dict]:
+    """Precompute the aggregates across runs (see `run_store.aggregate_runs`) of every value of every parameter, which
+    is what the frontend asks for when a single parameter value is selected. They are always written as binary
+    summaries.
+
+    Returns the entries listing the runs and file of each aggregate for `metadata.json`"""
+    agg_dir = outdir / "aggregates"
+    shutil.rmtree(agg_dir, ignore_errors=True)
+    agg_dir.mkdir()
+    store = RunStore(outdir.parent)
+    parameters = list(dict.fromkeys(k for params in run_parameters.values() for k in params))
+
+    entries = []
+    for j, param in enumerate(parameters):
+        values = []
+        for params in run_parameters.values():
+            if params[param] not in values: values.append(params[param])
+        for i, value in enumerate(values):
+            run_ids = sorted(int(r) for r in filter_by_selection(run_parameters, {param: [value]}))
+            runs = [store.load(outdir / f"summary_{r:03}{summary_suffix(fmt)}") for r in run_ids]
+            agg_f = f"aggregates/aggregate_{j:02}_{i:03}.bin"
+            with open(outdir / agg_f, "wb") as fp:
+                fp.write(run_to_bytes(aggregate_runs(runs)))
+            entries.append({"parameter": param, "value": value, "runs": run_ids, "file": agg_f})
+    return entries
+
+# Cell
+def write_cubes(outdir: Path, record_names: List[Path], fmt: str="csv", levels: Sequence[str]=("region",),
+                steps: Sequence[str]=("day",)):
+    """Write the summaries of all runs at every level of the geography in `levels` and time step in `steps` to a cube
+    next to them (see `project_cube`), which `junevis.server` memory maps to serve runs from"""
+    for level in levels:
+        for step in steps:
+            summaries = {int(r.stem.split("_")[1]): outdir / summary_name(r, fmt, level, step) for r in record_names}
+            folder = outdir / Path(summary_name(record_names[0], fmt, level, step)).parent
+            header = write_cube(folder, dict(sorted(summaries.items())))
+            logger.info(f"Wrote the cube of {len(summaries)} runs to {folder}, shape {header['shape']}")
+
+def remove_cubes(outdir: Path):
+    for path in outdir.rglob(CUBE_HEADER): remove_cube(path.parent)
+
+# Cell
+# geopandas is imported by the functions that use it, as it takes longer to load than the rest of the package together
+def largest_polygons(geometry: "gpd.GeoSeries") -> "gpd.GeoSeries":
+    "The polygon of largest area of every (multi)polygon in `geometry`"
+    import geopandas as gpd
+    parts = geometry.reset_index(drop=True).explode(index_parts=False)
+    owner, area = parts.index.to_numpy(), parts.area.to_numpy()
+    # Sort the parts of each shape by decreasing area. The sort is stable, so ties keep the first part like `np.argmax`
+    order = np.lexsort((-area, owner))
+    first = order[np.r_[True, owner[order][1:] != owner[order][:-1]]]
+    return gpd.GeoSeries(parts.values[first], index=geometry.index, crs=geometry.crs)
+
 def fix_geojson(gjson_file):
+    import geopandas as gpd
     gdf = gpd.read_file(gjson_file)
 
-    for i, shape in enumerate(gdf.geometry):
-        # To reduce the shape of the multipolygon, take the shape of the largest area
-        if shape.geom_type == "MultiPolygon":
-            polygon = shape[np.argmax(np.array([p.area for p in shape]))]
-        else:
-            polygon = shape
-        gdf.geometry[i] = polygon
+    # To reduce the shape of the multipolygon, take the shape of the largest area
+    gdf = gdf.set_geometry(largest_polygons(gdf.geometry))
 
     # The frontend operates with a `SSID` field instead of a `region` field to name each area.
     gdf['SSID'] = gdf['region']
     return gdf
 
+# Cell
+def simplify_shared(geometry: "gpd.GeoSeries", tolerance: float) -> "gpd.GeoSeries":
+    """Simplify the polygons of `geometry` by `tolerance`, simplifying every border they share only once so that
+    neighbours still meet along the same line, without gaps or overlaps between them.
+
+    The borders are split into arcs where shapes meet, each arc is simplified on its own (keeping its ends) and every
+    shape is rebuilt from the faces that the simplified arcs enclose and that mostly overlap it. A shape left without
+    faces (like an island smaller than `tolerance`) is simplified on its own instead"""
+    import geopandas as gpd
+    from shapely.ops import linemerge, polygonize, unary_union
+
+    shapes = list(geometry)
+    arcs = linemerge(unary_union([shape.boundary for shape in shapes]))
+    arcs = list(getattr(arcs, "geoms", [arcs]))
+    # Arcs that now overlap or cross, like the two sides of a sliver between shapes, are noded again
+    faces = polygonize(unary_union([arc.simplify(tolerance, preserve_topology=True) for arc in arcs]))
+
+    bounds = np.array([shape.bounds for shape in shapes])
+    parts = [[] for _ in shapes]
+    for face in faces:
+        minx, miny, maxx, maxy = face.bounds
+        near = np.flatnonzero((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) &
+                              (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+        overlaps = [face.intersection(shapes[i]).area for i in near]
+        if overlaps and max(overlaps) > face.area / 2: # Else a gap between the shapes, like a hole in one of them
+            parts[near[int(np.argmax(overlaps))]].append(face)
+    simplified = [unary_union(p) if p else shape.simplify(tolerance, preserve_topology=True)
+                  for shape, p in zip(shapes, parts)]
+    return gpd.GeoSeries(simplified, index=geometry.index, crs=geometry.crs)
+
+GEO_LEVELS = [300, 1200, 4800] # Sizes of the maps (in pixels) to simplify the geography for
+
+def geo_levels(gdf: "gpd.GeoDataFrame", pixels: List[int]=GEO_LEVELS) -> Iterator[Tuple[dict, "gpd.GeoDataFrame"]]:
+    """Simplified copies of `gdf` to draw on maps of each size in `pixels`, with their description for `metadata.json`.
+
+    Shapes are simplified by half a pixel of such a map, keeping the borders they share identical (see
+    `simplify_shared`), and their coordinates rounded to a tenth of that when written with `write_geojson`"""
+    minx, miny, maxx, maxy = gdf.total_bounds
+    extent = max(maxx - minx, maxy - miny)
+    for px in pixels:
+        tolerance = extent / px / 2
+        precision = max(0, int(np.ceil(-np.log10(tolerance / 10))))
+        level = {"file": f"sites.{px}px.geojson", "pixels": px, "tolerance": tolerance, "precision": precision}
+        yield level, gdf.set_geometry(simplify_shared(gdf.geometry, tolerance))
+
+def write_geojson(gdf: "gpd.GeoDataFrame", path: Union[str, Path], precision: Optional[int]=None):
+    "Write `gdf` as GeoJSON to `path`, with coordinates rounded to `precision` decimals if given"
+    options = {} if precision is None else {"COORDINATE_PRECISION": precision}
+    if Path(path).exists(): Path(path).unlink()
+    gdf.to_file(path, driver='GeoJSON', **options)
+
+# Cell
+def staging_dir(project_name: str) -> Path:
+    "Folder to build `project_name` in before `publish_project` moves it to the projects folder"
+    return pf.STAGING / project_name
+
+def publish_project(staged: Path, outdir: Path):
+    """Move the project built in `staged` to `outdir`, replacing the project there.
+
+    Both are on the same filesystem, so each move is a rename: the project served from `outdir` is either the previous
+    or the new one, never partially written (it is only missing between the two renames)"""
+    old = outdir.with_name(f".{outdir.name}.old-{os.getpid()}")
+    if outdir.exists(): os.rename(outdir, old)
+    os.rename(staged, outdir)
+    shutil.rmtree(old, ignore_errors=True)
+
 # Cell
 from fastcore.script import *
 
@@ -130,48 +519,184 @@ def main(record_path:Param("Path to JUNE simulation records and parameter grid",
          test_only:Param("Test behavior without changing files", store_true)=False,
          project_name:Param("Name the project. If not provided, use folder name of `record_path`", str)=None,
          description:Param("Description of project", str)="NA",
+         workers:Param("Number of records to summarize in parallel", int)=1,
+         max_worker_memory:Param("Memory limit in GB for each worker process when `workers` > 1", float)=None,
+         cache_dir:Param("Directory to persist the static world tables between records and runs (requires pyarrow)",
+                         str)=None,
+         incremental:Param("Keep an existing project and only summarize new or changed records", store_true)=False,
+         summary_format:Param("Format of the run summaries: `csv`, or the smaller and faster to load `bin`", str)="csv",
+         max_memory:Param("Read each record in chunks to summarize it within about this much memory in GB", float)=None,
+         aggregates:Param("Precompute the aggregates across the runs of every single parameter value",
+                          store_true)=False,
+         compress:Param("Write gzip (and brotli, if installed) versions of the project files for `junevis.server` "
+                        "to send", store_true)=False,
+         levels:Param("Finer levels of the geography to also summarize every run at: `super_area` and/or `area`",
+                      str, nargs="+")=None,
+         time_steps:Param("Longer time steps to also summarize every run per: `week` and/or `month`",
+                          str, nargs="+")=None,
+         profile:Param("Write the time, CPU time, peak memory and rows of every stage to `profiles/<project_name>` in "
+                       "the data folder (`JUNEVIS_DATA`)", store_true)=False,
+         quiet:Param("Only log warnings and errors instead of the progress of every stage", store_true)=False,
+         cube:Param("Also write all runs to one memory mapped array for `junevis.server` to serve them from",
+                    store_true)=False,
+         staging:Param("Build the project in a staging folder and only move it to the projects folder once complete",
+                       store_true)=False,
+         progress:Param("File to append the progress of every stage and record to, as JSON lines", str)=None,
+         index_dir:Param("Also write indexed copies of the records to this folder, to summarize windows of days or "
+                         "regions of them faster", str)=None,
+         memory_limit:Param("Memory limit in GB for this process and the workers it starts, as set by the build jobs "
+                            "of `junevis.server`", float)=None,
         ):
     """Create a project that can be visualized from the record files"""
-
+    if memory_limit is not None: _limit_memory(memory_limit)
+    import junevis.process_loggers as process_loggers
+    logging.basicConfig(level=logging.WARNING if quiet else logging.INFO, format="%(message)s")
+    profiler = Profiler().start() if profile and not test_only else None
+
+    summary_suffix(summary_format) # Fail early on an unknown format
+    levels = ["region"] + [l for l in (levels or []) if l != "region"]
+    unknown_levels = [l for l in levels if l not in process_loggers.LEVELS]
+    if unknown_levels: raise ValueError(f"Unknown levels {unknown_levels}. Choose from {process_loggers.LEVELS[1:]}")
+    steps = ["day"] + [s for s in (time_steps or []) if s != "day"]
+    unknown_steps = [s for s in steps if s not in TIME_STEPS]
+    if unknown_steps: raise ValueError(f"Unknown time steps {unknown_steps}. Choose from {list(TIME_STEPS)[1:]}")
     base = Path(record_path) # Path where loggers and parameter grid are stored
+    if index_dir is not None and Path(index_dir).resolve() == base.resolve():
+        raise ValueError("Write the indexed records to another folder than the records")
     project_name = base.stem if project_name is None else project_name
-    output_dir = pf.PROJECTS / project_name
-    if not output_dir.exists() and not test_only: output_dir.mkdir(parents=True)
+    project_dir = pf.PROJECTS / project_name
+    output_dir = staging_dir(project_name) if staging and not test_only else project_dir
+    progress = BuildProgress(progress)
+    profile_to = profile_dir(project_name) if profiler is not None else None
+    if profile_to is not None: shutil.rmtree(profile_to, ignore_errors=True)
 
-    active_projects = init_available_projects(project_name)
+    catalog = None if test_only else ProjectCatalog()
+    if not test_only:
+        init_available_projects(project_name, project_dir, force_add_project=force_add_project,
+                                keep_existing=incremental, catalog=catalog, staging=output_dir != project_dir)
+    if output_dir != project_dir:
+        shutil.rmtree(output_dir, ignore_errors=True) # Left by a build that failed
+        if incremental and project_dir.exists(): shutil.copytree(project_dir, output_dir)
+    if not output_dir.exists() and not test_only: output_dir.mkdir(parents=True)
+    # Profiles were written into the project by earlier versions
+    if not test_only: shutil.rmtree(output_dir / "profile", ignore_errors=True)
 
     record_names = sorted(list(base.glob("*.h5")))
-    for r in record_names:
-        print(f"Summarizing {r}")
-        if not test_only: df = summarize_h5(r, output_dir)
-
-    print("ALL SUMMARIES COMPLETED\n-------------\n-------------\n")
+    manifest = load_manifest(output_dir) if incremental else {}
+    to_summarize = records_to_summarize(record_names, manifest, output_dir, fmt=summary_format, levels=levels,
+                                        steps=steps)
+    if incremental: logger.info(f"{len(record_names) - len(to_summarize)} of {len(record_names)} records are unchanged")
+    if test_only: logger.info(f"Found {len(to_summarize)} records to summarize with {workers} worker(s)")
+    else:
+        for name in remove_stale_runs(output_dir, manifest, record_names): logger.info(f"Removed summary of {name}")
+        cache = TableCache(cache_dir=cache_dir)
+        with progress.stage("summarize records", records=len(to_summarize)) as s:
+            entries = summarize_records(to_summarize, output_dir, workers=workers,
+                                        max_worker_memory=max_worker_memory, cache=cache, fmt=summary_format,
+                                        max_memory=max_memory, levels=levels, steps=steps, profile=profile_to,
+                                        progress=progress)
+            s.add_rows(len(to_summarize))
+        for r, entry in entries.items():
+            old = manifest.get(r.name, entry)
+            summaries = {entry["summary"], *entry["extra_summaries"]}
+            for old_summary in [old["summary"], *old.get("extra_summaries", [])]:
+                if old_summary not in summaries and (output_dir / old_summary).exists():
+                    (output_dir / old_summary).unlink() # Summary in the previous format
+            manifest[r.name] = entry
+        # Levels and time steps no longer summarized
+        dropped = [l for l in process_loggers.LEVELS[1:] if l not in levels] + [s for s in TIME_STEPS if s not in steps]
+        for folder in dropped:
+            for path in [output_dir / folder] + [output_dir / l / folder for l in levels[1:]]:
+                shutil.rmtree(path, ignore_errors=True)
+        for r in record_names:
+            manifest[r.name]["extra_summaries"] = [n for n in summary_names(r, summary_format, levels, steps)
+                                                   if n != manifest[r.name]["summary"]]
+        for entry in manifest.values():
+            if "sketch" not in entry["statistics"]: # Written before distribution statistics were recorded
+                entry["statistics"] = summary_statistics(output_dir / entry["summary"])
+        save_manifest(output_dir, manifest)
+
+        if index_dir is not None:
+            index_dir = Path(index_dir)
+            index_dir.mkdir(parents=True, exist_ok=True)
+            to_index = [r for r in record_names if r in to_summarize or not (index_dir / r.name).exists()]
+            with progress.stage("index records", records=len(to_index)) as s:
+                for r in to_index:
+                    process_loggers.index_record(r, index_dir / r.name)
+                    logger.info(f"Indexed {r} to {index_dir / r.name}")
+                s.add_rows(len(to_index))
+
+        if cube and record_names:
+            with progress.stage("cube") as s:
+                write_cubes(output_dir, record_names, fmt=summary_format, levels=levels, steps=steps)
+                s.add_rows(len(record_names) * len(levels) * len(steps))
+        else: remove_cubes(output_dir)
+
+    logger.info("All summaries completed")
 
     # Once the summary files have been created, we can accumulate the statistics into the `metadata.json` file
-    print("Creating metadata...")
+    logger.info("Creating metadata...")
     with open(base / "parameter_grid.json") as fp:
         parameter_grid = json.load(fp)
     param_info = pgrid_to_run_parameters(parameter_grid)
-    project_stats = collect_statistics(output_dir)
+    with progress.stage("project statistics") as s:
+        if test_only: project_stats = collect_statistics(output_dir)
+        else:
+            ordered = sorted(manifest.values(), key=lambda e: e["summary"])
+            project_stats = merge_statistics([e["statistics"] for e in ordered])
+        s.add_rows(len(manifest))
+
+    # Copy over the geography description, and simplified versions of it to draw smaller maps
+    logger.info("Fixing geojson...")
+    with progress.stage("geojson") as s:
+        gdf = fix_geojson(base / "sites.geojson")
+        if not test_only: write_geojson(gdf, output_dir / "sites.new.geojson")
+        geo = []
+        for geo_level, simplified in geo_levels(gdf):
+            if not test_only:
+                write_geojson(simplified, output_dir / geo_level["file"], precision=geo_level["precision"])
+            geo.append(geo_level)
+        s.add_rows(len(gdf))
 
     # Now we can save the metadata for this project, including the optional description
-    metadata = {"description": description}; [metadata.update(p) for p in [param_info, project_stats]];
+    metadata = {
+        "description": description,
+        "summary_format": summary_format,
+        "summary_levels": levels,
+        "time_steps": steps,
+        "cube": cube,
+        "geo_levels": geo,
+    }
+    metadata.update(param_info)
+    metadata.update(project_stats)
+    if aggregates and not test_only:
+        logger.info("Precomputing aggregates...")
+        with progress.stage("aggregates") as s:
+            metadata["aggregates"] = write_aggregates(output_dir, param_info["run_parameters"], fmt=summary_format)
+            s.add_rows(len(metadata["aggregates"]))
+    elif not test_only: shutil.rmtree(output_dir / "aggregates", ignore_errors=True)
     if not test_only:
         with open(output_dir / "metadata.json", 'w+') as fp:
             json.dump(metadata, fp, indent=4)
 
-    # Copy over the geography description
-    print("Fixing geojson...")
-    gdf = fix_geojson(base / "sites.geojson")
-    if not test_only: gdf.to_file(output_dir / "sites.new.geojson", driver='GeoJSON')
+    if compress and not test_only:
+        # Loads the web server, which building a project otherwise does not need
+        from junevis.static_files import precompress
+        with progress.stage("compress"):
+            logger.info(f"Compressed {precompress(output_dir)} project files")
 
-    # Add to available projects
-    print(f"Adding '{project_name}' to {pf.AVAILABLE_PROJECTS}")
-    new_available_projects = "".join(["\n" + p for p in (list(active_projects) + [project_name])]).strip()
-    print(f"New projects: {new_available_projects}")
+    if profiler is not None:
+        profiler.stop()
+        stages = [st for r in to_summarize for st in read_profile(profile_path(profile_to, summary_name(r)))]
+        write_profile(profiler.stages + stages, profile_path(profile_to, "project"))
+        logger.info(f"Wrote the profile of every stage to {profile_path(profile_to, 'project')}.csv")
 
+    # Add to available projects
+    if output_dir != project_dir:
+        with progress.stage("publish"): publish_project(output_dir, project_dir)
+        logger.info(f"Published the project to {project_dir}")
     if not test_only:
-        with open(pf.AVAILABLE_PROJECTS, 'r+') as fp:
-            fp.write(new_available_projects)
+        catalog.register(project_name, metadata)
+        logger.info(f"Added '{project_name}' to {catalog.path} and {catalog.project_list}")
 
-    print("COMPLETE")
\ No newline at end of file
+    logger.info("COMPLETE")
\ No newline at end of file
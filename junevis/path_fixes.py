@@ -13,4 +13,8 @@ DIST = CLIENT / "dist"
 DEMO = PUBLIC / "demo"
 PROJECTS = DEMO / "projects"
 DEFAULT_GEOJSON = DEMO / "coxs_bazar.geojson"
-AVAILABLE_PROJECTS = DEMO / "availableProjects.txt"
\ No newline at end of file
+AVAILABLE_PROJECTS = DEMO / "availableProjects.txt"
+STAGING = DEMO / ".staging"  # Projects being built with `junevis_create --staging`, on the same filesystem as `PROJECTS`
+DATA = Path(os.environ.get("JUNEVIS_DATA", JUNEVIS / "data"))  # Private state of the builds and server, outside the client
+CATALOG = DATA / "projects.sqlite"  # Catalog of the projects in `PROJECTS`, see `junevis.project_catalog`
+PROFILES = DATA / "profiles"  # Profiles of `junevis_create --profile`
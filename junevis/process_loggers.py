@@ -1,29 +1,42 @@
+import numpy as np
 import pandas as pd
 from pathlib import Path
-import datetime
-import time
+import copy
+import logging
+import os
+import shutil
 from junevis.record_reader import RecordReader
+from junevis.table_cache import TableCache
+from junevis.profiling import stage
 from typing import *
 
+logger = logging.getLogger(__name__)
+
+def age_bin_labels(age_bins, out_column_name):
+    """Column names for each `[lo, hi)` age bin, e.g. `infected_0_12`"""
+    intervals = pd.IntervalIndex.from_breaks(age_bins, closed="left")
+    return [
+        out_column_name
+        + "_"
+        + "_".join(i.replace("[", "").replace(")", "").split(", "))
+        for i in intervals.astype(str)
+    ]
+
 def split_by_age(df, age_bins, out_column_name, group_on=["name_region", "timestamp"]):
     df_by_age = df.groupby(
         [pd.cut(df["age"], bins=age_bins, right=False)] + group_on,
     ).size()
     df_by_age = df_by_age.unstack(level=0, fill_value=0)
     df_by_age.columns.name = None
-    df_by_age.columns = [
-        out_column_name
-        + "_"
-        + "_".join(i.replace("[", "").replace(")", "").split(", "))
-        for i in df_by_age.columns.astype(str)
-    ]
+    df_by_age.columns = age_bin_labels(age_bins, out_column_name)
     return df_by_age
 
 def get_infection_locations(infections_df):
     n_infections_by_location = (
-        infections_df.groupby(["name_region", "timestamp", "location_specs"])
+        infections_df.groupby(["name_region", "timestamp", "location_specs"], observed=True)
         .size()
         .unstack(fill_value=0)
+        .sort_index(axis=1)
     )
     n_infections_by_location.columns = [
         "n_infections_in_" + col for col in n_infections_by_location.columns
@@ -44,190 +57,875 @@ def get_regional_outputs(df, age_bins, column_name):
     )
 
 def combine_start_end(start_df, end_df):
+    """One row per person and day from each start in `start_df` until (excluding) its end in `end_df`, joined on the
+    person id. Rows without a day (no start, no end, or an end before the start) are kept once, without a timestamp.
+
+    Rows are repeated with `np.repeat` and shifted by their day offset, instead of building a list of dates per row"""
     end_df = end_df.rename('end_timestamp')
-    t0 = time.time()
     df = start_df.join(end_df, how='outer')
-    df["n_days"] = df["end_timestamp"] - df["timestamp"]
-    df["n_days"] = df["n_days"].apply(lambda x: x.days).fillna(0.0)
-
-    # TODO : this bit is extremely slow!!
-    df["range_dates"] = df.apply(
-        lambda x: [
-            x["timestamp"] + datetime.timedelta(days=day)
-            for day in range(int(x.n_days))
-        ],
-        axis=1,
-    )
-    df = df[["age", "range_dates", "name_region"]].explode(column="range_dates")
-    return df.rename(columns={"range_dates": "timestamp"})
-
-def read_table_with_people(read, table, index, people_df, geography_df):
-    df = read.table_to_df(table, index=index)
-    df = df.merge(people_df, how="inner", left_index=True, right_index=True)
-    if geography_df is not None:
-        df = df.merge(geography_df, left_on="area_id", right_index=True, how="inner")
-    if "timestamp" in df.columns:
-        df["timestamp"] = pd.to_datetime(df["timestamp"])
-    return df
-
-def read_table_with_locations(
-    read, table, index, people_df, geography_df, location_type="hospital"
-):
-    df = read_table_with_people(
-        read, table, index=index, people_df=people_df, geography_df=geography_df
-    )
-    locations_df = read.table_to_df("locations", "id")
-    locations_df = locations_df[locations_df["spec"] == location_type]
-    locations_df.set_index("group_id", inplace=True)
-    return df.merge(locations_df, left_on=f"{location_type}_ids", right_index=True)
+    n_days = (df["end_timestamp"] - df["timestamp"]).dt.days.fillna(0).to_numpy().astype(np.int64)
+    n_rows = np.maximum(n_days, 1)
+    rows = np.repeat(np.arange(len(df)), n_rows)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    timestamps = df["timestamp"].to_numpy()[rows] + offsets.astype("timedelta64[D]")
+    timestamps[(n_days <= 0)[rows]] = np.datetime64("NaT")
+    out = df[["age", "name_region"]].iloc[rows]
+    out.insert(1, "timestamp", timestamps)
+    return out
 
-def regional_outputs(logger_f: Union[Path, str], age_bins=(0, 12, 25, 65, 101),
-        min_date= '2020-05-01',
-        max_date= '2020-12-31',):
-    read = RecordReader(logger_f)
-    print("loading people...")
-    people_df = read.table_to_df("population", index="id")
-    print("loading geography...")
-    geography_df = read.get_geography_df()
-    geography_df = geography_df.drop_duplicates()
-    print("loading infections...")
-    infections_df = read_table_with_people(
-        read,
-        "infections",
-        index="infected_ids",
-        people_df=people_df,
-        geography_df=geography_df,
-    )
-    print("loading deaths...")
-    deaths_df = read_table_with_people(
-        read,
-        "deaths",
-        index="dead_person_ids",
-        people_df=people_df,
-        geography_df=geography_df,
-    )
-    print("loading hospital admissions...")
-    hosp_admissions_df = read_table_with_locations(
-        read,
-        "hospital_admissions",
-        index="patient_ids",
-        people_df=people_df,
-        geography_df=geography_df,
+def interval_counts(group_codes, age_codes, start_days, n_days, n_groups, n_ages):
+    """Count the intervals `[start_day, start_day + n_days)` active on each day, per group and age code.
+
+    Uses a difference array (+1 on the start day, -1 on the end day) and a cumulative sum over days,
+    so the cost is linear in the number of intervals and never expands to one row per person-day.
+    Returns an array of shape `(n_groups, n_total_days, n_ages)`.
+    """
+    keep = n_days > 0
+    group_codes, age_codes = group_codes[keep].astype(np.int64), age_codes[keep]
+    start_days, n_days = start_days[keep], n_days[keep]
+    n_total_days = int((start_days + n_days).max()) if len(start_days) else 0
+
+    size = n_groups * (n_total_days + 1) * n_ages
+    start_keys = (group_codes * (n_total_days + 1) + start_days) * n_ages + age_codes
+    end_keys = start_keys + n_days * n_ages
+    diff = np.bincount(start_keys, minlength=size) - np.bincount(end_keys, minlength=size)
+    counts = diff.reshape(n_groups, n_total_days + 1, n_ages).cumsum(axis=1)
+    return counts[:, :-1]
+
+def count_intervals(group_codes, age_codes, start_days, n_days, n_groups, n_ages):
+    """`interval_counts` for absolute start days (days since 1970-01-01). Returns `(counts, first_day)`"""
+    keep = n_days > 0
+    if not keep.any():
+        return np.zeros((n_groups, 0, n_ages), dtype=np.int64), 0
+    first_day = int(start_days[keep].min())
+    counts = interval_counts(
+        group_codes[keep], age_codes[keep], start_days[keep] - first_day, n_days[keep], n_groups, n_ages
     )
-    print("loading icu admissions...")
-    icu_admissions_df = read_table_with_locations(
-        read,
-        "icu_admissions",
-        index="patient_ids",
-        people_df=people_df,
-        geography_df=geography_df,
+    return counts, first_day
+
+def count_events(group_codes, days, age_codes, n_groups, n_ages):
+    """Count events per group, day and age code with a single `np.bincount` over a flattened key.
+
+    `days` are days since 1970-01-01. Returns `(counts, first_day)`, where `counts` has shape `(n_groups, n_days, n_ages)`
+    and covers every day from `first_day` to the last event.
+    """
+    if len(days) == 0:
+        return np.zeros((n_groups, 0, n_ages), dtype=np.int64), 0
+    first_day = int(days.min())
+    n_days = int(days.max()) - first_day + 1
+    keys = (group_codes.astype(np.int64) * n_days + (days - first_day)) * n_ages + age_codes
+    counts = np.bincount(keys, minlength=n_groups * n_days * n_ages)
+    return counts.reshape(n_groups, n_days, n_ages), first_day
+
+def join_intervals(start_ids, start_days, end_ids, end_days):
+    """Pair every start with every end of the same id, like an inner join on the id.
+
+    Returns `(start_idx, n_days)`: the position of the start of each pair in `start_ids` and the number of days between
+    its start and end.
+    """
+    order = np.argsort(end_ids, kind="stable")
+    sorted_end_ids = end_ids[order]
+    lo = np.searchsorted(sorted_end_ids, start_ids, side="left")
+    n_matches = np.searchsorted(sorted_end_ids, start_ids, side="right") - lo
+
+    start_idx = np.repeat(np.arange(len(start_ids)), n_matches)
+    offsets = np.arange(len(start_idx)) - np.repeat(np.cumsum(n_matches) - n_matches, n_matches)
+    end_idx = order[np.repeat(lo, n_matches) + offsets]
+    return start_idx, end_days[end_idx] - start_days[start_idx]
+
+def timestamps_to_days(timestamps) -> np.ndarray:
+    """Days since 1970-01-01 of each timestamp, parsing every distinct timestamp only once"""
+    timestamps = pd.Categorical(timestamps)
+    days = pd.to_datetime(timestamps.categories).values.astype("datetime64[D]").astype(np.int64)
+    return days[timestamps.codes]
+
+# Integer types that counts are kept in, smallest first
+COUNT_DTYPES = [np.dtype(t) for t in [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64]]
+
+def count_dtype(lo, hi) -> np.dtype:
+    """Smallest integer type that holds every count from `lo` to `hi`"""
+    return next(dt for dt in COUNT_DTYPES if np.iinfo(dt).min <= lo and hi <= np.iinfo(dt).max)
+
+def compact_counts(values):
+    """`values` (an array or Series of integers, or floats holding integers) in the smallest integer type that holds them.
+    Sums of such values are computed in 64 bits by numpy and pandas, so they cannot overflow"""
+    if len(values) == 0:
+        return values.astype(COUNT_DTYPES[0])
+    return values.astype(count_dtype(values.min(), values.max()))
+
+def region_day_index(regions, region_idx, first_day, day_idx):
+    """Index of the rows of `(region, day)` codes: the names of the regions and the dates are only held once each, in
+    the levels of the index"""
+    first, last = (int(day_idx.min()), int(day_idx.max())) if len(day_idx) else (0, -1)
+    return pd.MultiIndex(
+        levels=[pd.Index(regions), pd.to_datetime(first_day + np.arange(first, last + 1), unit="D")],
+        codes=[region_idx, day_idx - first],
+        names=["name_region", "timestamp"],
+        verify_integrity=False,
     )
-    print("loading discharges...")
-    discharges_df = read_table_with_locations(
-        read,
-        "discharges",
-        index="patient_ids",
-        people_df=people_df,
-        geography_df=geography_df,
+
+def join_frames(frames: Sequence[pd.DataFrame]) -> pd.DataFrame:
+    """`pd.concat(frames, axis=1).fillna(0.0).astype(int)` for frames indexed by unique (region, timestamp) pairs, with
+    every column in the smallest integer type that holds its values (see `compact_counts`).
+
+    Rows come in the same order: those of the first frame, then the rows of each next frame that are not in the ones
+    before it. Rows are matched by the codes of their region and day in the levels of the indexes (made common to all
+    frames) instead of by comparing the index tuples, which is what makes the concatenation slow for many regions"""
+    n_rows = [len(f) for f in frames]
+    level_codes = []
+    for i in range(frames[0].index.nlevels):
+        uniques = frames[0].index.levels[i]
+        for f in frames[1:]:
+            uniques = uniques.append(f.index.levels[i]).unique()
+        codes = np.concatenate([uniques.get_indexer(f.index.levels[i])[f.index.codes[i]] for f in frames])
+        level_codes.append((codes, uniques))
+    keys = np.zeros(sum(n_rows), dtype=np.int64)
+    for codes, uniques in level_codes:
+        keys = keys * len(uniques) + codes
+    unique_keys, first, row_of_key = np.unique(keys, return_index=True, return_inverse=True)
+    # Rows in order of their first appearance
+    order = np.argsort(first, kind="stable")
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    rows = position[row_of_key]
+
+    columns, offset = {}, 0
+    for f, n in zip(frames, n_rows):
+        for name in f.columns:
+            values = compact_counts(f[name].fillna(0.0).to_numpy())
+            columns[name] = np.zeros(len(order), dtype=values.dtype)
+            columns[name][rows[offset : offset + n]] = values
+        offset += n
+    index = pd.MultiIndex(
+        levels=[uniques for _, uniques in level_codes],
+        codes=[codes[first[order]] for codes, _ in level_codes],
+        names=frames[0].index.names,
+        verify_integrity=False,
+    ).remove_unused_levels()
+    return pd.DataFrame(columns, index=index)
+
+def counts_to_frame(counts, first_day, regions, age_bins, column_name):
+    """Turn `(region, day, age code)` counts into the frame of `get_regional_outputs`.
+
+    There is one row per region and day with at least one count, holding the daily total and one column per age bin.
+    Age code 0 holds ages outside of `age_bins`, which count towards the daily total only, as in `split_by_age`.
+    """
+    daily = counts.sum(axis=2)
+    region_idx, day_idx = np.nonzero(daily)
+    output = pd.DataFrame(
+        compact_counts(counts[region_idx, day_idx, 1:]),
+        index=region_day_index(regions, region_idx, first_day, day_idx),
+        columns=age_bin_labels(age_bins, column_name),
     )
-    print("loading recoveries...")
-    recoveries_df = read_table_with_people(
-        read,
-        "recoveries",
-        index="recovered_person_ids",
-        people_df=people_df,
-        geography_df=geography_df,
+    output.insert(0, column_name, compact_counts(daily[region_idx, day_idx]))
+    return output
+
+def age_codes_for(ages, age_bins):
+    """Age bin of each age, shifted by one so that 0 marks ages outside of `age_bins`"""
+    return pd.cut(ages, bins=age_bins, right=False).codes.astype(np.int16) + 1
+
+def get_regional_intervals(start_df, end_df, age_bins, column_name):
+    """Equivalent to `get_regional_outputs(combine_start_end(start_df, end_df), age_bins, column_name)`
+    without expanding every interval into one row per day"""
+    start_days = start_df["timestamp"].values.astype("datetime64[D]").astype(np.int64)
+    end_days = end_df.values.astype("datetime64[D]").astype(np.int64)
+    start_idx, n_days = join_intervals(
+        start_df.index.to_numpy(), start_days, end_df.index.to_numpy(), end_days
     )
-    print("loading infection locations...")
-    infection_locations = get_infection_locations(infections_df)
-    print("loading regional infections...")
-    regional_infections = get_regional_outputs(infections_df, age_bins, "infected")
-    pd.testing.assert_series_equal(
-        regional_infections["infected"],
-        infection_locations.sum(axis=1),
-        check_names=False,
+    region_codes, regions = pd.factorize(start_df["name_region"], sort=True)
+    age_codes = age_codes_for(start_df["age"].to_numpy(), age_bins)
+
+    counts, first_day = count_intervals(
+        region_codes[start_idx], age_codes[start_idx], start_days[start_idx], n_days, len(regions), len(age_bins)
     )
-    print("loading regional deaths...")
-    regional_deaths = get_regional_outputs(deaths_df, age_bins, "deaths")
-    print("loading regional hospital admissions...")
-    regional_admissions = get_regional_outputs(
-        hosp_admissions_df, age_bins, "hospital_admissions"
+    return counts_to_frame(counts, first_day, np.asarray(regions), age_bins, column_name)
+
+def lookup_table(keys, codes):
+    """Dense table from the (unique, integer) `keys` to their `codes`, for `lookup_in`. Returns `(lowest key, table)`"""
+    if len(keys) == 0:
+        return 0, np.zeros(0, dtype=np.result_type(codes, np.int8))
+    lo = keys.min()
+    table = np.full(keys.max() - lo + 1, -1, dtype=np.result_type(codes, np.int8))
+    table[keys - lo] = codes
+    return lo, table
+
+def lookup_in(lo, table, queries):
+    """Look up `queries` in a table made by `lookup_table`, giving -1 for queries that are not among its keys"""
+    out = np.full(len(queries), -1, dtype=table.dtype)
+    valid = (queries >= lo) & (queries - lo < len(table))
+    out[valid] = table[queries[valid] - lo]
+    return out
+
+def lookup_codes(keys, codes, queries):
+    """`codes[i]` for the `i` where `keys[i] == query`, or -1 where the query is not among the (unique, integer) keys"""
+    return lookup_in(*lookup_table(keys, codes), queries)
+
+# Levels of the geography of a record, from the coarsest to the finest
+LEVELS = ["region", "super_area", "area"]
+
+class PersonIndex:
+    """Region code and age bin of every person in a record, looked up by person id.
+
+    This replaces merging every event table with the whole population and geography: an event table is reduced to the
+    position of each person in the index and the day of the event (`Events`), and regions and age bins are resolved by
+    fancy indexing.
+
+    People can be grouped by a finer `level` of the geography than regions (see `LEVELS`), in which case `region` and
+    `regions` hold the codes and names of their super areas or areas. `parents` maps each coarser level to the code of
+    the group every group belongs to and the names of those groups, for `at_level`.
+    """
+
+    def __init__(self, ids, region_codes, regions, age_codes, age_bins, level="region", parents=None):
+        self.ids = ids
+        self.region = region_codes
+        self.regions = np.asarray(regions)
+        self.age_bins = age_bins
+        self.n_ages = len(age_bins)
+        self.age_code = age_codes
+        self.level = level
+        self.parents = {} if parents is None else parents
+        self._lo, self._positions = lookup_table(ids, np.arange(len(ids), dtype=np.int32))
+
+    @classmethod
+    def from_record(cls, read: RecordReader, age_bins, chunksize=None, level="region", regions=None):
+        """Index the population of a record, grouped by `level`. With `chunksize`, the population is read in chunks of
+        that many rows instead of being loaded (and cached) as a whole, so only the index itself is held in memory.
+
+        With a list of `regions`, only the people living in those regions are indexed, reading only their rows if
+        the record is indexed (see `rows_to_read`)"""
+        geography_df = read.get_geography_df().drop_duplicates()
+        rows = {}
+        if regions is not None:
+            unknown = sorted(set(regions) - set(geography_df["name_region"]))
+            if unknown:
+                raise ValueError(f"Unknown regions {unknown}")
+            geography_df = geography_df[geography_df["name_region"].isin(regions)]
+            rows = rows_to_read(read, "population", "area_id", id_ranges(geography_df.index.to_numpy()))
+        area_region, regions = pd.factorize(geography_df[f"name_{level}"], sort=True)
+        area_table = lookup_table(geography_df.index.to_numpy(), area_region.astype(np.int32))
+        # The first area of every group tells which coarser groups it belongs to
+        _, first_area = np.unique(area_region, return_index=True)
+        parents = {}
+        for parent in LEVELS[:LEVELS.index(level)]:
+            parent_codes, parent_names = pd.factorize(geography_df[f"name_{parent}"], sort=True)
+            parents[parent] = (parent_codes[first_area].astype(np.int32), np.asarray(parent_names))
+
+        if chunksize is None:
+            if not rows:
+                people_df = read.cached_table_to_df("population", index="id", fields=("age", "area_id"))
+            else:
+                people_df = read.table_to_df("population", index="id", fields=("age", "area_id"), **rows)
+            chunks = [(people_df.index.to_numpy(), people_df["age"].to_numpy(), people_df["area_id"].to_numpy())]
+        else:
+            chunks = (
+                (df["id"].to_numpy(), df["age"].to_numpy(), df["area_id"].to_numpy())
+                for df in read.iter_table("population", fields=("id", "age", "area_id"), chunksize=chunksize, **rows)
+            )
+        # Fill arrays sized for the whole population, to avoid holding every chunk and their concatenation at once
+        n_rows, _ = read.table_size("population")
+        ids, person_regions, age_codes = None, np.zeros(n_rows, dtype=np.int32), np.zeros(n_rows, dtype=np.int16)
+        n_people = 0
+        for chunk_ids, chunk_ages, area_ids in chunks:
+            person_region = lookup_in(*area_table, area_ids)
+            rows = np.flatnonzero(person_region >= 0)
+            if ids is None:
+                ids = np.zeros(n_rows, dtype=chunk_ids.dtype)
+            people = slice(n_people, n_people + len(rows))
+            ids[people], person_regions[people] = chunk_ids[rows], person_region[rows]
+            age_codes[people] = age_codes_for(chunk_ages[rows], age_bins)
+            n_people += len(rows)
+        ids = np.zeros(0, dtype=np.int64) if ids is None else ids[:n_people]
+        return cls(ids, person_regions[:n_people], regions, age_codes[:n_people], age_bins, level, parents)
+
+    def at_level(self, level) -> "PersonIndex":
+        """The same people grouped by `level`, which is this index's level or a coarser one"""
+        if level == self.level:
+            return self
+        if level not in self.parents:
+            raise ValueError(f"Cannot group people by {level} from an index of {self.level}s")
+        codes, names = self.parents[level]
+        _, first = np.unique(codes, return_index=True)
+        grouped = copy.copy(self)  # Shares the ids, ages and lookup table
+        grouped.region, grouped.regions, grouped.level = codes[self.region], names, level
+        grouped.parents = {p: (self.parents[p][0][first], self.parents[p][1]) for p in LEVELS[:LEVELS.index(level)]}
+        return grouped
+
+    @property
+    def n_regions(self):
+        return len(self.regions)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.ids, self.region, self.age_code, self._positions])
+
+    def lookup(self, person_ids):
+        """Position of each person id in the index, or -1 for people outside of the population or geography"""
+        return lookup_in(self._lo, self._positions, person_ids)
+
+    def age_counts(self):
+        """Number of people per region and age code, as an array of shape `(n_regions, n_ages)`"""
+        return np.bincount(
+            self.region.astype(np.int64) * self.n_ages + self.age_code,
+            minlength=self.n_regions * self.n_ages,
+        ).reshape(self.n_regions, self.n_ages)
+
+    def people_by_age(self, out_column_name="people"):
+        """Equivalent to `split_by_age(people_df, age_bins, out_column_name, group_on=["name_region"])`"""
+        counts = self.age_counts()
+        has_people = counts.sum(axis=1) > 0
+        return pd.DataFrame(
+            counts[has_people, 1:],
+            index=pd.Index(self.regions[has_people], name="name_region"),
+            columns=age_bin_labels(self.age_bins, out_column_name),
+        )
+
+class Events(NamedTuple):
+    """An event table reduced to the `PersonIndex` position of each person and the day of each event"""
+    person: np.ndarray
+    day: np.ndarray
+    spec: Optional[pd.Categorical] = None
+
+    def select(self, mask):
+        return Events(self.person[mask], self.day[mask], None if self.spec is None else self.spec[mask])
+
+    def append(self, other: "Events"):
+        return Events(np.concatenate([self.person, other.person]), np.concatenate([self.day, other.day]))
+
+    @staticmethod
+    def concat(chunks: Sequence["Events"]) -> "Events":
+        """Join events read in chunks. The location specs are kept only if every chunk has them"""
+        if len(chunks) == 0:
+            return Events(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        specs = [c.spec for c in chunks]
+        return Events(
+            np.concatenate([c.person for c in chunks]),
+            np.concatenate([c.day for c in chunks]),
+            None if any(s is None for s in specs) else pd.api.types.union_categoricals(specs),
+        )
+
+def iter_events(read: RecordReader, table, id_field, people: PersonIndex, spec_field=None, location_type=None, chunksize=None,
+                rows=None):
+    """`read_events` for one chunk of at most `chunksize` rows of `table` at a time, or for the whole table at once if
+    `chunksize` is None. People and days are stored as 32 bit integers.
+
+    With `rows` (see `rows_to_read`), only those rows of `table` are read"""
+    location_field = None if location_type is None else f"{location_type}_ids"
+    fields = [f for f in [id_field, "timestamp", spec_field, location_field] if f is not None]
+    categorical = [f for f in ["timestamp", spec_field] if f is not None]
+
+    if location_type is not None:
+        locations_df = read.cached_table_to_df(
+            "locations", "id", fields=("spec", "group_id"), categorical=("spec",)
+        )
+        group_ids, n_locations = np.unique(
+            locations_df.loc[locations_df["spec"] == location_type, "group_id"].to_numpy(),
+            return_counts=True,
+        )
+
+    if chunksize is None:
+        chunks = [read.table_to_df(table, index=None, fields=fields, categorical=categorical, **(rows or {}))]
+    else:
+        chunks = read.iter_table(table, fields=fields, chunksize=chunksize, categorical=categorical, **(rows or {}))
+    for df in chunks:
+        person = people.lookup(df[id_field].to_numpy())
+        rows = np.flatnonzero(person >= 0)
+        if location_type is not None:
+            # Repeat each event once per matching location, like the inner merge in `read_table_with_locations`
+            n_matches = lookup_codes(group_ids, n_locations, df[location_field].to_numpy()[rows])
+            rows = np.repeat(rows, np.maximum(n_matches, 0))
+
+        days = timestamps_to_days(df["timestamp"].array)
+        spec = None if spec_field is None else df[spec_field].array[rows]
+        yield Events(person[rows], days[rows].astype(np.int32), spec)
+
+def read_events(read: RecordReader, table, id_field, people: PersonIndex, spec_field=None, location_type=None):
+    """Read the people and days of `table`, dropping people outside of `people`.
+
+    With `location_type`, only events at a location of that type (e.g. `"hospital"`) are kept, matching
+    `read_table_with_locations`."""
+    return Events.concat(list(iter_events(read, table, id_field, people, spec_field, location_type)))
+
+def event_day_counts(people: PersonIndex, events: Events):
+    """Events per region, day and age code. Returns `(counts, first_day)`"""
+    return count_events(
+        people.region[events.person], events.day, people.age_code[events.person], people.n_regions, people.n_ages
     )
-    print("loading regional icu admissions...")
-    regional_icu_admissions = get_regional_outputs(
-        icu_admissions_df, age_bins, "icu_admissions"
+
+def interval_day_counts(people: PersonIndex, starts: Events, ends: Events):
+    """People between a start and an end event per region, day and age code. Returns `(counts, first_day)`"""
+    start_idx, n_days = join_intervals(starts.person, starts.day, ends.person, ends.day)
+    person = starts.person[start_idx]
+    return count_intervals(
+        people.region[person], people.age_code[person], starts.day[start_idx], n_days, people.n_regions, people.n_ages
     )
-    print("loading regional hospital deaths...")
-    hospital_deaths_df = deaths_df[deaths_df["location_specs"] == "hospital"]
-    print("loading all discharges info...")
-    all_discharges_df = hospital_deaths_df["timestamp"].append(
-        discharges_df["timestamp"]
+
+def regional_event_counts(people: PersonIndex, events: Events, column_name):
+    """Equivalent to `get_regional_outputs` on the merged event table"""
+    counts, first_day = event_day_counts(people, events)
+    return counts_to_frame(counts, first_day, people.regions, people.age_bins, column_name)
+
+def regional_interval_counts(people: PersonIndex, starts: Events, ends: Events, column_name):
+    """Equivalent to `get_regional_intervals` on the merged start and end tables"""
+    counts, first_day = interval_day_counts(people, starts, ends)
+    return counts_to_frame(counts, first_day, people.regions, people.age_bins, column_name)
+
+def location_counts_to_frame(counts, first_day, regions, specs):
+    """Turn `(region, day, location spec)` counts into the frame of `get_infection_locations`"""
+    specs = np.asarray(specs, dtype=object)
+    region_idx, day_idx = np.nonzero(counts.sum(axis=2))
+    columns = [i for i in np.argsort(specs) if counts[..., i].any()]
+    return pd.DataFrame(
+        compact_counts(counts[region_idx, day_idx][:, columns]),
+        index=region_day_index(regions, region_idx, first_day, day_idx),
+        columns=["n_infections_in_" + spec for spec in specs[columns]],
     )
-    print("loading hospital in/out info...")
-    hospital_in_out_df = combine_start_end(hosp_admissions_df, all_discharges_df,)
-    print("loading regional current in hospital...")
-    regional_current_in_hospital = get_regional_outputs(
-        hospital_in_out_df, age_bins, "currently_in_hospital"
+
+def infection_location_counts(people: PersonIndex, infections: Events):
+    """Equivalent to `get_infection_locations` on the merged infections table"""
+    specs = np.asarray(infections.spec.categories)
+    counts, first_day = count_events(
+        people.region[infections.person], infections.day, infections.spec.codes, people.n_regions, len(specs)
     )
-    print("loading all end (?) infection...")
-    all_end_infection_df = deaths_df["timestamp"].append(recoveries_df["timestamp"])
+    return location_counts_to_frame(counts, first_day, people.regions, specs)
 
-    print("loading in out (?) infection. Takes a while...")
-    start = time.time()
-    infected_in_out_df = combine_start_end(infections_df, all_end_infection_df)
-    print(f"\tTook {time.time() - start} seconds")
+def spec_codes(specs: List[str], spec: pd.Categorical):
+    """Position of every value of `spec` in `specs`, the location specs seen so far, adding the ones seen for the first time"""
+    specs.extend(s for s in spec.categories if s not in specs)
+    return np.array([specs.index(s) for s in spec.categories], dtype=np.int64)[spec.codes]
 
-    print("loading regional infected...")
-    regional_current_infected = get_regional_outputs(
-        infected_in_out_df, age_bins, "currently_infected"
-    )
-    print("loading regional recovered...")
-    regional_recovered = get_regional_outputs(recoveries_df, age_bins, "recovered")
-    people_df = people_df.merge(
-        geography_df, left_on="area_id", right_index=True, how="inner"
+class DayCounts:
+    """Counts per group, day and key (age code or location spec), summed over chunks of events that each cover their own
+    range of days and keys"""
+
+    def __init__(self, n_groups, n_keys):
+        self.counts = np.zeros((n_groups, 0, n_keys), dtype=np.int64)
+        self.first_day = 0
+
+    def add(self, counts, first_day):
+        if counts.shape[1] == 0:
+            return
+        n_groups, n_days, n_keys = self.counts.shape
+        start, stop = first_day, first_day + counts.shape[1]
+        if n_days > 0:
+            start, stop = min(start, self.first_day), max(stop, self.first_day + n_days)
+        if (start, stop - start) != (self.first_day, n_days) or counts.shape[2] > n_keys:
+            grown = np.zeros((n_groups, stop - start, max(n_keys, counts.shape[2])), dtype=np.int64)
+            grown[:, self.first_day - start : self.first_day - start + n_days, :n_keys] = self.counts
+            self.counts, self.first_day = grown, start
+        offset = first_day - self.first_day
+        self.counts[:, offset : offset + counts.shape[1], : counts.shape[2]] += counts
+
+    def clip(self, first_day=None, last_day=None) -> "DayCounts":
+        """Counts of the days from `first_day` to `last_day` (inclusive, days since 1970-01-01) only"""
+        n_days = self.counts.shape[1]
+        lo = 0 if first_day is None else min(max(first_day - self.first_day, 0), n_days)
+        hi = n_days if last_day is None else min(max(last_day + 1 - self.first_day, lo), n_days)
+        clipped = DayCounts(self.counts.shape[0], self.counts.shape[2])
+        clipped.counts, clipped.first_day = self.counts[:, lo:hi], self.first_day + lo
+        return clipped
+
+    def rollup(self, codes, n_groups) -> "DayCounts":
+        """Counts of the `n_groups` coarser groups that each group belongs to, given by `codes` (e.g. the region of every
+        area)"""
+        rolled = DayCounts(n_groups, self.counts.shape[2])
+        rolled.counts = np.zeros((n_groups,) + self.counts.shape[1:], dtype=self.counts.dtype)
+        rolled.first_day = self.first_day
+        if len(codes) > 0:
+            order = np.argsort(codes, kind="stable")
+            sorted_codes = codes[order]
+            bounds = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+            rolled.counts[sorted_codes[bounds]] = np.add.reduceat(self.counts[order], bounds, axis=0)
+        return rolled
+
+# Event tables, and the ones holding the start or end of an interval
+EVENT_TABLES = ["infections", "deaths", "hospital_admissions", "icu_admissions", "discharges", "recoveries"]
+INTERVAL_TABLES = ["infections", "deaths", "hospital_admissions", "discharges", "recoveries"]
+
+# Columns that `regional_day_counts` selects the rows of a table on: the day and the person of every event, and the area
+# of every person
+INDEX_COLUMNS = {
+    "population": ["area_id"],
+    "infections": ["timestamp", "infected_ids"],
+    "deaths": ["timestamp", "dead_person_ids"],
+    "hospital_admissions": ["timestamp", "patient_ids"],
+    "icu_admissions": ["timestamp", "patient_ids"],
+    "discharges": ["timestamp", "patient_ids"],
+    "recoveries": ["timestamp", "recovered_person_ids"],
+}
+# Ranges of ids beyond which selecting rows by id is left to the `PersonIndex`, as evaluating the condition would cost
+# more than the rows it saves reading
+MAX_ID_RANGES = 64
+
+def index_record(logger_f: Union[Path, str], indexed_f: Union[Path, str]) -> List[str]:
+    """Write a copy of the record `logger_f` to `indexed_f` with its `INDEX_COLUMNS` indexed (see
+    `RecordReader.create_indexes`), so that summarizing a window of days or some regions of the copy only reads the rows
+    of those. The record itself is only read, so its fingerprint is unchanged. Returns the columns indexed"""
+    indexed_f = Path(indexed_f)
+    tmp_f = indexed_f.with_name(f"{indexed_f.name}.{os.getpid()}.tmp")
+    shutil.copyfile(logger_f, tmp_f)
+    try:
+        created = RecordReader(tmp_f).create_indexes(INDEX_COLUMNS)
+    except BaseException:
+        tmp_f.unlink()
+        raise
+    os.replace(tmp_f, indexed_f)
+    return created
+
+def id_ranges(ids, max_ranges=MAX_ID_RANGES) -> Optional[List[Tuple[int, int]]]:
+    """The runs of consecutive values of the integer `ids`, as `(first, last)` pairs. None if there are more than
+    `max_ranges` of them"""
+    ids = np.unique(ids)
+    if len(ids) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(ids) != 1)
+    if len(breaks) + 1 > max_ranges:
+        return None
+    return list(zip(ids[np.r_[0, breaks + 1]].tolist(), ids[np.r_[breaks, len(ids) - 1]].tolist()))
+
+def _date_bytes(date) -> bytes:
+    return str(pd.Timestamp(date).date()).encode()
+
+def rows_to_read(read: RecordReader, table, column=None, ranges=None, since=None, until=None) -> dict:
+    """Arguments of `RecordReader.table_to_df` to read the rows of `table` whose `column` is in one of the `ranges` of
+    `id_ranges` (any value if None) and whose timestamp is from the date `since` to the date `until` (inclusive, no
+    limit if None).
+
+    Only the columns indexed by `index_record` select rows: sorted ones by the range of rows of their values, the others
+    with a `where` condition. The other rows are read too, for the caller to drop, which is faster than evaluating a
+    condition on every row. Timestamps are compared as strings, so they must start with an ISO date"""
+    if ranges is not None and len(ranges) == 0:
+        return {"start": 0, "stop": 0}
+    if ranges is None and since is None and until is None:
+        return {}
+    indexed = read.indexed_columns(table)
+    bounds, terms, condvars = [], [], {}
+    if (since is not None or until is not None) and "timestamp" in indexed:
+        lo = None if since is None else _date_bytes(since)
+        hi = None if until is None else _date_bytes(pd.Timestamp(until) + pd.Timedelta(days=1))
+        if indexed["timestamp"] == "sorted":
+            bounds.append(read.sorted_range(table, "timestamp", lo, hi))
+        else:
+            terms += [term for term, value in [("(timestamp >= since)", lo), ("(timestamp < after)", hi)] if value is not None]
+            condvars.update({name: value for name, value in [("since", lo), ("after", hi)] if value is not None})
+    if ranges is not None and indexed.get(column) == "sorted":
+        bounds.append(read.sorted_range(table, column, ranges[0][0], ranges[-1][1] + 1))
+    elif ranges is not None and indexed.get(column) == "index":
+        terms.append("(" + " | ".join(f"(({column} >= {lo}) & ({column} <= {hi}))" for lo, hi in ranges) + ")")
+
+    rows = {}
+    if bounds:
+        start = max(first for first, _ in bounds)
+        rows.update(start=start, stop=max(start, min(stop for _, stop in bounds)))
+    if terms:
+        rows.update(where=" & ".join(terms), condvars=condvars)
+    return rows
+
+# Rough memory of each person in a `PersonIndex`, per row of a chunk on top of the raw row (decoded columns and
+# lookups), and per event kept for pairing into intervals (the stored person and day, and the sort and join in
+# `join_intervals`)
+PERSON_BYTES = 14
+CHUNK_ROW_BYTES = 64
+INTERVAL_EVENT_BYTES = 64
+
+def plan_chunks(read: RecordReader, max_memory):
+    """Chunk size and number of groups of people for `regional_day_counts` to stay within about `max_memory` bytes.
+
+    The `PersonIndex` and the static tables in the cache are held in memory throughout. Of the rest, a quarter goes to
+    reading chunks and half to the events paired into intervals."""
+    sizes = {t: read.table_size(t) for t in ["population"] + EVENT_TABLES}
+    fixed = sizes["population"][0] * PERSON_BYTES + (0 if read.cache is None else read.cache.nbytes)
+    budget = max_memory - fixed
+    if budget <= 0:
+        raise ValueError(
+            f"A memory limit of {max_memory / 1024 ** 3:.2f}GB is too small for {read.record_file}: "
+            f"its people alone take {fixed / 1024 ** 3:.2f}GB"
+        )
+    row_bytes = max(nbytes for _, nbytes in sizes.values()) + CHUNK_ROW_BYTES
+    chunksize = max(1000, int(budget / 4 / row_bytes))
+    n_interval_events = sum(sizes[t][0] for t in INTERVAL_TABLES)
+    n_partitions = max(1, int(np.ceil(n_interval_events * INTERVAL_EVENT_BYTES / (budget / 2))))
+    return chunksize, n_partitions
+
+def regional_day_counts(read: RecordReader, people: PersonIndex, chunksize=None, n_partitions=1, start_date=None,
+                        end_date=None, person_ranges=None):
+    """Count every event and interval column of the summary per region, day and age code, reading the event tables in
+    chunks of at most `chunksize` rows (or whole, if None).
+
+    To summarize the days from `start_date` to `end_date` only, the events after `end_date` that start an interval and
+    those before `start_date` that end one are not needed, nor with the `person_ranges` of `id_ranges` the events of
+    other people. Their rows are not read if the record is indexed (see `rows_to_read`). The intervals overlapping those
+    days are all still paired, but events (and intervals) outside of them may be counted too: clip the counts to those
+    days (see `DayCounts.clip`).
+
+    Events are counted one chunk at a time. Intervals (e.g. from infection until recovery or death) pair the start and
+    end events of each person, so those events are kept in memory until their tables have been read, at 8 bytes each.
+    To bound that memory, people are split into `n_partitions` groups that are paired separately, reading the tables
+    once per group.
+
+    Returns a `DayCounts` for every column, one of infections per location spec, and the names of those specs."""
+    counts = {
+        c: DayCounts(people.n_regions, people.n_ages)
+        for c in ["infected", "deaths", "hospital_admissions", "icu_admissions", "recovered",
+                  "currently_in_hospital", "currently_infected"]
+    }
+    locations, specs = DayCounts(people.n_regions, 0), []
+
+    def events(table, id_field, since=None, until=None, **kwargs):
+        rows = rows_to_read(read, table, id_field, person_ranges, since, until)
+        return iter_events(read, table, id_field, people, chunksize=chunksize, rows=rows, **kwargs)
+
+    for part in range(n_partitions):
+        first_pass = part == 0
+        if n_partitions > 1:
+            logger.info(f"pairing intervals of group {part + 1}/{n_partitions} of people...")
+
+        def keep(chunk):
+            "Compact copy of the events of this group of people, to pair into intervals"
+            chunk = Events(chunk.person, chunk.day)
+            return chunk if n_partitions == 1 else chunk.select(chunk.person % n_partitions == part)
+
+        infection_starts, infection_ends, hospital_starts, hospital_ends = [], [], [], []
+        logger.info("loading infections...")
+        with stage("read infections") as s:
+            for chunk in events("infections", "infected_ids", until=end_date,
+                                spec_field="location_specs" if first_pass else None):
+                s.add_rows(len(chunk.person))
+                if first_pass:
+                    counts["infected"].add(*event_day_counts(people, chunk))
+                    locations.add(*count_events(
+                        people.region[chunk.person], chunk.day, spec_codes(specs, chunk.spec), people.n_regions, len(specs)
+                    ))
+                infection_starts.append(keep(chunk))
+        logger.info("loading deaths...")
+        with stage("read deaths") as s:
+            for chunk in events("deaths", "dead_person_ids", since=start_date, spec_field="location_specs"):
+                s.add_rows(len(chunk.person))
+                if first_pass:
+                    counts["deaths"].add(*event_day_counts(people, chunk))
+                infection_ends.append(keep(chunk))
+                hospital_ends.append(keep(chunk.select(chunk.spec == "hospital")))
+        logger.info("loading hospital admissions...")
+        with stage("read hospital_admissions") as s:
+            for chunk in events("hospital_admissions", "patient_ids", until=end_date, location_type="hospital"):
+                s.add_rows(len(chunk.person))
+                if first_pass:
+                    counts["hospital_admissions"].add(*event_day_counts(people, chunk))
+                hospital_starts.append(keep(chunk))
+        if first_pass:
+            logger.info("loading icu admissions...")
+            with stage("read icu_admissions") as s:
+                for chunk in events("icu_admissions", "patient_ids", since=start_date, until=end_date,
+                                    location_type="hospital"):
+                    s.add_rows(len(chunk.person))
+                    counts["icu_admissions"].add(*event_day_counts(people, chunk))
+        logger.info("loading discharges...")
+        with stage("read discharges") as s:
+            for chunk in events("discharges", "patient_ids", since=start_date, location_type="hospital"):
+                s.add_rows(len(chunk.person))
+                hospital_ends.append(keep(chunk))
+        logger.info("loading recoveries...")
+        with stage("read recoveries") as s:
+            for chunk in events("recoveries", "recovered_person_ids", since=start_date):
+                s.add_rows(len(chunk.person))
+                if first_pass:
+                    counts["recovered"].add(*event_day_counts(people, chunk))
+                infection_ends.append(keep(chunk))
+
+        logger.info("loading regional current in hospital...")
+        with stage("pair hospital stays") as s:
+            starts, ends = Events.concat(hospital_starts), Events.concat(hospital_ends)
+            s.add_rows(len(starts.person))
+            counts["currently_in_hospital"].add(*interval_day_counts(people, starts, ends))
+        del hospital_starts, hospital_ends, starts, ends
+        logger.info("loading regional infected...")
+        with stage("pair infections") as s:
+            starts, ends = Events.concat(infection_starts), Events.concat(infection_ends)
+            s.add_rows(len(starts.person))
+            counts["currently_infected"].add(*interval_day_counts(people, starts, ends))
+        del infection_starts, infection_ends, starts, ends
+    return counts, locations, specs
+
+def susceptible_counts(people: PersonIndex, infected: DayCounts, first_day, n_days):
+    """People not yet infected per region, day and age bin, over the `n_days` days from `first_day`.
+
+    The number is only known on the days a region has infections. Other days take the value of its next day with
+    infections or, after the last one, of the previous one. Regions without any infections in these days are NaN.
+    Returns an array of shape `(n_regions, n_days, n_ages - 1)`: age code 0 (outside of the age bins) is left out."""
+    n_infected_days = infected.counts.shape[1]
+    susceptible = np.full((people.n_regions, n_days, people.n_ages - 1), np.nan)
+    if n_infected_days == 0:
+        return susceptible
+
+    days = first_day + np.arange(n_days)
+    in_infected = (days >= infected.first_day) & (days < infected.first_day + n_infected_days)
+    infected_day = np.clip(days - infected.first_day, 0, n_infected_days - 1)
+    has_infections = np.zeros((people.n_regions, n_days), dtype=bool)
+    has_infections[:, in_infected] = infected.counts.sum(axis=2)[:, infected_day[in_infected]] > 0
+
+    # Day each value is taken from: the next day with infections, else the previous one (-1 if there is none)
+    positions = np.arange(n_days)
+    next_day = np.minimum.accumulate(np.where(has_infections, positions, n_days)[:, ::-1], axis=1)[:, ::-1]
+    previous_day = np.maximum.accumulate(np.where(has_infections, positions, -1), axis=1)
+    source = np.where(next_day < n_days, next_day, previous_day)
+
+    ever_infected = infected.counts[..., 1:].cumsum(axis=1)
+    region = np.arange(people.n_regions)[:, None]
+    known = source >= 0
+    age_counts = people.age_counts()
+    population = age_counts[:, 1:].astype(float)
+    population[age_counts.sum(axis=1) == 0] = np.nan # Regions without people
+    susceptible[known] = (population[:, None, :] - ever_infected[region, infected_day[np.maximum(source, 0)]])[known]
+    return susceptible
+
+def susceptible_to_frame(susceptible, first_day, regions, region_idx, age_bins):
+    """Frame of `susceptible_counts` for the regions `region_idx`, with a row for every region and day (ordered by day),
+    one column per age bin and their total"""
+    n_days = susceptible.shape[1]
+    values = susceptible[region_idx].transpose(1, 0, 2).reshape(-1, susceptible.shape[2])
+    output = pd.DataFrame(
+        values,
+        index=region_day_index(
+            regions, np.tile(region_idx, n_days), first_day, np.repeat(np.arange(n_days), len(region_idx))
+        ),
+        columns=age_bin_labels(age_bins, "currently_susceptible"),
     )
-    print("loading people by age...")
-    people_by_age = split_by_age(
-        people_df, age_bins, "people", group_on=["name_region"]
+    output["currently_susceptible"] = output.sum(axis=1)
+    return output
+
+def to_day(date) -> int:
+    """Days since 1970-01-01 of a date such as `"2020-05-01"`"""
+    return int(np.datetime64(pd.Timestamp(date).date(), "D").astype(np.int64))
+
+def regional_outputs(logger_f: Union[Path, str], age_bins=(0, 12, 25, 65, 101),
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        cache: Optional[TableCache] = None,
+        chunksize: Optional[int] = None,
+        max_memory: Optional[float] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        regions: Optional[Sequence[str]] = None,):
+    """Summarize the record `logger_f` per region and day.
+
+    `currently_susceptible` is given for every day from `min_date` to `max_date`, which default to the first and last
+    day of the record's events.
+
+    The population and event tables are read whole, or in chunks of `chunksize` rows. With `max_memory` (in bytes), the
+    chunk size and the number of groups that intervals are paired in are chosen to stay within about that much memory
+    (see `plan_chunks`), so records larger than the available memory can be summarized. The output is the same either way.
+
+    With `start_date` and/or `end_date`, only the days from `start_date` to `end_date` (and by default, `min_date` and
+    `max_date`) are summarized, and with `regions` only those regions. Only the rows of the tables those need are read,
+    which is fast on an indexed copy of the record (see `index_record`). The rows of those days and regions are the
+    same as in the whole summary, except for `currently_susceptible`: it only knows of the infections until `end_date`
+    and is only given for the regions with people infected in the window, as if the simulation had ended there."""
+    return multilevel_outputs(logger_f, ["region"], age_bins, min_date, max_date, cache, chunksize, max_memory,
+                              start_date, end_date, regions)["region"]
+
+def multilevel_outputs(logger_f: Union[Path, str], levels: Sequence[str] = ("region",), age_bins=(0, 12, 25, 65, 101),
+        min_date: Optional[str] = None,
+        max_date: Optional[str] = None,
+        cache: Optional[TableCache] = None,
+        chunksize: Optional[int] = None,
+        max_memory: Optional[float] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        regions: Optional[Sequence[str]] = None,) -> Dict[str, pd.DataFrame]:
+    """Summarize the record `logger_f` per day and group of each level of the geography in `levels` (see `LEVELS`), like
+    `regional_outputs` does per region (and for the same window of days and `regions`, the groups within those). The
+    groups are named in the `name_region` level of the index regardless.
+
+    The record is read once: events are counted per group of the finest level, and those counts are summed into the
+    groups of the coarser levels. The counts take `n_groups * n_days * n_ages` integers per column though, which adds up
+    for the areas of a large world."""
+    unknown = [l for l in levels if l not in LEVELS]
+    if unknown:
+        raise ValueError(f"Unknown levels {unknown}. Choose from {LEVELS}")
+    finest = max(levels, key=LEVELS.index)
+    min_date = start_date if min_date is None else min_date
+    max_date = end_date if max_date is None else max_date
+
+    # Without a shared cache, still avoid re-reading the static tables within this record
+    read = RecordReader(logger_f, cache=TableCache() if cache is None else cache)
+    n_partitions = 1
+    if max_memory is not None:
+        with stage("plan chunks"):
+            planned_chunksize, n_partitions = plan_chunks(read, max_memory)
+        chunksize = planned_chunksize if chunksize is None else chunksize
+        logger.info(f"reading tables in chunks of {chunksize} rows, pairing intervals in {n_partitions} group(s) of people")
+    logger.info("loading people...")
+    with stage("read people") as s:
+        people = PersonIndex.from_record(read, age_bins, chunksize=chunksize, level=finest, regions=regions)
+        s.add_rows(len(people.region))
+
+    person_ranges = None if regions is None else id_ranges(people.ids)
+    counts, locations, specs = regional_day_counts(read, people, chunksize=chunksize, n_partitions=n_partitions,
+                                                   start_date=start_date, end_date=end_date, person_ranges=person_ranges)
+
+    outputs = {}
+    for level in levels:
+        grouped = people.at_level(level)
+        if level != finest:
+            logger.info(f"summing up {finest}s into {level}s...")
+            with stage(f"rollup to {level}"):
+                codes = people.parents[level][0]
+                level_counts = {c: counts[c].rollup(codes, grouped.n_regions) for c in counts}
+                level_locations = locations.rollup(codes, grouped.n_regions)
+        else:
+            level_counts, level_locations = counts, locations
+        outputs[level] = summary_frame(grouped, level_counts, level_locations, specs, min_date, max_date, start_date,
+                                       end_date)
+    return outputs
+
+def summary_frame(people: PersonIndex, counts: Dict[str, DayCounts], locations: DayCounts, specs: List[str],
+                  min_date: Optional[str] = None, max_date: Optional[str] = None, start_date: Optional[str] = None,
+                  end_date: Optional[str] = None) -> pd.DataFrame:
+    """The summary of `regional_outputs` from the counts of `regional_day_counts`, per group of `people`. Counts before
+    `start_date` or after `end_date` are left out"""
+    age_bins = people.age_bins
+    window = [None if date is None else to_day(date) for date in [start_date, end_date]]
+    clipped = {column: c.clip(*window) for column, c in counts.items()}
+    to_frame = lambda column: counts_to_frame(
+        clipped[column].counts, clipped[column].first_day, people.regions, age_bins, column
     )
-    regional_current_susceptible = pd.DataFrame()
-    idx = pd.date_range(start=min_date, end=max_date)
-    multi_idx = pd.MultiIndex.from_product([list(regional_current_infected.index.levels[0]), 
-        list(idx)],
-        names=list(regional_current_infected.index.names))
-
-    for column in people_by_age.columns:
-        age_suffix = "_".join(column.split("_")[1:])
-        infected_ever = regional_infections.groupby(level=0)[
-            "infected_" + age_suffix
-        ].cumsum()
-
-        column_name = "currently_susceptible_" + age_suffix
-        regional_current_susceptible[column_name] = people_by_age[column].sub(infected_ever)
-        regional_current_susceptible = regional_current_susceptible.reindex(multi_idx)
-        regional_current_susceptible = regional_current_susceptible.unstack(
-             level=0
-            ).bfill().ffill().stack()
-        regional_current_susceptible = regional_current_susceptible.reorder_levels([1,0])
-
-    regional_current_susceptible[
-        "currently_susceptible"
-    ] = regional_current_susceptible.sum(axis=1)
-
-    print("Concatenating information...")
-    output = pd.concat(
-        [
-            infection_locations,
-            regional_infections,
-            regional_deaths,
-            regional_admissions,
-            regional_icu_admissions,
-            regional_current_in_hospital,
-            regional_current_infected,
-            regional_recovered,
-            regional_current_susceptible,
-        ],
-        axis=1,
-    ).fillna(0.0).astype(int)
-
-    return output
\ No newline at end of file
+    with stage("count frames"):
+        locations = locations.clip(*window)
+        infection_locations = location_counts_to_frame(locations.counts, locations.first_day, people.regions, specs)
+        regional_infections = to_frame("infected")
+        regional_deaths = to_frame("deaths")
+        regional_admissions = to_frame("hospital_admissions")
+        regional_icu_admissions = to_frame("icu_admissions")
+        regional_current_in_hospital = to_frame("currently_in_hospital")
+        regional_current_infected = to_frame("currently_infected")
+        regional_recovered = to_frame("recovered")
+
+    logger.info("loading susceptible...")
+    spans = [(c.first_day, c.first_day + c.counts.shape[1]) for c in counts.values() if c.counts.shape[1] > 0]
+    first_day = to_day(min_date) if min_date is not None else min([start for start, _ in spans], default=0)
+    last_day = to_day(max_date) if max_date is not None else max([stop for _, stop in spans], default=first_day) - 1
+    n_days = max(0, last_day - first_day + 1)
+    with stage("susceptible") as s:
+        susceptible = susceptible_counts(people, counts["infected"], first_day, n_days)
+        # Only regions that ever have infected people
+        region_idx = np.flatnonzero(counts["currently_infected"].counts.sum(axis=(1, 2)) > 0)
+        regional_current_susceptible = susceptible_to_frame(susceptible, first_day, people.regions, region_idx, age_bins)
+        s.add_rows(len(regional_current_susceptible))
+
+    logger.info("Concatenating information...")
+    with stage("concat") as s:
+        output = join_frames(
+            [
+                infection_locations,
+                regional_infections,
+                regional_deaths,
+                regional_admissions,
+                regional_icu_admissions,
+                regional_current_in_hospital,
+                regional_current_infected,
+                regional_recovered,
+                regional_current_susceptible,
+            ]
+        )
+        s.add_rows(len(output))
+
+    return output
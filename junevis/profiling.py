@@ -0,0 +1,176 @@
+"""Per-stage profiles of building a project with `junevis_create --profile`.
+
+The pipeline marks its stages with `stage`, which only measures anything while a `Profiler` is active in the process:
+
+    with Profiler(record="summary_001") as profiler:
+        with stage("read infections") as s:
+            for chunk in chunks:
+                s.add_rows(len(chunk))
+    write_profile(profiler.stages, profile_dir / "summary_001")  # summary_001.json and summary_001.csv
+
+Every stage records its wall and CPU time, the peak memory allocated while it ran and the number of rows it handled.
+Memory is traced with `tracemalloc`, which sees the arrays of numpy and pandas as well as Python objects but slows down
+code that allocates many small objects, so only profile when asked to."""
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import *
+import csv
+import json
+import logging
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+STAGE_FIELDS = ["record", "stage", "depth", "seconds", "cpu_seconds", "peak_mb", "max_rss_mb", "rows"]
+
+
+def _max_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024  # Bytes on macOS, KB on Linux
+
+
+class Stage:
+    """A stage being profiled. Code in the stage reports the rows it handles with `add_rows`"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = None
+        self.peak = 0
+
+    def add_rows(self, n: int):
+        self.rows = int(n) if self.rows is None else self.rows + int(n)
+
+
+_active = None  # The Profiler collecting the stages of this process
+
+
+class Profiler:
+    """Collects the stages run while it is active (as a context manager, or between `start` and `stop`) into `stages`,
+    one dict per stage with the fields of `STAGE_FIELDS`, in the order the stages started. Nested stages have a larger
+    `depth` than their parent."""
+
+    def __init__(self, record: Optional[str] = None, trace_memory: bool = True):
+        self.record = record
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._open = []
+        self._peak = 0
+        self._started_tracing = False
+        self._previous = None
+
+    def start(self) -> "Profiler":
+        """Collect the stages of this process until `stop`. A profiler started inside the stage of another one passes the
+        peak memory it sees on to that stage"""
+        global _active
+        self._previous, _active = _active, self
+        if self._previous is not None:
+            self._previous._update_peaks()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def stop(self):
+        global _active
+        self._update_peaks()
+        if self._previous is not None:
+            for s in self._previous._open:
+                s.peak = max(s.peak, self._peak)
+        _active, self._previous = self._previous, None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self) -> "Profiler":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _update_peaks(self):
+        """Fold the peak traced since the last update into every open stage. tracemalloc keeps a single peak, so it is
+        reset to measure nested stages separately (on Python < 3.9, which cannot reset it, peaks only grow)"""
+        if not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        self._peak = max(self._peak, peak)
+        for s in self._open:
+            s.peak = max(s.peak, peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        self._update_peaks()
+        current = Stage(name)
+        row = {"record": self.record, "stage": name, "depth": len(self._open)}
+        self.stages.append(row)
+        self._open.append(current)
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield current
+        finally:
+            seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - cpu_start
+            max_rss = _max_rss_mb()
+            self._update_peaks()
+            self._open.pop()
+            row.update({
+                "seconds": round(seconds, 4),
+                "cpu_seconds": round(cpu_seconds, 4),
+                "peak_mb": round(current.peak / 1024 ** 2, 2) if tracemalloc.is_tracing() else None,
+                "max_rss_mb": None if max_rss is None else round(max_rss, 1),
+                "rows": current.rows,
+            })
+            logger.debug(f"{name}: {seconds:.3f}s")
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Stage]:
+    """Profile the code in this context as stage `name` of the active `Profiler`, if there is one"""
+    if _active is None:
+        yield Stage(name)
+    else:
+        with _active.stage(name) as s:
+            yield s
+
+
+def summarize_stages(stages: List[dict]) -> List[dict]:
+    """Totals of every stage name across records and repetitions (e.g. a table read in several groups of people): the
+    number of times it ran, the sums of its times and rows and its largest peak memory. Slowest first"""
+    totals = {}
+    for s in stages:
+        t = totals.setdefault(s["stage"], {"stage": s["stage"], "count": 0, "seconds": 0.0, "cpu_seconds": 0.0,
+                                           "peak_mb": None, "rows": None})
+        t["count"] += 1
+        t["seconds"] = round(t["seconds"] + s["seconds"], 4)
+        t["cpu_seconds"] = round(t["cpu_seconds"] + s["cpu_seconds"], 4)
+        if s["peak_mb"] is not None:
+            t["peak_mb"] = max(t["peak_mb"] or 0, s["peak_mb"])
+        if s["rows"] is not None:
+            t["rows"] = (t["rows"] or 0) + s["rows"]
+    return sorted(totals.values(), key=lambda t: -t["seconds"])
+
+
+def write_profile(stages: List[dict], path: Union[Path, str]):
+    """Write `stages` to `path` with suffix `.json` (along with their `summarize_stages` totals) and `.csv`"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".json"), "w") as fp:
+        json.dump({"stages": stages, "totals": summarize_stages(stages)}, fp, indent=2)
+    with open(path.with_suffix(".csv"), "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=STAGE_FIELDS)
+        writer.writeheader()
+        writer.writerows(stages)
+
+
+def read_profile(path: Union[Path, str]) -> List[dict]:
+    """The stages written to `path` (without suffix) by `write_profile`"""
+    with open(Path(path).with_suffix(".json")) as fp:
+        return json.load(fp)["stages"]
@@ -0,0 +1,243 @@
+"""The catalog of the projects that `junevis_create` built, in SQLite, for any number of builds to register projects at
+once and for `junevis.server` to list them and look them up without reading every `metadata.json`.
+
+The database runs in WAL mode, so readers never wait for a build that registers a project. Builds take the write lock
+for each registration, which also rewrites `availableProjects.txt` (the list of project names the frontend reads)
+atomically, so concurrent builds can neither lose nor garble each other's entries. A catalog that is missing or empty is
+filled from that list, as written before the catalog existed.
+
+The server opens the catalog `read_only` unless it builds projects itself, so that it never writes next to the projects.
+Without a catalog to read, it lists the projects of `availableProjects.txt` from a catalog in memory instead."""
+
+from pathlib import Path
+from typing import *
+from contextlib import contextmanager
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import junevis.path_fixes as pf
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,       -- 'building' until first registered, then 'ready'
+    builder TEXT,               -- 'host:pid' of the build holding the project, if any
+    description TEXT,
+    n_runs INTEGER,
+    parameters TEXT,            -- JSON: the values of every parameter varied across the runs
+    field_statistics TEXT,      -- JSON: the `field_statistics` of the metadata
+    summary_format TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS projects_by_status ON projects (status, created);
+"""
+
+# Columns of the listing, leaving out the field statistics which are large for projects with many fields
+LIST_COLUMNS = ["name", "status", "description", "n_runs", "parameters", "summary_format", "created", "updated"]
+
+
+def builder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_running(builder: Optional[str]) -> bool:
+    """Whether the build `builder` is still running. Builds on other hosts are assumed to be"""
+    if builder is None:
+        return False
+    host, _, pid = builder.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+def parameter_axes(run_parameters: Dict[str, dict]) -> Dict[str, list]:
+    """The values every parameter takes across the runs of `run_parameters`, in order of appearance"""
+    axes = {}
+    for params in run_parameters.values():
+        for k, v in params.items():
+            values = axes.setdefault(k, [])
+            if v not in values:
+                values.append(v)
+    return axes
+
+
+def _row_to_entry(row: sqlite3.Row) -> dict:
+    entry = dict(row)
+    for key in ["parameters", "field_statistics"]:
+        if entry.get(key) is not None:
+            entry[key] = json.loads(entry[key])
+    return entry
+
+
+class ProjectCatalog:
+    """The catalog in the SQLite database `path` of the projects in `projects_dir`, whose names are also listed in
+    `project_list` for the frontend. Every thread has its own connection.
+
+    A `read_only` catalog is opened without creating or writing any file, and cannot register or remove projects"""
+
+    def __init__(self, path: Union[Path, str, None] = None, projects_dir: Union[Path, str, None] = None,
+                 project_list: Union[Path, str, None] = None, timeout: float = 30.0, read_only: bool = False):
+        self.path = Path(pf.CATALOG if path is None else path)
+        self.projects_dir = Path(pf.PROJECTS if projects_dir is None else projects_dir)
+        self.project_list = Path(pf.AVAILABLE_PROJECTS if project_list is None else project_list)
+        self.timeout = timeout
+        self.read_only = read_only
+        self._local = threading.local()
+        self._uri = self.path.resolve().as_uri() + "?mode=ro" if read_only else None
+        self._memory = None
+        if read_only and not self.path.exists():
+            # The catalog lives as long as a connection to it is open
+            self._uri = f"file:junevis-catalog-{id(self)}?mode=memory&cache=shared"
+            self._memory = sqlite3.connect(self._uri, uri=True, isolation_level=None, check_same_thread=False)
+            self._memory.executescript(SCHEMA)
+            self._import_project_list(self._memory)
+        elif read_only:
+            try:
+                self._db.execute("SELECT COUNT(*) FROM projects")
+            except sqlite3.OperationalError:
+                # Readers of a WAL database share memory through a file next to it, which cannot be created on a
+                # read-only filesystem: read the catalog as it is instead
+                self._uri = self.path.resolve().as_uri() + "?immutable=1"
+                self._local.db = None
+        else:
+            self._db.executescript(SCHEMA)
+            with self._transaction() as db:
+                if db.execute("SELECT COUNT(*) FROM projects").fetchone()[0] == 0:
+                    self._import_project_list(db)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if self.read_only:
+                db = sqlite3.connect(self._uri, timeout=self.timeout, isolation_level=None, uri=True)
+                db.execute("PRAGMA query_only=ON")
+            else:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                db = sqlite3.connect(str(self.path), timeout=self.timeout, isolation_level=None)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """A write transaction, which holds the lock of the database from the start"""
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _import_project_list(self, db: sqlite3.Connection):
+        """Register the projects of `project_list` that have a `metadata.json`"""
+        if not self.project_list.exists():
+            return
+        for name in dict.fromkeys(p.strip() for p in self.project_list.read_text().splitlines() if p.strip()):
+            metadata_f = self.projects_dir / name / "metadata.json"
+            if metadata_f.exists():
+                with open(metadata_f) as fp:
+                    self._upsert(db, name, json.load(fp))
+
+    def _upsert(self, db: sqlite3.Connection, name: str, metadata: dict):
+        now = time.time()
+        db.execute(
+            """INSERT INTO projects (name, status, builder, description, n_runs, parameters, field_statistics,
+                                     summary_format, created, updated)
+               VALUES (?, 'ready', NULL, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (name) DO UPDATE SET
+                   status = 'ready', builder = NULL, description = excluded.description, n_runs = excluded.n_runs,
+                   parameters = excluded.parameters, field_statistics = excluded.field_statistics,
+                   summary_format = excluded.summary_format, updated = excluded.updated""",
+            (
+                name,
+                metadata.get("description"),
+                len(metadata.get("run_parameters", {})),
+                json.dumps(parameter_axes(metadata.get("run_parameters", {}))),
+                json.dumps(metadata.get("field_statistics", {})),
+                metadata.get("summary_format", "csv"),
+                now,
+                now,
+            ),
+        )
+
+    def _write_project_list(self, db: sqlite3.Connection):
+        """Rewrite `project_list` from the catalog, replacing it at once so that readers never see a partial list"""
+        names = [row[0] for row in db.execute("SELECT name FROM projects WHERE status = 'ready' ORDER BY created, name")]
+        tmp = self.project_list.with_name(f"{self.project_list.name}.{os.getpid()}.tmp")
+        tmp.write_text("\n".join(names))
+        os.replace(tmp, self.project_list)
+
+    def reserve(self, name: str, replace: bool = False, keep_existing: bool = False, withdraw: bool = False) -> Optional[dict]:
+        """Hold `name` for a build of this process, so that no other build takes it meanwhile.
+
+        An existing project of that name can only be reserved to `replace` it, or to update it in place with
+        `keep_existing`. Raises ValueError otherwise, or if another build that is still running holds it. With
+        `withdraw`, for builds that delete the existing project before building it anew, the project is marked as being
+        built again and taken off `project_list` until it is registered. Returns the entry of the existing project, if
+        any"""
+        with self._transaction() as db:
+            row = db.execute("SELECT * FROM projects WHERE name = ?", (name,)).fetchone()
+            existing = None if row is None else _row_to_entry(row)
+            if existing is not None:
+                if existing["builder"] not in (None, builder_id()) and _is_running(existing["builder"]):
+                    raise ValueError(f"Project '{name}' is being built by {existing['builder']}")
+                if existing["status"] == "ready" and not (replace or keep_existing):
+                    raise ValueError(f"Cannot create project of name '{name}': Project already exists in {self.path}")
+            now = time.time()
+            db.execute(
+                """INSERT INTO projects (name, status, builder, created, updated) VALUES (?, 'building', ?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE SET builder = excluded.builder, updated = excluded.updated""",
+                (name, builder_id(), now, now),
+            )
+            if existing is not None and withdraw:
+                db.execute("UPDATE projects SET status = 'building' WHERE name = ?", (name,))
+                self._write_project_list(db)
+        return existing
+
+    def register(self, name: str, metadata: dict):
+        """Add or replace the project `name` with its `metadata` and list it in `project_list`"""
+        with self._transaction() as db:
+            self._upsert(db, name, metadata)
+            self._write_project_list(db)
+
+    def remove(self, name: str):
+        with self._transaction() as db:
+            db.execute("DELETE FROM projects WHERE name = ?", (name,))
+            self._write_project_list(db)
+
+    def get(self, name: str) -> Optional[dict]:
+        """The entry of project `name`, or None if there is no such project"""
+        row = self._db.execute("SELECT * FROM projects WHERE name = ?", (name,)).fetchone()
+        return None if row is None else _row_to_entry(row)
+
+    def projects(self, prefix: Optional[str] = None, limit: Optional[int] = None, offset: int = 0,
+                 include_building: bool = False) -> List[dict]:
+        """The projects whose names start with `prefix`, in the order they were first registered, without their field
+        statistics. Projects being built for the first time are left out, unless `include_building`"""
+        query = f"SELECT {', '.join(LIST_COLUMNS)} FROM projects WHERE (? OR status = 'ready')"
+        args = [include_building]
+        if prefix:
+            query += " AND name >= ? AND name < ?"
+            args += [prefix, prefix + "\U0010ffff"]
+        query += " ORDER BY created, name LIMIT ? OFFSET ?"
+        args += [-1 if limit is None else limit, offset]
+        return [_row_to_entry(row) for row in self._db.execute(query, args)]
+
+    def names(self) -> List[str]:
+        return [p["name"] for p in self.projects()]
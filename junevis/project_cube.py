@@ -0,0 +1,181 @@
+"""All runs of a project in one dense array, for `junevis.server` to serve slices of runs from without reading their
+summaries.
+
+`junevis_create --cube` writes the summaries of a folder of the project (per region and day, and those of every other level
+and time step) to a `cube.<version>.dat` next to them, with the name of that file and the labels of its axes in `cube.json`:
+
+    {"data": "cube.<version>.dat", "runs": [0, 1, ...], "regions": [...], "timestamps": [...], "index_names": [...],
+     "fields": [{"name", "integer"}, ...], "dtype": "<i4", "shape": [n_runs, n_regions, n_days, n_fields],
+     "mask_offset": int or null}
+
+The data file holds the values of every run, region, day and field as a C ordered array of `dtype` (the smallest that holds
+all of them), followed at `mask_offset` bytes by a `runs x regions x days` uint8 mask of the rows present in each run, if
+some runs miss some rows. Runs are aligned on the union of their regions (in order of appearance) and days.
+
+`ProjectCube` opens it with `np.memmap`: the arrays of a run are views into the file that the OS pages in on demand and
+shares between all the processes serving the project. A cube is replaced by writing its data to a file of a new version,
+then renaming the new `cube.json` over the old one, so a process that opens the cube always reads a header and data that
+belong together. Processes that still map the old data keep reading it until they open the new cube."""
+
+from pathlib import Path
+from typing import *
+import json
+import os
+import uuid
+import numpy as np
+
+from junevis.summary_format import smallest_dtype, read_summary_arrays, ALIGN
+
+CUBE_HEADER = "cube.json"
+CUBE_DATA_PATTERN = "cube.*.dat"
+
+
+def _aligned(n: int) -> int:
+    return -(-n // ALIGN) * ALIGN
+
+
+def cube_nbytes(header: dict) -> int:
+    """Size of the data file of the cube with `header`"""
+    shape = header["shape"]
+    if header["mask_offset"] is not None:
+        return header["mask_offset"] + int(np.prod(shape[:3]))
+    return int(np.prod(shape)) * np.dtype(header["dtype"]).itemsize
+
+
+def cube_header(summaries: Dict[int, Union[Path, str]]) -> dict:
+    """Header of the cube of the summaries of every run id in `summaries`, reading each of them once to find the labels of
+    the axes and the range of the values"""
+    regions, timestamps, fields, integer = {}, set(), None, {}
+    lo, hi = 0, 0
+    for path in summaries.values():
+        header, arrays, mask = read_summary_arrays(path)
+        regions.update(dict.fromkeys(header["regions"]))
+        timestamps.update(header["timestamps"])
+        names = [f["name"] for f in header["fields"]]
+        fields = names if fields is None else [f for f in fields if f in names]
+        for f in header["fields"]:
+            integer[f["name"]] = integer.get(f["name"], True) and f["integer"]
+            values = arrays[f["name"]] if mask is None else arrays[f["name"]][mask]
+            if f["integer"] and values.size:
+                lo, hi = min(lo, int(values.min())), max(hi, int(values.max()))
+        index_names = header["index_names"]
+
+    fields = fields or []
+    shape = [len(summaries), len(regions), len(timestamps), len(fields)]
+    all_integer = all(integer[name] for name in fields)
+    dtype = smallest_dtype(np.array([lo, hi], dtype=np.int64)) if all_integer else np.dtype("<f8")
+    return {
+        "runs": [int(r) for r in summaries],
+        "regions": list(regions),
+        "timestamps": sorted(timestamps),
+        "index_names": index_names,
+        "fields": [{"name": name, "integer": integer[name]} for name in fields],
+        "data": f"cube.{uuid.uuid4().hex[:12]}.dat",
+        "dtype": dtype.str,
+        "shape": shape,
+        "mask_offset": None,
+    }
+
+
+def write_cube(folder: Union[Path, str], summaries: Dict[int, Union[Path, str]]) -> dict:
+    """Write the cube of the summaries of every run id in `summaries` to `folder` (see the module). Returns its header"""
+    folder = Path(folder)
+    header = cube_header(summaries)
+    shape, dtype = tuple(header["shape"]), np.dtype(header["dtype"])
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    region_pos = {r: i for i, r in enumerate(header["regions"])}
+    day_pos = {t: i for i, t in enumerate(header["timestamps"])}
+
+    data_path = folder / header["data"]  # Not read until `cube.json` names it
+    buffer = np.memmap(data_path, dtype=np.uint8, mode="w+", shape=(_aligned(n_bytes) + int(np.prod(shape[:3])),))
+    data = buffer[:n_bytes].view(dtype).reshape(shape)
+    mask = buffer[_aligned(n_bytes):].reshape(shape[:3])
+    for i, path in enumerate(summaries.values()):
+        run_header, arrays, run_mask = read_summary_arrays(path)
+        rows = np.ix_(
+            np.array([region_pos[r] for r in run_header["regions"]], dtype=np.int64),
+            np.array([day_pos[t] for t in run_header["timestamps"]], dtype=np.int64),
+        )
+        for k, field in enumerate(header["fields"]):
+            data[i][rows + (k,)] = arrays[field["name"]]
+        mask[i][rows] = 1 if run_mask is None else run_mask
+
+    if mask.all():
+        n_total = n_bytes
+    else:
+        header["mask_offset"] = _aligned(n_bytes)
+        n_total = len(buffer)
+    buffer.flush()
+    del data, mask, buffer
+    with open(data_path, "r+b") as fp:
+        fp.truncate(n_total)
+
+    # The data is complete before the header that names it replaces the previous one
+    tmp_header = folder / (CUBE_HEADER + ".tmp")
+    with open(tmp_header, "w") as fp:
+        json.dump(header, fp)
+    os.replace(tmp_header, folder / CUBE_HEADER)
+    _remove_data(folder, keep=header["data"])
+    return header
+
+
+def _remove_data(folder: Path, keep: Optional[str] = None):
+    """Remove the data files of previous versions of the cube in `folder`, and of writes that did not finish"""
+    for path in folder.glob(CUBE_DATA_PATTERN):
+        if path.name != keep:
+            path.unlink()
+
+
+def remove_cube(folder: Union[Path, str]):
+    folder = Path(folder)
+    if (folder / CUBE_HEADER).exists():
+        (folder / CUBE_HEADER).unlink()
+    _remove_data(folder)
+
+
+def has_cube(folder: Union[Path, str]) -> bool:
+    return (Path(folder) / CUBE_HEADER).exists()
+
+
+class ProjectCube:
+    """The cube in `folder`, memory mapped. Raises FileNotFoundError if its data was replaced while opening it, and
+    ValueError if the data file does not have the size its header expects"""
+
+    def __init__(self, folder: Union[Path, str]):
+        folder = Path(folder)
+        with open(folder / CUBE_HEADER) as fp:
+            self.header = json.load(fp)
+        self.data_path = folder / self.header["data"]
+        shape = tuple(self.header["shape"])
+        with open(self.data_path, "rb") as fp:  # Holds on to the data should a new cube replace it meanwhile
+            size = os.fstat(fp.fileno()).st_size
+            if size != cube_nbytes(self.header):
+                raise ValueError(f"{self.data_path} has {size} bytes instead of the {cube_nbytes(self.header)} of its header")
+            self.data = np.memmap(fp, dtype=self.header["dtype"], mode="r", shape=shape)
+            self.mask = None
+            if self.header["mask_offset"] is not None:
+                self.mask = np.memmap(fp, dtype=np.uint8, mode="r", offset=self.header["mask_offset"],
+                                      shape=shape[:3]).view(bool)
+        self._run_index = {r: i for i, r in enumerate(self.header["runs"])}
+        self._run_header = {
+            "regions": self.header["regions"],
+            "timestamps": self.header["timestamps"],
+            "index_names": self.header["index_names"],
+            "fields": [{**f, "dtype": self.header["dtype"]} for f in self.header["fields"]],
+        }
+
+    @property
+    def run_ids(self) -> List[int]:
+        return self.header["runs"]
+
+    def __contains__(self, run_id: int) -> bool:
+        return int(run_id) in self._run_index
+
+    def read_run(self, run_id: int) -> Tuple[dict, Dict[str, np.ndarray], Optional[np.ndarray]]:
+        """The header, `(n_regions, n_days)` array per field and row mask (or None) of run `run_id`, like
+        `summary_format.read_summary_arrays`. The arrays are views of the file"""
+        i = self._run_index[int(run_id)]
+        run = self.data[i]
+        arrays = {f["name"]: run[:, :, k] for k, f in enumerate(self.header["fields"])}
+        mask = None if self.mask is None else self.mask[i]
+        return self._run_header, arrays, mask
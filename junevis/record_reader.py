@@ -2,24 +2,24 @@ from pathlib import Path
 from typing import *
 import numpy as np
 import pandas as pd
-import tables
+import hashlib
 import logging
+from junevis.table_cache import TableCache
 
 logger = logging.getLogger(__name__)
 
 
 class RecordReader:
-    def __init__(self, record_file: Union[Path, str], summary_csv: Optional[Union[Path, str]] = None):
+    def __init__(
+        self,
+        record_file: Union[Path, str],
+        summary_csv: Optional[Union[Path, str]] = None,
+        cache: Optional[TableCache] = None,
+    ):
         self.record_file = Path(record_file)
-
-        if summary_csv is not None:
-            self.summary_csv = Path(summary_csv)
-            self.regional_summary = self.get_regional_summary(
-                self.summary_csv
-            )
-            self.world_summary = self.regional_summary.drop(columns="region") \
-                .groupby("time_stamp") \
-                .agg(self.aggregator)
+        self.cache = cache
+        self.summary_csv = None if summary_csv is None else Path(summary_csv)
+        self._summaries = None  # (regional, world) summaries, read from `summary_csv` on first use
 
     @classmethod
     def from_results_path(cls, results_path:Union[Path, str]="results", record_file: str="june_record.h5", summary_name: Optional[str]=None ):
@@ -36,36 +36,300 @@ class RecordReader:
 
         return cls(record_file, summary_csv)
 
-    def decode_bytes_columns(self, df):
-        str_df = df.select_dtypes([np.object])
+    def decode_bytes_columns(self, df, categorical: Union[bool, Sequence[str]] = False):
+        str_df = df.select_dtypes([object])
         for col in str_df:
-            df[col] = str_df[col].str.decode("utf-8")
+            as_category = categorical is True or (categorical is not False and col in categorical)
+            df[col] = self.decode_bytes(str_df[col].to_numpy(), as_category)
         return df
 
+    @staticmethod
+    def decode_bytes(values: np.ndarray, categorical: bool = False):
+        """Decode an array of byte strings to `str`, decoding each distinct value only once.
+
+        Columns like `spec`, `location_specs` and `timestamp` repeat a handful of values across millions of rows,
+        so this is much faster than decoding row by row. With `categorical=True` a `pd.Categorical` is returned
+        instead of an object array.
+        """
+        uniques, codes = np.unique(values, return_inverse=True)
+        decoded = np.array([u.decode("utf-8") for u in uniques], dtype=object)
+        if categorical:
+            return pd.Categorical.from_codes(codes, categories=decoded)
+        return decoded[codes]
+
+    @staticmethod
+    def aggregations(columns: Sequence[str]) -> Dict[str, str]:
+        """How each field of a summary combines across rows of the same day: fields of current counts (named
+        `current...`) are averaged, the counts of new events summed"""
+        return {col: "mean" if "current" in col else "sum" for col in columns}
+
+    @classmethod
+    def read_summaries(cls, summary_path: Union[Path, str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """The summary at `summary_path` per region and day (with a categorical `region` column) and per day over the
+        whole world, indexed by `time_stamp`.
+
+        Rows are grouped on dates (parsed once per distinct day) and region codes, and fields are combined by name
+        (`aggregations`) so that pandas runs its cythonized reductions. The world summary is computed from the regional
+        one, which has a single row per region and day"""
+        df = pd.read_csv(summary_path, dtype={"time_stamp": "category", "region": "category"})
+        fields = list(df.columns[2:])
+        days = df["time_stamp"].cat
+        df["time_stamp"] = days.rename_categories(pd.to_datetime(days.categories)).astype("datetime64[ns]")
+        how = cls.aggregations(fields)
+
+        # `sort=True` does not order observed categorical groups in every version of pandas, so sort them here
+        regional = df.groupby(["time_stamp", "region"], observed=True).agg(how).sort_index()
+        world = regional.groupby(level="time_stamp", sort=True).agg(how)
+        return regional.reset_index(level="region"), world
+
+    def _summary(self, i: int) -> pd.DataFrame:
+        if self.summary_csv is None:
+            raise AttributeError(f"No summary to read for {self.record_file}: give the reader a `summary_csv`")
+        if self._summaries is None:
+            self._summaries = self.read_summaries(self.summary_csv)
+        return self._summaries[i]
+
+    @property
+    def regional_summary(self) -> pd.DataFrame:
+        "The summary per region and day of `summary_csv`, read on first use (see `read_summaries`)"
+        return self._summary(0)
+
+    @property
+    def world_summary(self) -> pd.DataFrame:
+        "The summary per day of `summary_csv` over all regions, read on first use (see `read_summaries`)"
+        return self._summary(1)
+
+    @property
+    def aggregator(self) -> Dict[str, str]:
+        return self.aggregations(self.regional_summary.columns[1:])
+
     def get_regional_summary(self, summary_path):
-        df = pd.read_csv(summary_path)
-        self.aggregator = {
-            col: np.mean if "current" in col else sum for col in df.columns[2:]
-        }
-        df = df.groupby(["time_stamp", "region"], as_index=False).agg(self.aggregator)
-        df.set_index("time_stamp", inplace=True)
-        df.index = pd.to_datetime(df.index)
+        return self.read_summaries(summary_path)[0]
+
+    def _open(self, mode: str = "r"):
+        import tables  # Imported on first use: it takes a while to load, and is only needed to read records
+
+        return tables.open_file(self.record_file, mode=mode)
+
+    @staticmethod
+    def _read_rows(table, fields: Optional[Sequence[str]], start: int, stop: int, chunksize: int,
+                   where: Optional[str] = None, condvars: Optional[dict] = None):
+        """Read rows `[start, stop)` of `table` as a dict of column arrays, keeping only `fields`.
+
+        Rows are copied out one chunk at a time so the full-width records are never held in memory at once. With a
+        `where` condition (see `tables.Table.read_where`), only the matching rows are read, using the indexes of the
+        columns it names if the table has them."""
+        if where is not None:
+            records = table.read_where(where, condvars, start=start, stop=stop)
+            return {name: records[name] for name in (records.dtype.names if fields is None else fields)}
+        if fields is None:
+            records = table.read(start, stop)
+            return {name: records[name] for name in records.dtype.names}
+        if len(fields) == 1:
+            return {fields[0]: table.read(start, stop, field=fields[0])}
+
+        columns = {name: np.empty(stop - start, dtype=table.coldtypes[name]) for name in fields}
+        for chunk_start in range(start, stop, chunksize):
+            chunk_stop = min(chunk_start + chunksize, stop)
+            records = table.read(chunk_start, chunk_stop)
+            for name in fields:
+                columns[name][chunk_start - start : chunk_stop - start] = records[name]
+        return columns
+
+    def _columns_to_df(self, columns: Dict[str, np.ndarray], index: Optional[str], categorical) -> pd.DataFrame:
+        data = {}
+        for name, values in columns.items():
+            if values.dtype.kind == "S":
+                as_category = categorical is True or (categorical is not False and name in categorical)
+                data[name] = self.decode_bytes(values, as_category)
+            else:
+                data[name] = values
+        df = pd.DataFrame(data)
+        if index is not None:
+            df.set_index(index, inplace=True)
         return df
 
+    @staticmethod
+    def _with_index(fields: Optional[Sequence[str]], index: Optional[str]) -> Optional[List[str]]:
+        if fields is None:
+            return None
+        fields = list(fields)
+        if index is not None and index not in fields:
+            fields = [index] + fields
+        return fields
+
     def table_to_df(
-        self, table_name: str, index: str = "id", fields: Optional[Tuple] = None
+        self,
+        table_name: str,
+        index: str = "id",
+        fields: Optional[Sequence[str]] = None,
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        categorical: Union[bool, Sequence[str]] = False,
+        chunksize: int = 1_000_000,
+        where: Optional[str] = None,
+        condvars: Optional[dict] = None,
     ) -> pd.DataFrame:
-        # TODO: include fields to read only certain columns
-        with tables.open_file(self.record_file, mode="r") as f:
+        """Load `table_name` into a DataFrame indexed by `index`.
+
+        Only the columns in `fields` (plus `index`) are kept, and only rows `[start, stop)` are read, or only those of
+        them matching the condition `where` on the columns of the table (with the variables `condvars`, see
+        `tables.Table.read_where`). Byte string columns are decoded to `str`; those named in `categorical` (or all of
+        them if `True`) become categoricals.
+        """
+        fields = self._with_index(fields, index)
+        with self._open() as f:
             table = getattr(f.root, table_name)
-            df = pd.DataFrame.from_records(table.read(), index=index)
-        df = self.decode_bytes_columns(df)
-        return df
+            start, stop, _ = slice(start, stop).indices(table.nrows)
+            columns = self._read_rows(table, fields, start, max(start, stop), chunksize, where, condvars)
+        return self._columns_to_df(columns, index, categorical)
+
+    def iter_table(
+        self,
+        table_name: str,
+        fields: Optional[Sequence[str]] = None,
+        chunksize: int = 1_000_000,
+        index: Optional[str] = None,
+        categorical: Union[bool, Sequence[str]] = False,
+        start: Optional[int] = None,
+        stop: Optional[int] = None,
+        where: Optional[str] = None,
+        condvars: Optional[dict] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """Iterate over `table_name` in DataFrames of at most `chunksize` rows, keeping only `fields`. With a `where`
+        condition as in `table_to_df`, each DataFrame holds the matching rows of the next `chunksize` rows"""
+        fields = self._with_index(fields, index)
+        with self._open() as f:
+            table = getattr(f.root, table_name)
+            start, stop, _ = slice(start, stop).indices(table.nrows)
+            for chunk_start in range(start, stop, chunksize):
+                chunk_stop = min(chunk_start + chunksize, stop)
+                columns = self._read_rows(table, fields, chunk_start, chunk_stop, chunksize, where, condvars)
+                yield self._columns_to_df(columns, index, categorical)
+
+    def table_size(self, table_name: str) -> Tuple[int, int]:
+        """Number of rows of `table_name` and bytes per row, without reading it"""
+        with self._open() as f:
+            table = getattr(f.root, table_name)
+            return table.nrows, table.dtype.itemsize
+
+    def create_indexes(self, columns: Dict[str, Sequence[str]], chunksize: int = 1_000_000) -> List[str]:
+        """Index the `columns` of every table, to read only the rows with values in a range of them. This writes to the
+        record file.
+
+        Columns whose values are already in order (like the timestamps of the events, which are logged day by day) are
+        marked as sorted, so that `sorted_range` finds the rows of a range by binary search. Others get a completely
+        sorted PyTables index, which `where` conditions on them use. Returns the `table.column` names that were indexed"""
+        created = []
+        with self._open("a") as f:
+            for table_name, names in columns.items():
+                if table_name not in f.root:
+                    continue
+                table = getattr(f.root, table_name)
+                sorted_columns = list(getattr(table.attrs, "sorted_columns", []))
+                for name in names:
+                    column = table.cols._f_col(name)
+                    if name in sorted_columns or column.is_indexed:
+                        continue
+                    if self._is_sorted(table, name, chunksize):
+                        sorted_columns.append(name)
+                    else:
+                        column.create_csindex()
+                    created.append(f"{table_name}.{name}")
+                table.attrs.sorted_columns = sorted_columns
+        return created
+
+    @staticmethod
+    def _is_sorted(table, name: str, chunksize: int) -> bool:
+        last = None
+        for start in range(0, table.nrows, chunksize):
+            values = table.read(start, min(start + chunksize, table.nrows), field=name)
+            if (last is not None and values[0] < last) or (values[1:] < values[:-1]).any():
+                return False
+            last = values[-1]
+        return True
+
+    def indexed_columns(self, table_name: str) -> Dict[str, str]:
+        """The columns of `table_name` indexed by `create_indexes`: `"sorted"` or `"index"` by column name"""
+        with self._open() as f:
+            table = getattr(f.root, table_name)
+            indexed = {name: "index" for name in table.colindexed if table.colindexed[name]}
+            indexed.update({name: "sorted" for name in getattr(table.attrs, "sorted_columns", [])})
+        return indexed
+
+    def sorted_range(self, table_name: str, column: str, lo=None, hi=None) -> Tuple[int, int]:
+        """The rows `[start, stop)` of `table_name` whose `column`, which must be sorted, is at least `lo` and below `hi`
+        (no limit if None), found by binary search"""
+        with self._open() as f:
+            table = getattr(f.root, table_name)
+
+            def first_at_least(value):
+                first, last = 0, table.nrows
+                while first < last:
+                    middle = (first + last) // 2
+                    if table.read(middle, middle + 1, field=column)[0] < value:
+                        first = middle + 1
+                    else:
+                        last = middle
+                return first
+
+            start = 0 if lo is None else first_at_least(lo)
+            stop = table.nrows if hi is None else max(start, first_at_least(hi))
+        return start, stop
+
+    def table_checksum(self, table_name: str, chunk_rows: int = 2 ** 18) -> str:
+        """Fingerprint the contents of `table_name`: its column layout, number of rows and the raw bytes of every row.
+
+        The rows are read `chunk_rows` at a time, which costs a pass over the table but much less than parsing it into
+        a frame, and tells apart any two tables that differ anywhere.
+        """
+        with self._open() as f:
+            table = getattr(f.root, table_name)
+            h = hashlib.sha1()
+            h.update(table_name.encode("utf-8"))
+            h.update(str(table.dtype.descr).encode("utf-8"))
+            h.update(str(table.nrows).encode("utf-8"))
+            for start in range(0, table.nrows, chunk_rows):
+                h.update(table.read(start, min(start + chunk_rows, table.nrows)).tobytes())
+        return h.hexdigest()
+
+    def cached_checksum(self, table_name: str) -> str:
+        """`table_checksum` of `table_name`, computed once per version of the record file and kept in `self.cache`"""
+        return self.cache.checksum(self.record_file, table_name, lambda: self.table_checksum(table_name))
+
+    def cached_table_to_df(
+        self,
+        table_name: str,
+        index: str = "id",
+        fields: Optional[Sequence[str]] = None,
+        categorical: Union[bool, Sequence[str]] = False,
+    ) -> pd.DataFrame:
+        """Like `table_to_df`, but served from `self.cache` if an identical table was already loaded.
+
+        Meant for the static tables shared by every record of a world. The returned frame is shared: treat it as read-only."""
+        load = lambda: self.table_to_df(table_name, index=index, fields=fields, categorical=categorical)
+        if self.cache is None:
+            return load()
+        key = TableCache.make_key(
+            self.cached_checksum(table_name),
+            index,
+            None if fields is None else tuple(fields),
+            categorical if isinstance(categorical, bool) else tuple(categorical),
+        )
+        return self.cache.get_or_load(key, load)
 
     def get_geography_df(self,):
-        areas_df = self.table_to_df("areas")
-        super_areas_df = self.table_to_df("super_areas")
-        regions_df = self.table_to_df("regions")
+        if self.cache is None:
+            return self._get_geography_df()
+        key = TableCache.make_key(
+            "geography", *[self.cached_checksum(t) for t in ["areas", "super_areas", "regions"]]
+        )
+        return self.cache.get_or_load(key, self._get_geography_df)
+
+    def _get_geography_df(self,):
+        areas_df = self.table_to_df("areas", fields=("super_area_id", "name"))
+        super_areas_df = self.table_to_df("super_areas", fields=("region_id", "name"))
+        regions_df = self.table_to_df("regions", fields=("name",))
 
         geography_df = areas_df[["super_area_id", "name"]].merge(
             super_areas_df[["region_id", "name"]],
@@ -0,0 +1,441 @@
+"""Parsed run summaries of the projects, cached in memory to serve slices of them and aggregates across runs from the API
+in `junevis.server`"""
+
+from pathlib import Path
+from typing import *
+from collections import OrderedDict
+import json
+import datetime
+import threading
+import numpy as np
+
+from junevis.summary_format import summary_suffix, read_summary_arrays, arrays_to_bytes
+from junevis.project_cube import ProjectCube, CUBE_HEADER
+
+# Statistics across runs of every region, day and field, see `aggregate_runs`
+AGGREGATE_PERCENTILES = [5, 25, 50, 75, 95]
+AGGREGATE_STATISTICS = ["mean", "min", "max"] + [f"p{p}" for p in AGGREGATE_PERCENTILES]
+
+# Time steps that summaries are written for, finest first, and their pandas period frequency
+TIME_STEPS = {"day": "D", "week": "W", "month": "M"}
+
+# Ways to combine the regions of a run into one, and the name of that region (as in the frontend), see `combine_regions`
+COMBINED_REGIONS = {"sum": "all", "mean": "average"}
+
+
+class RunData(NamedTuple):
+    """A run summary as a `(n_regions, n_days)` array per field, see `summary_format.read_summary_arrays`"""
+
+    header: dict
+    arrays: Dict[str, np.ndarray]
+    mask: Optional[np.ndarray]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self.arrays.values()) + (0 if self.mask is None else self.mask.nbytes)
+
+
+class RunStore:
+    """Size-bounded LRU cache of the parsed runs of every project in `projects_dir`, and of the aggregates across them.
+
+    Runs are keyed by the path, size and modification time of their summary, so a rebuilt project is read again. Projects
+    written with `junevis_create --cube` serve their runs from the memory mapped cube instead (see `project_cube`), which
+    takes no space in the cache."""
+
+    def __init__(self, projects_dir: Union[Path, str], max_bytes: int = 1024 ** 3):
+        self.projects_dir = Path(projects_dir)
+        self.max_bytes = max_bytes
+        self._runs = OrderedDict()
+        self._metadata = {}
+        self._cubes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(run.nbytes for run in self._runs.values())
+
+    def project_dir(self, project: str) -> Path:
+        path = self.projects_dir / project
+        if Path(project).name != project or not (path / "metadata.json").exists():
+            raise FileNotFoundError(f"No project named '{project}'")
+        return path
+
+    def metadata(self, project: str) -> dict:
+        metadata_f = self.project_dir(project) / "metadata.json"
+        key = (metadata_f, metadata_f.stat().st_mtime)
+        if key not in self._metadata:
+            with open(metadata_f) as fp:
+                self._metadata[key] = json.load(fp)
+        return self._metadata[key]
+
+    def summary_folder(self, project: str, level: str = "region", step: str = "day") -> Path:
+        """Folder of the summaries per group of the geography `level` and per time `step`, one of the `summary_levels`
+        and `time_steps` of the project's metadata. Finer levels than regions and longer steps than days are in a folder
+        of their name"""
+        metadata = self.metadata(project)
+        levels, steps = metadata.get("summary_levels", ["region"]), metadata.get("time_steps", ["day"])
+        if level not in levels:
+            raise ValueError(f"Project '{project}' has no summaries per {level}. Choose from {levels}")
+        if step not in steps:
+            raise ValueError(f"Project '{project}' has no summaries per {step}. Choose from {steps}")
+        return self.project_dir(project).joinpath(*[f for f in [level, step] if f not in ("region", "day")])
+
+    def summary_path(self, project: str, run_id: int, level: str = "region", step: str = "day") -> Path:
+        """Summary of run `run_id` per group of the geography `level` and per time `step`, see `summary_folder`"""
+        fmt = self.metadata(project).get("summary_format", "csv")
+        path = self.summary_folder(project, level, step) / f"summary_{int(run_id):03}{summary_suffix(fmt)}"
+        if not path.exists():
+            raise FileNotFoundError(f"No run {run_id} in project '{project}'")
+        return path
+
+    def run_ids(self, project: str) -> List[int]:
+        return sorted(int(r) for r in self.metadata(project)["run_parameters"])
+
+    def _cached(self, key, compute: Callable[[], RunData]) -> RunData:
+        with self._lock:
+            if key in self._runs:
+                self._runs.move_to_end(key)
+                return self._runs[key]
+
+        run = compute()
+        with self._lock:
+            self._runs[key] = run
+            while self.nbytes > self.max_bytes and len(self._runs) > 1:
+                self._runs.popitem(last=False)
+        return run
+
+    @staticmethod
+    def _file_key(path: Path) -> tuple:
+        stat = path.stat()
+        return (str(path), stat.st_size, stat.st_mtime)
+
+    def load(self, path: Union[Path, str]) -> RunData:
+        """The parsed summary at `path`"""
+        path = Path(path)
+
+        def read():
+            header, arrays, mask = read_summary_arrays(path)
+            return RunData(header, {name: np.array(a) for name, a in arrays.items()}, mask)
+
+        return self._cached(self._file_key(path), read)
+
+    def _cube(self, project: str, level: str, step: str) -> Tuple[Optional[tuple], Optional[ProjectCube]]:
+        if not self.metadata(project).get("cube", False):
+            return None, None
+        folder = self.summary_folder(project, level, step)
+        for attempt in range(2):
+            try:
+                # The header is replaced at once and names data that is never rewritten (see `project_cube`)
+                stat = (folder / CUBE_HEADER).stat()
+                key = (str(folder), stat.st_size, stat.st_mtime, stat.st_ino)
+            except FileNotFoundError:
+                return None, None
+            with self._lock:
+                cached = self._cubes.get(folder)
+            if cached is not None and cached[0] == key:
+                return cached
+            try:
+                cached = (key, ProjectCube(folder))
+            except FileNotFoundError:  # Replaced by a new cube while opening it
+                continue
+            with self._lock:
+                self._cubes[folder] = cached
+            return cached
+        return None, None
+
+    def cube(self, project: str, level: str = "region", step: str = "day") -> Optional[ProjectCube]:
+        """The cube of the summaries per `level` and `step` of `project`, if it was written with one"""
+        return self._cube(project, level, step)[1]
+
+    def _run_key(self, project: str, run_id: int, level: str, step: str) -> tuple:
+        key, cube = self._cube(project, level, step)
+        if cube is not None and run_id in cube:
+            return key + (int(run_id),)
+        return self._file_key(self.summary_path(project, run_id, level, step))
+
+    def get_run(self, project: str, run_id: int, level: str = "region", step: str = "day") -> RunData:
+        """Run `run_id` of `project`, from its cube if it has one (as views of the memory mapped file) or its summary"""
+        cube = self.cube(project, level, step)
+        if cube is not None and run_id in cube:
+            return RunData(*cube.read_run(run_id))
+        return self.load(self.summary_path(project, run_id, level, step))
+
+    def time_step(self, project: str, start: Optional[str] = None, end: Optional[str] = None,
+                  max_points: Optional[int] = None) -> str:
+        """The time step of `project` to draw the days from `start` to `end` with, see `time_step_for`"""
+        metadata = self.metadata(project)
+        return time_step_for(metadata["all_timestamps"], metadata.get("time_steps", ["day"]), start, end, max_points)
+
+    def select_runs(self, project: str, selection: Dict[str, list]) -> List[int]:
+        """Runs of `project` matching a parameter selection, see `filter_by_selection`"""
+        run_parameters = self.metadata(project)["run_parameters"]
+        return sorted(int(r) for r in filter_by_selection(run_parameters, selection))
+
+    def aggregate(
+        self,
+        project: str,
+        run_ids: Sequence[int],
+        fields: Optional[Sequence[str]] = None,
+        regions: Optional[Sequence[str]] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        level: str = "region",
+        step: str = "day",
+        combine: Optional[str] = None,
+    ) -> RunData:
+        """The statistics of `aggregate_runs` across `run_ids`, for a slice of the runs (per group of `level` and time
+        `step`) as in `slice_run`, with the regions of each run combined into one if `combine` is given (see
+        `combine_regions`).
+
+        Uses the aggregates precomputed by `junevis_create --aggregates` when they cover the same runs"""
+        run_ids = sorted(set(int(r) for r in run_ids))
+        if not run_ids:
+            raise ValueError("No runs to aggregate")
+        agg_fields = None if fields is None else [aggregate_field_name(f, s) for f in fields for s in AGGREGATE_STATISTICS]
+
+        for entry in self.metadata(project).get("aggregates", []) if (level, step, combine) == ("region", "day", None) else []:
+            path = self.project_dir(project) / entry["file"]
+            if sorted(entry["runs"]) == run_ids and path.exists():
+                return slice_run(self.load(path), agg_fields, regions, start, end)
+
+        run_keys = tuple(self._run_key(project, r, level, step) for r in run_ids)
+        key = ("aggregate", run_keys, _key(fields), _key(regions), start, end, combine)
+        return self._cached(key, lambda: aggregate_runs([
+            combine_regions(slice_run(self.get_run(project, r, level, step), fields, regions, start, end), combine) for r in run_ids
+        ]))
+
+    def clear(self):
+        with self._lock:
+            self._runs.clear()
+            self._metadata.clear()
+            self._cubes.clear()
+
+
+def _key(values: Optional[Sequence[str]]) -> Optional[tuple]:
+    return None if values is None else tuple(values)
+
+
+def time_step_for(timestamps: Sequence[str], steps: Sequence[str], start: Optional[str] = None, end: Optional[str] = None,
+                  max_points: Optional[int] = None) -> str:
+    """The finest of `steps` (see `TIME_STEPS`) that has at most `max_points` periods among the days `timestamps` from
+    `start` to `end` (inclusive), e.g. the width of a chart in pixels. The coarsest step if none does, and days (if
+    available) without `max_points`"""
+    import pandas as pd
+
+    steps = sorted(steps, key=list(TIME_STEPS).index)
+    if max_points is None:
+        return steps[0]
+    days = pd.DatetimeIndex([t for t in timestamps if (start is None or t >= start) and (end is None or t <= end)])
+    for step in steps:
+        if days.to_period(TIME_STEPS[step]).nunique() <= max_points:
+            return step
+    return steps[-1]
+
+
+def check_step(step: str) -> str:
+    """`step` if it is one of `TIME_STEPS`, else a ValueError"""
+    if step not in TIME_STEPS:
+        raise ValueError(f"Unknown time step '{step}'. Choose one of {', '.join(TIME_STEPS)}")
+    return step
+
+
+def check_date(date: Optional[str]) -> Optional[str]:
+    """`date` if it is None or a day as YYYY-MM-DD, the format of the timestamps in the summaries, else a ValueError"""
+    if date is not None:
+        try:
+            datetime.date.fromisoformat(date)
+        except ValueError:
+            raise ValueError(f"Invalid date '{date}'. Use YYYY-MM-DD") from None
+    return date
+
+
+def period_start(date: Optional[str], step: str) -> Optional[str]:
+    """First day of the period of time `step` that the day `date` is in, which names that period in the summaries.
+    Raises ValueError for an unknown `step` or a `date` that is not YYYY-MM-DD"""
+    import pandas as pd
+
+    check_step(step)
+    if check_date(date) is None or step == "day":
+        return date
+    return str(pd.Period(date, freq=TIME_STEPS[step]).start_time.date())
+
+
+def filter_by_selection(run_parameters: Dict[str, dict], selection: Dict[str, list]) -> List[str]:
+    """Ids of the runs whose parameters take one of the values listed for every parameter of `selection`, like
+    `JuneProject.filterBySelection` in the frontend. An empty list of values selects every value of that parameter"""
+    return [
+        run_id
+        for run_id, params in run_parameters.items()
+        if all(len(values) == 0 or params.get(k) in values for k, values in selection.items())
+    ]
+
+
+def _positions(names: List[str], selected: Optional[Sequence[str]], kind: str) -> np.ndarray:
+    if selected is None:
+        return np.arange(len(names))
+    lookup = {name: i for i, name in enumerate(names)}
+    unknown = [s for s in selected if s not in lookup]
+    if unknown:
+        raise ValueError(f"Unknown {kind}: {', '.join(unknown)}")
+    return np.array([lookup[s] for s in selected], dtype=np.int64)
+
+
+def slice_run(
+    run: RunData,
+    fields: Optional[Sequence[str]] = None,
+    regions: Optional[Sequence[str]] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+) -> RunData:
+    """Only the `fields` and `regions` of `run` (all if None), between the dates `start` and `end` (inclusive)"""
+    field_names = [f["name"] for f in run.header["fields"]]
+    _positions(field_names, fields, "fields")
+    region_idx = _positions(run.header["regions"], regions, "regions")
+
+    timestamps = run.header["timestamps"]
+    first = 0 if start is None else int(np.searchsorted(timestamps, start, side="left"))
+    last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side="right"))
+    days = slice(first, max(first, last))
+
+    selected = field_names if fields is None else list(fields)
+    header = {
+        **run.header,
+        "regions": [run.header["regions"][i] for i in region_idx],
+        "timestamps": timestamps[days],
+        "fields": [f for f in run.header["fields"] if f["name"] in set(selected)],
+    }
+    arrays = {name: run.arrays[name][region_idx, days] for name in selected}
+    mask = None if run.mask is None else run.mask[region_idx, days]
+    return RunData(header, arrays, mask)
+
+
+def combine_regions(run: RunData, how: Optional[str]) -> RunData:
+    """The regions of `run` combined into one, like the "all" (`how="sum"`) and "average" (`how="mean"`, the sum over
+    the number of regions) regions of `JuneSim` in the frontend. Missing rows count as 0, and a day is only missing if
+    every region is. `run` itself if `how` is None"""
+    if how is None:
+        return run
+    if how not in COMBINED_REGIONS:
+        raise ValueError(f"Unknown way to combine regions '{how}'. Choose one of {', '.join(COMBINED_REGIONS)}")
+    arrays = {}
+    for name, values in run.arrays.items():
+        if run.mask is not None:
+            values = np.where(run.mask, values, 0)
+        integer = values.dtype.kind in "iub" and how == "sum"
+        arrays[name] = values.sum(axis=0, keepdims=True, dtype=np.int64 if integer else np.float64)
+        if how == "mean":
+            arrays[name] /= max(1, len(run.header["regions"]))
+
+    header = {
+        **run.header,
+        "regions": [COMBINED_REGIONS[how]],
+        "fields": [{"name": name, "dtype": values.dtype.str, "integer": values.dtype.kind == "i"} for name, values in arrays.items()],
+    }
+    mask = None if run.mask is None else run.mask.any(axis=0, keepdims=True)
+    return RunData(header, arrays, mask)
+
+
+def run_to_json(run: RunData) -> dict:
+    """Columnar JSON of a run: for each field, a list of the values of each region by day (null for missing rows and NaN)"""
+    fields = {}
+    for name, values in run.arrays.items():
+        missing = np.zeros(values.shape, dtype=bool) if run.mask is None else ~run.mask
+        if values.dtype.kind == "f":
+            missing |= np.isnan(values)
+        if missing.any():
+            values = values.astype(object)
+            values[missing] = None
+        fields[name] = values.tolist()
+    return {"regions": run.header["regions"], "timestamps": run.header["timestamps"], "fields": fields}
+
+
+def run_to_bytes(run: RunData) -> bytes:
+    """A run in the binary summary format, readable with `parseSummary` in the frontend"""
+    return arrays_to_bytes(run.header, run.arrays, run.mask)
+
+
+def aggregate_field_name(field: str, statistic: str) -> str:
+    return f"{field}:{statistic}"
+
+
+def _run_statistics(stacked: np.ndarray) -> Dict[str, np.ndarray]:
+    """`AGGREGATE_STATISTICS` over the last axis of `stacked`, ignoring NaN. Percentiles interpolate linearly like
+    `np.nanpercentile`, but share a single partial sort for all of them"""
+    qs = np.array([0] + AGGREGATE_PERCENTILES + [100]) / 100
+    missing = np.isnan(stacked)
+    if not missing.any():
+        pos = qs * (stacked.shape[-1] - 1)
+        below = np.floor(pos).astype(np.int64)
+        above = np.minimum(below + 1, stacked.shape[-1] - 1)
+        ordered = np.partition(stacked, np.union1d(below, above), axis=-1)
+        percentiles = ordered[..., below] * (1 - pos + below) + ordered[..., above] * (pos - below)
+        mean = stacked.mean(axis=-1)
+    else:
+        ordered = np.sort(stacked, axis=-1)  # NaN sort last
+        n = stacked.shape[-1] - missing.sum(axis=-1)
+        pos = np.maximum(n - 1, 0)[..., None] * qs
+        below = np.floor(pos).astype(np.int64)
+        above = np.minimum(below + 1, np.maximum(n - 1, 0)[..., None])
+        percentiles = np.take_along_axis(ordered, below, -1) * (1 - pos + below) + np.take_along_axis(ordered, above, -1) * (pos - below)
+        with np.errstate(invalid="ignore", divide="ignore"):  # Cells no run has stay NaN
+            mean = np.where(n > 0, np.nansum(stacked, axis=-1) / n, np.nan)
+
+    stats = {"mean": mean, "min": percentiles[..., 0], "max": percentiles[..., -1]}
+    stats.update({f"p{p}": percentiles[..., i + 1] for i, p in enumerate(AGGREGATE_PERCENTILES)})
+    return stats
+
+
+def aggregate_runs(runs: Sequence[RunData], block_bytes: int = 64 * 1024 ** 2) -> RunData:
+    """The `AGGREGATE_STATISTICS` across `runs` of every region, day and field they share, as float fields named by
+    `aggregate_field_name`. Runs are aligned on the union of their regions (in order of appearance) and days, ignoring the
+    rows a run is missing.
+
+    Runs are stacked into a `(n_regions, n_days, n_runs)` array for a block of regions of about `block_bytes` at a time"""
+    regions = list(dict.fromkeys(region for r in runs for region in r.header["regions"]))
+    timestamps = sorted(set().union(*(r.header["timestamps"] for r in runs)))
+    fields = [f["name"] for f in runs[0].header["fields"] if all(f["name"] in r.arrays for r in runs[1:])]
+    shape = (len(regions), len(timestamps))
+
+    # Position of every row of each run in the aligned grid
+    region_pos = [_positions(regions, r.header["regions"], "regions") for r in runs]
+    day_pos = [_positions(timestamps, r.header["timestamps"], "timestamps") for r in runs]
+
+    present = np.zeros(shape, dtype=bool)
+    for run, rp, dp in zip(runs, region_pos, day_pos):
+        present[np.ix_(rp, dp)] |= True if run.mask is None else run.mask
+
+    arrays = {aggregate_field_name(f, s): np.full(shape, np.nan) for f in fields for s in AGGREGATE_STATISTICS}
+    block = max(1, block_bytes // max(1, len(runs) * shape[1] * 8))
+    for lo in range(0, shape[0], block):
+        hi = min(lo + block, shape[0])
+        for field in fields:
+            # Runs on the last axis, so sorting them is contiguous
+            stacked = np.full((hi - lo, shape[1], len(runs)), np.nan)
+            for i, (run, rp, dp) in enumerate(zip(runs, region_pos, day_pos)):
+                rows = (rp >= lo) & (rp < hi)
+                values = run.arrays[field][rows].astype(np.float64)
+                if run.mask is not None:
+                    values[~run.mask[rows]] = np.nan
+                stacked[np.ix_(rp[rows] - lo, dp, [i])] = values[..., None]
+
+            for stat, values in _run_statistics(stacked).items():
+                arrays[aggregate_field_name(field, stat)][lo:hi] = values
+
+    header = {
+        "regions": regions,
+        "timestamps": timestamps,
+        "index_names": runs[0].header["index_names"],
+        "fields": [{"name": name, "dtype": "<f8", "integer": False} for name in arrays],
+    }
+    return RunData(header, arrays, None if present.all() else present)
+
+
+def aggregate_to_json(run: RunData) -> dict:
+    """Columnar JSON of aggregates like `run_to_json`, with the fields grouped as `{field: {statistic: values}}`"""
+    out = run_to_json(run)
+    fields = {}
+    for name, values in out["fields"].items():
+        field, stat = name.rsplit(":", 1)
+        fields.setdefault(field, {})[stat] = values
+    out["fields"] = fields
+    return out
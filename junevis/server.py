@@ -1,19 +1,36 @@
 import argparse
+import json
+import logging
+import secrets
 from typing import *
 from pathlib import Path
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import RedirectResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-import uvicorn
+from starlette.requests import Request
+from pydantic import BaseModel
 import junevis.path_fixes as pf
+from junevis.run_store import RunStore, slice_run, combine_regions, period_start, check_step, check_date, run_to_json, run_to_bytes, aggregate_to_json
+from junevis.static_files import StaticFiles, precompress
+from junevis.project_catalog import ProjectCatalog
+from junevis.build_queue import BuildQueue
+
+logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--port", default=8000, type=int, help="Port to run the app. ")
 parser.add_argument("--dist", default=pf.DIST, type=str, help="Path to the dist folder containing HTML+JS+CSS")
-
-args, _ = parser.parse_known_args()
+parser.add_argument("--projects", default=pf.PROJECTS, type=str, help="Path to the folder containing the projects")
+parser.add_argument("--catalog", default=pf.CATALOG, type=str, help="Path to the SQLite catalog of the projects")
+parser.add_argument("--hot_cache_mb", default=256, type=int, help="Memory for the most requested static files, in MB")
+parser.add_argument("--build_jobs", default=0, type=int, help="Projects to build at the same time through the API. 0 to not build any")
+parser.add_argument("--build_memory", default=None, type=float, help="Memory limit in GB of each process of a build job")
+parser.add_argument("--build_workers", default=1, type=int, help="Processes that each build job may summarize records with")
+parser.add_argument("--builds_dir", default=None, type=str, help="Folder to keep the progress and output of build jobs in")
+parser.add_argument("--build_records", default=None, type=str, help="Folder of the records that projects may be built from. Required with --build_jobs")
+parser.add_argument("--build_token", default=None, type=str, help="Token that requests to build projects must send as `Authorization: Bearer <token>`. Generated and logged if not given")
+parser.add_argument("--precompress", action="store_true", help="Write gzip/brotli versions of the static files before serving")
 
 app = FastAPI()
 app.add_middleware(
@@ -24,6 +41,197 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+store = catalog = builds = build_token = static = None # Set by `configure`
+
+def configure(args: argparse.Namespace):
+    """Serve the projects, catalog and frontend given by the command line `args` (see `parser`), and build projects if
+    `args.build_jobs` > 0. `run` configures the app from the command line; imported on its own, the app is configured
+    with the defaults when it starts"""
+    global store, catalog, builds, build_token, static
+    if args.build_jobs > 0 and args.build_records is None:
+        raise ValueError("Give the folder of the records to build projects from with --build_records")
+    store = RunStore(args.projects)
+    catalog = ProjectCatalog(args.catalog, projects_dir=args.projects, read_only=args.build_jobs < 1)
+    builds = None if args.build_jobs < 1 else BuildQueue(args.build_records, args.builds_dir, max_jobs=args.build_jobs,
+                                                          max_job_memory=args.build_memory, max_job_workers=args.build_workers)
+    build_token = None if builds is None else args.build_token or secrets.token_urlsafe(24)
+    if builds is not None and args.build_token is None:
+        logger.info(f"Send 'Authorization: Bearer {build_token}' to build projects")
+    static = StaticFiles(args.dist, max_bytes=args.hot_cache_mb * 1024 ** 2)
+
+@app.on_event("startup")
+def configure_defaults():
+    if store is None: configure(parser.parse_args([]))
+
+def _split(value: Optional[str]) -> Optional[List[str]]:
+    """Comma separated list of a query parameter, None if not given"""
+    return None if value is None else [v for v in value.split(",") if v]
+
+def _time_step(project: str, step: Optional[str], start: Optional[str], end: Optional[str], max_points: Optional[int]) -> str:
+    """`step` if given, else the time step of the project's summaries that fits `max_points` points (see `time_step_for`).
+    Checks `step`, `start` and `end` first, answering 400 if they are invalid"""
+    try:
+        check_date(start), check_date(end)
+        if step is not None:
+            return check_step(step)
+        return store.time_step(project, start, end, max_points)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _run_slice(project: str, run_id: int, fields: Optional[str], regions: Optional[str], start: Optional[str], end: Optional[str],
+               level: str = "region", step: str = "day", combine: Optional[str] = None):
+    try:
+        run = slice_run(store.get_run(project, run_id, level, step), _split(fields), _split(regions), period_start(start, step), end)
+        return combine_regions(run, combine)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _selection(selection: str) -> Dict[str, list]:
+    """The parameter query `selection`, parsed from JSON. Raises ValueError unless it maps parameter names to lists"""
+    try:
+        query = json.loads(selection)
+    except ValueError:
+        raise ValueError(f"Invalid JSON in selection '{selection}'") from None
+    if not isinstance(query, dict) or not all(isinstance(values, list) for values in query.values()):
+        raise ValueError('The selection must be a JSON object of parameter names to lists of values, like {"param": [value, ...]}')
+    return query
+
+# ======================================================================
+## Project Catalog API ##
+# ======================================================================
+@app.get("/api/projects")
+def get_projects(prefix: str = None, limit: int = None, offset: int = 0):
+    """The projects whose names start with `prefix` (all of them if not given), in the order they were first created:
+    their description, number of runs, the values of every parameter, summary format and times of creation and last update"""
+    return JSONResponse({"projects": catalog.projects(prefix, limit, offset)})
+
+@app.get("/api/projects/{project}")
+def get_project(project: str):
+    """Catalog entry of `project` as in `get_projects`, along with the statistics of every field"""
+    entry = catalog.get(project)
+    if entry is None or entry["status"] != "ready":
+        raise HTTPException(status_code=404, detail=f"No project '{project}' in {catalog.path}")
+    return JSONResponse(entry)
+
+# ======================================================================
+## Run Summary API ##
+# ======================================================================
+@app.get("/api/projects/{project}/runs/{run_id}")
+def get_run(project: str, run_id: int, fields: str = None, regions: str = None, start: str = None, end: str = None, format: str = "json",
+            level: str = "region", step: str = None, max_points: int = None, combine: str = None):
+    """Slice of the summary of one run: only the comma separated `fields` and `regions` between the dates `start` and
+    `end` (inclusive). Sent as columnar JSON, or with `format=bin` as a binary summary that `parseSummary` reads.
+
+    With `level`, the summary per super area or area (if the project has it) is sliced instead, `regions` naming those.
+    The summary is per day, or per `step` (`week` or `month`, if the project has it). With `max_points` instead of a
+    `step`, the finest step with at most that many points between `start` and `end` is chosen. Periods are named by their
+    first day, and the one `start` is in is included. The step sent is in the `time_step` field of the JSON, or the
+    `X-Time-Step` header. With `combine` (`sum` or `mean`), the regions of the slice are sent combined into one, named
+    `all` or `average` like in the frontend (see `combine_regions`)"""
+    step = _time_step(project, step, start, end, max_points)
+    run = _run_slice(project, run_id, fields, regions, start, end, level, step, combine)
+    if format == "bin":
+        return Response(content=run_to_bytes(run), media_type="application/octet-stream", headers={"X-Time-Step": step})
+    if format != "json":
+        raise HTTPException(status_code=400, detail=f"Unknown format '{format}'. Choose 'json' or 'bin'")
+    return JSONResponse({**run_to_json(run), "time_step": step})
+
+@app.get("/api/projects/{project}/runs")
+def get_runs(project: str, run_ids: str = None, fields: str = None, regions: str = None, start: str = None, end: str = None,
+             level: str = "region", step: str = None, max_points: int = None, combine: str = None):
+    """The same slice of several runs (comma separated `run_ids`, all runs of the project if not given) as columnar JSON"""
+    try:
+        ids = store.run_ids(project) if run_ids is None else [int(r) for r in _split(run_ids)]
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid run_ids '{run_ids}'")
+    step = _time_step(project, step, start, end, max_points)
+    runs = {str(r): {**run_to_json(_run_slice(project, r, fields, regions, start, end, level, step, combine)), "time_step": step}
+            for r in ids}
+    return JSONResponse({"runs": runs})
+
+@app.get("/api/projects/{project}/aggregate")
+def get_aggregate(project: str, selection: str = None, run_ids: str = None, fields: str = None, regions: str = None,
+                  start: str = None, end: str = None, format: str = "json", level: str = "region", step: str = None,
+                  max_points: int = None, combine: str = None):
+    """Mean, min, max and percentiles across runs of every region, day and field of a slice as in `get_run`, with its
+    regions combined into one first if `combine` is given.
+
+    The runs are either the comma separated `run_ids` or those matching `selection`, a parameter query as JSON
+    (`{"param": [value, ...]}`, like `filterBySelection` in the frontend). All runs of the project if neither is given.
+    A `selection` that matches no run is sent as JSON with no `runs` and no `fields`"""
+    step = _time_step(project, step, start, end, max_points)
+    try:
+        if run_ids is not None:
+            ids = [int(r) for r in _split(run_ids)]
+        elif selection is not None:
+            ids = store.select_runs(project, _selection(selection))
+            if not ids and format == "json":
+                return JSONResponse({"runs": [], "time_step": step, "regions": [], "timestamps": [], "fields": {}})
+        else:
+            ids = store.run_ids(project)
+        agg = store.aggregate(project, ids, _split(fields), _split(regions), period_start(start, step), end, level, step, combine)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if format == "bin":
+        return Response(content=run_to_bytes(agg), media_type="application/octet-stream", headers={"X-Time-Step": step})
+    if format != "json":
+        raise HTTPException(status_code=400, detail=f"Unknown format '{format}'. Choose 'json' or 'bin'")
+    return JSONResponse({"runs": ids, "time_step": step, **aggregate_to_json(agg)})
+
+# ======================================================================
+## Project Build API ##
+# ======================================================================
+class BuildRequest(BaseModel):
+    record_path: str
+    project_name: str = None
+    options: Dict[str, Any] = {}
+
+def _builds(authorization: Optional[str]) -> BuildQueue:
+    """The build queue, for requests that send the `build_token`"""
+    if builds is None:
+        raise HTTPException(status_code=403, detail="Building projects is disabled. Start the server with --build_jobs")
+    if authorization is None or not secrets.compare_digest(authorization, f"Bearer {build_token}"):
+        raise HTTPException(status_code=401, detail="Send the build token as 'Authorization: Bearer <token>'")
+    return builds
+
+@app.post("/api/builds", status_code=202)
+def post_build(build: BuildRequest, authorization: str = Header(None)):
+    """Queue a job to build a project from the records and parameter grid in `record_path` (relative to the
+    `--build_records` folder), with the `options` of `junevis_create` in `build_queue.BUILD_OPTIONS`. The project is
+    published once complete. Returns the status of the job"""
+    try:
+        return JSONResponse(_builds(authorization).submit(build.record_path, build.project_name, **build.options), status_code=202)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/builds")
+def get_builds(authorization: str = Header(None)):
+    return JSONResponse({"builds": _builds(authorization).list()})
+
+@app.get("/api/builds/{job_id}")
+def get_build(job_id: str, authorization: str = Header(None)):
+    """Status of a build job: the stage it is in, the stages it went through, the records summarized so far and the end
+    of its output (see `junevis.build_queue`)"""
+    try:
+        return JSONResponse(_builds(authorization).status(job_id))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No build job '{job_id}'")
+
+@app.delete("/api/builds/{job_id}")
+def cancel_build(job_id: str, authorization: str = Header(None)):
+    try:
+        return JSONResponse(_builds(authorization).cancel(job_id))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No build job '{job_id}'")
+
 # ======================================================================
 ## Simple Static File Server ##
 # ======================================================================
@@ -34,23 +242,37 @@ async def index():
 
 # the `file_path:path` says to accept any path as a string here. Otherwise, `file_paths` containing `/` will not be served properly
 @app.get("/{file_path:path}")
-async def send_static_client(file_path:str):
-    """ Serves (makes accessible) all files from ./client/ to ``/client/{path}``. Used primarily for development. NGINX handles production.
+def send_static_client(file_path:str, request: Request):
+    """ Serves (makes accessible) all files from ./client/ to ``/client/{path}``. Used for development, or in production
+    without NGINX: files are sent compressed, with `ETag`s to revalidate them, and the most requested are kept in memory.
 
     Args:
         path: Name of file in the client directory
     """
-    f = str(args.dist / file_path)
-    print("Finding file: ", f)
-    return FileResponse(f)
+    try:
+        return static.response(request, file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"File '{file_path}' not found")
 
 @app.exception_handler(HTTPException)
 async def notfound_exception_handler(request, exc):
-    """Catch all response, redirect to index. Necessary when using Vue Router"""
+    """Catch all response, redirect to index. Necessary when using Vue Router. Errors of the API are sent as JSON"""
+    if request.url.path.startswith("/api/"):
+        return JSONResponse({"detail": exc.detail}, status_code=exc.status_code)
     return RedirectResponse(url="/index.html")
 
 def run():
-    uvicorn.run("junevis.server:app", host='127.0.0.1', port=args.port)
+    import uvicorn
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parser.parse_args()
+    try:
+        configure(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.precompress:
+        logger.info(f"Wrote {precompress(args.dist)} compressed files in {args.dist}")
+    uvicorn.run(app, host='127.0.0.1', port=args.port)
 
 if __name__ == "__main__":
     run()
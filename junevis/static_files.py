@@ -0,0 +1,212 @@
+"""Serving the frontend and the project files from `junevis.server` with compression, conditional requests, byte ranges and
+an in-memory cache of the most requested files.
+
+Compressed variants are read from `.br` / `.gz` sidecar files next to the original when they are up to date (see
+`precompress`), and otherwise compressed on the fly with gzip and kept in the cache. Brotli is optional: install it with
+`pip install brotli` to write and serve `.br` files."""
+
+from pathlib import Path
+from typing import *
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import gzip
+import mimetypes
+import os
+import re
+import threading
+
+from starlette.requests import Request
+from starlette.responses import Response, FileResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Worth compressing: text formats, which is everything the frontend loads except images
+COMPRESSIBLE = {".html", ".js", ".css", ".json", ".geojson", ".csv", ".txt", ".svg", ".map", ".bin"}
+MIN_COMPRESS_BYTES = 1024
+
+# Vue CLI adds a content hash to the file names of the built assets, e.g. `js/app.3f2a1b4c.js`. Those never change
+HASHED_ASSET = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+SIDECARS = {"br": ".br", "gzip": ".gz"}
+MEDIA_TYPES = {".geojson": "application/geo+json", ".bin": "application/octet-stream", ".map": "application/json"}
+
+
+def media_type(path: Path) -> str:
+    return MEDIA_TYPES.get(path.suffix) or mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def precompress(root: Union[Path, str], encodings: Sequence[str] = ("gzip", "br"), min_bytes: int = MIN_COMPRESS_BYTES) -> int:
+    """Write up to date `.gz` (and `.br`, if brotli is installed) sidecars for the compressible files under `root`.
+
+    Returns the number of sidecars written"""
+    encodings = [e for e in encodings if e != "br" or brotli is not None]
+    written = 0
+    for path in Path(root).rglob("*"):
+        if not path.is_file() or path.suffix not in COMPRESSIBLE or path.stat().st_size < min_bytes:
+            continue
+        data = None
+        for encoding in encodings:
+            sidecar = path.with_name(path.name + SIDECARS[encoding])
+            if sidecar.exists() and sidecar.stat().st_mtime >= path.stat().st_mtime:
+                continue
+            data = path.read_bytes() if data is None else data
+            tmp = sidecar.with_name(sidecar.name + ".tmp")
+            tmp.write_bytes(_compress(data, encoding))
+            os.replace(tmp, sidecar)
+            written += 1
+    return written
+
+
+def _accepted(request: Request) -> Set[str]:
+    """Encodings of the `Accept-Encoding` header, ignoring those refused with `q=0`"""
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def _byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single `bytes=` range. None for ranges this does not handle (then the whole file is sent),
+    ValueError if the range cannot be satisfied"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), size - 1 if last == "" else min(int(last), size - 1)
+    if first > last or first >= size:
+        raise ValueError(f"Range {header} not satisfiable for {size} bytes")
+    return first, last
+
+
+class StaticFiles:
+    """The files under `root`, with an LRU cache of up to `max_bytes` of file contents (original or compressed).
+
+    Files larger than `max_file_bytes` are never cached and are only compressed if they have a sidecar"""
+
+    def __init__(self, root: Union[Path, str], max_bytes: int = 256 * 1024 ** 2, max_file_bytes: int = 32 * 1024 ** 2):
+        self.root = Path(root).resolve()
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(data) for data in self._cache.values())
+
+    def resolve(self, file_path: str) -> Path:
+        """Path of `file_path` under `root`, FileNotFoundError if it is not a file there"""
+        path = (self.root / file_path).resolve()
+        if self.root not in path.parents or not path.is_file():
+            raise FileNotFoundError(file_path)
+        return path
+
+    def _read(self, path: Path, stat: os.stat_result, encoding: Optional[str]) -> bytes:
+        key = (str(path), stat.st_size, stat.st_mtime_ns, encoding)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        data = path.read_bytes()
+        if encoding is not None:
+            data = _compress(data, encoding)
+        with self._lock:
+            self._cache[key] = data
+            while self.nbytes > self.max_bytes and len(self._cache) > 1:
+                self._cache.popitem(last=False)
+        return data
+
+    def _sidecar(self, path: Path, stat: os.stat_result, encoding: str) -> Optional[Path]:
+        sidecar = path.with_name(path.name + SIDECARS[encoding])
+        try:
+            fresh = sidecar.stat().st_mtime >= stat.st_mtime
+        except FileNotFoundError:
+            return None
+        return sidecar if fresh else None
+
+    def response(self, request: Request, file_path: str) -> Response:
+        path = self.resolve(file_path)
+        stat = path.stat()
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Cache-Control": IMMUTABLE if HASHED_ASSET.search(path.name) else REVALIDATE,
+            "Accept-Ranges": "bytes",
+        }
+        if path.suffix in COMPRESSIBLE:
+            headers["Vary"] = "Accept-Encoding"
+
+        # Ranges are served from the original bytes, so a resumed download does not depend on the encoding
+        range_header = request.headers.get("range")
+        if range_header is not None and request.headers.get("if-range", etag) in (etag, headers["Last-Modified"]):
+            try:
+                byte_range = _byte_range(range_header, stat.st_size)
+            except ValueError:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+            if byte_range is not None:
+                first, last = byte_range
+                with open(path, "rb") as fp:
+                    fp.seek(first)
+                    body = fp.read(last - first + 1)
+                headers["Content-Range"] = f"bytes {first}-{last}/{stat.st_size}"
+                return Response(body, status_code=206, headers=headers, media_type=media_type(path))
+
+        encoding, body_path = self._encoding(request, path, stat)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            headers["ETag"] = f'{etag[:-1]}-{encoding}"'
+        if self._not_modified(request, etag, stat):
+            return Response(status_code=304, headers=headers)
+
+        if body_path is None:  # Compressed on the fly
+            return Response(self._read(path, stat, encoding), headers=headers, media_type=media_type(path))
+        body_stat = body_path.stat()
+        if body_stat.st_size > self.max_file_bytes:
+            return FileResponse(str(body_path), headers=headers, media_type=media_type(path), stat_result=body_stat)
+        return Response(self._read(body_path, body_stat, None), headers=headers, media_type=media_type(path))
+
+    def _encoding(self, request: Request, path: Path, stat: os.stat_result) -> Tuple[Optional[str], Optional[Path]]:
+        """The encoding to send `path` with, and the file to read it from (None if it is compressed on the fly)"""
+        if path.suffix not in COMPRESSIBLE or stat.st_size < MIN_COMPRESS_BYTES:
+            return None, path
+        accepted = _accepted(request)
+        for encoding in SIDECARS:
+            sidecar = self._sidecar(path, stat, encoding) if encoding in accepted else None
+            if sidecar is not None:
+                return encoding, sidecar
+        if "gzip" in accepted and stat.st_size <= self.max_file_bytes:
+            return "gzip", None
+        return None, path
+
+    @staticmethod
+    def _not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            # Any encoding of the same file version matches, as they only differ by the suffix added to its ETag
+            tags = [t.strip().replace("W/", "", 1) for t in if_none_match.split(",")]
+            return any(t == "*" or t == etag or t.startswith(etag[:-1] + "-") for t in tags)
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
@@ -0,0 +1,197 @@
+"""Reading and writing run summaries as CSV or as a compact typed binary file.
+
+The binary layout (`.bin`) stores every field as a dense `region x day` array in the smallest integer type that holds its
+values, which is several times smaller than the CSV and can be read without parsing any text, both here and in the
+browser (see `client/src/logic/summaryFormat.ts`):
+
+    b"JUNESUM1"                     8 byte magic
+    uint32 (little endian)          length of the JSON header in bytes
+    JSON header                     {"regions": [...], "timestamps": [...], "index_names": [...],
+                                     "fields": [{"name", "dtype", "integer", "offset"}, ...], "mask_offset": int or null}
+    field arrays                    for each field, `n_regions * n_days` values of `dtype` in region-major order,
+                                    starting at `offset` bytes from the start of the file (8 byte aligned)
+    row mask (optional)             `n_regions * n_days` uint8 flags marking the (region, day) rows present in the summary,
+                                    only written if some rows are missing
+"""
+
+from pathlib import Path
+from typing import *
+import json
+import struct
+import numpy as np
+
+SUMMARY_FORMATS = ("csv", "bin")
+MAGIC = b"JUNESUM1"
+ALIGN = 8
+
+# Candidate storage types, smallest first. Values beyond int32 are stored as float64, which is exact up to 2**53 and
+# readable by every browser (unlike 64 bit integers)
+_INT_DTYPES = [np.dtype(t) for t in ["<u1", "<i1", "<u2", "<i2", "<u4", "<i4"]]
+
+
+def summary_suffix(fmt: str) -> str:
+    if fmt not in SUMMARY_FORMATS:
+        raise ValueError(f"Unknown summary format '{fmt}'. Choose one of {SUMMARY_FORMATS}")
+    return f".{fmt}"
+
+
+def smallest_dtype(values: np.ndarray) -> np.dtype:
+    """Smallest little endian type that stores `values` exactly"""
+    if values.dtype.kind not in "iub":
+        return np.dtype("<f8")
+    if len(values) == 0:
+        return _INT_DTYPES[0]
+    lo, hi = values.min(), values.max()
+    for dt in _INT_DTYPES:
+        info = np.iinfo(dt)
+        if info.min <= lo and hi <= info.max:
+            return dt
+    return np.dtype("<f8")
+
+
+def _aligned(n: int) -> int:
+    return -(-n // ALIGN) * ALIGN
+
+
+def write_summary(df: "pd.DataFrame", path: Union[Path, str], fmt: str = "csv"):
+    """Write a summary indexed by (region, timestamp) to `path` in format `fmt`"""
+    if fmt == "csv":
+        df.to_csv(str(path))
+    elif fmt == "bin":
+        with open(path, "wb") as fp:
+            fp.write(summary_to_bytes(df))
+    else:
+        summary_suffix(fmt)
+
+
+def summary_arrays(df: "pd.DataFrame") -> Tuple[dict, Dict[str, np.ndarray], Optional[np.ndarray]]:
+    """Dense `(n_regions, n_days)` array of every field of a summary indexed by (region, timestamp).
+
+    Returns the header (`regions`, `timestamps`, `index_names` and `fields`), the arrays and the mask of the rows present
+    in the summary, or None if all of them are"""
+    import pandas as pd
+
+    region_codes, regions = pd.factorize(df.index.get_level_values(0), sort=True)
+    day_codes, days = pd.factorize(df.index.get_level_values(1), sort=True)
+    shape = (len(regions), len(days))
+
+    arrays = {}
+    for name in df.columns:
+        values = df[name].to_numpy()
+        arrays[name] = np.zeros(shape, dtype=values.dtype)
+        arrays[name][region_codes, day_codes] = values
+
+    mask = None
+    if len(df) < shape[0] * shape[1]:
+        mask = np.zeros(shape, dtype=bool)
+        mask[region_codes, day_codes] = True
+
+    header = {
+        "regions": [str(r) for r in regions],
+        "timestamps": list(pd.Index(days).astype(str)),
+        "index_names": list(df.index.names),
+        "fields": [{"name": n, "dtype": a.dtype.str, "integer": a.dtype.kind in "iub"} for n, a in arrays.items()],
+    }
+    return header, arrays, mask
+
+
+def arrays_to_bytes(header: dict, arrays: Dict[str, np.ndarray], mask: Optional[np.ndarray] = None) -> bytes:
+    """Binary summary of the arrays returned by `summary_arrays` or `read_summary_arrays`"""
+    fields, stored = [], []
+    for name, values in arrays.items():
+        dtype = smallest_dtype(values.ravel())
+        fields.append({"name": name, "dtype": dtype.str, "integer": values.dtype.kind in "iub"})
+        stored.append(np.ascontiguousarray(values, dtype=dtype))
+
+    header = {
+        "regions": header["regions"],
+        "timestamps": header["timestamps"],
+        "index_names": header["index_names"],
+        "fields": fields,
+        "mask_offset": None,
+    }
+    # The offsets are stored in the header, so grow the space reserved for it until it fits
+    data_start = 0
+    while True:
+        offset = data_start
+        for field, array in zip(fields, stored):
+            field["offset"] = offset
+            offset = _aligned(offset + array.nbytes)
+        if mask is not None:
+            header["mask_offset"] = offset
+        header_bytes = json.dumps(header).encode("utf-8")
+        needed = _aligned(len(MAGIC) + 4 + len(header_bytes))
+        if needed <= data_start:
+            break
+        data_start = needed
+    header_bytes = header_bytes.ljust(data_start - len(MAGIC) - 4)
+
+    out = bytearray(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+    for field, array in zip(fields, stored):
+        out.extend(b"\0" * (field["offset"] - len(out)))
+        out.extend(array.tobytes())
+    if mask is not None:
+        out.extend(b"\0" * (header["mask_offset"] - len(out)))
+        out.extend(mask.astype(np.uint8).tobytes())
+    return bytes(out)
+
+
+def summary_to_bytes(df: "pd.DataFrame") -> bytes:
+    return arrays_to_bytes(*summary_arrays(df))
+
+
+def read_summary_header(path: Union[Path, str]) -> dict:
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a binary summary")
+        (header_len,) = struct.unpack("<I", fp.read(4))
+        return json.loads(fp.read(header_len).decode("utf-8"))
+
+
+def read_summary_arrays(path: Union[Path, str]) -> Tuple[dict, Dict[str, np.ndarray], Optional[np.ndarray]]:
+    """Read a summary as a `(n_regions, n_days)` array per field, like `summary_arrays`. Returns the header, the arrays
+    and the row mask (or None). The arrays of a binary summary are memory mapped"""
+    if Path(path).suffix == ".csv":
+        import pandas as pd
+
+        return summary_arrays(pd.read_csv(path, index_col=[0, 1]))
+    header = read_summary_header(path)
+    shape = (len(header["regions"]), len(header["timestamps"]))
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {
+        f["name"]: buffer[f["offset"] : f["offset"] + int(np.prod(shape)) * np.dtype(f["dtype"]).itemsize]
+        .view(f["dtype"])
+        .reshape(shape)
+        for f in header["fields"]
+    }
+    mask = None
+    if header["mask_offset"] is not None:
+        mask = buffer[header["mask_offset"] : header["mask_offset"] + int(np.prod(shape))].reshape(shape).astype(bool)
+    return header, arrays, mask
+
+
+def read_summary(path: Union[Path, str]) -> "pd.DataFrame":
+    """Read a summary file written by `write_summary` into the frame `pd.read_csv` returns for the CSV format:
+    a default index, with `region` and `timestamp` (as strings) as the first columns. Binary summaries come back sorted by
+    region and timestamp"""
+    import pandas as pd
+
+    path = Path(path)
+    if path.suffix == ".csv":
+        return pd.read_csv(path)
+
+    header, arrays, mask = read_summary_arrays(path)
+    n_regions, n_days = len(header["regions"]), len(header["timestamps"])
+    region_idx = np.repeat(np.arange(n_regions), n_days)
+    day_idx = np.tile(np.arange(n_days), n_regions)
+    rows = slice(None) if mask is None else mask.ravel()
+
+    region_name, timestamp_name = header["index_names"]
+    data = {
+        region_name: np.asarray(header["regions"], dtype=object)[region_idx[rows]],
+        timestamp_name: np.asarray(header["timestamps"], dtype=object)[day_idx[rows]],
+    }
+    for field in header["fields"]:
+        values = arrays[field["name"]].ravel()[rows]
+        data[field["name"]] = values.astype(np.int64 if field["integer"] else np.float64)
+    return pd.DataFrame(data)
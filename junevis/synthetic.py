@@ -0,0 +1,172 @@
+"""Synthetic JUNE records with the table layout `RecordReader` expects, to develop and benchmark the summarization pipeline
+without real simulation outputs.
+
+    python -m junevis.synthetic /tmp/sweep --n_people 100000 --n_runs 4
+    junevis_create /tmp/sweep
+"""
+
+from pathlib import Path
+from typing import *
+import argparse
+import json
+import numpy as np
+import tables
+
+# Location specs, how many of each there are and where infections happen
+LOCATIONS = {"household": 200, "school": 20, "company": 30, "hospital": 5}
+INFECTION_SPECS = ["household", "school", "company", "leisure"]
+
+TIMESTAMP = "S10"
+SPEC = "S20"
+
+
+def _timestamps(days: np.ndarray, start_date: str) -> np.ndarray:
+    return (np.datetime64(start_date, "D") + days.astype("timedelta64[D]")).astype(str).astype(TIMESTAMP)
+
+
+def _write_table(f: tables.File, table: str, columns: List[Tuple[str, str]], **values):
+    n = len(next(iter(values.values())))
+    rows = np.zeros(n, dtype=columns)
+    for column, value in values.items():
+        rows[column] = value
+    f.create_table("/", table, rows)
+
+
+def _write_events(f: tables.File, table: str, columns: List[Tuple[str, str]], days: np.ndarray, start_date: str, **values):
+    """Write the events of `table` in order of their day, like the simulation logs them"""
+    order = np.argsort(days, kind="stable")
+    sorted_values = {column: np.asarray(value)[order] for column, value in values.items()}
+    _write_table(f, table, columns, timestamp=_timestamps(days[order], start_date), **sorted_values)
+
+
+def write_record(
+    path: Union[Path, str],
+    n_people: int = 20_000,
+    n_regions: int = 4,
+    super_areas_per_region: int = 3,
+    areas_per_super_area: int = 4,
+    n_days: int = 120,
+    attack_rate: float = 0.3,
+    reinfection_rate: float = 0.01,
+    hospital_rate: float = 0.1,
+    icu_rate: float = 0.3,
+    death_rate: float = 0.2,
+    start_date: str = "2020-05-01",
+    seed: int = 0,
+):
+    """Write a record of a simulated epidemic in a population of `n_people` to the HDF5 file `path`.
+
+    A share `attack_rate` of people is infected on a random day (and a share `reinfection_rate` of those infected again),
+    then either recovers or dies after 3 to 25 days, unless that is past the end of the simulation. Of those, a share
+    `hospital_rate` is admitted to hospital (some to a hospital id missing from `locations`, as in real records) and
+    `icu_rate` of them to intensive care. The geography is a tree of regions, super areas and areas"""
+    rng = np.random.default_rng(seed)
+    n_super_areas = n_regions * super_areas_per_region
+    n_areas = n_super_areas * areas_per_super_area
+
+    with tables.open_file(str(path), "w") as f:
+        # Geography and population
+        _write_table(f, "regions", [("id", "i4"), ("name", SPEC)],
+                     id=np.arange(n_regions), name=[f"R-{i:03}".encode() for i in range(n_regions)])
+        _write_table(f, "super_areas", [("id", "i4"), ("region_id", "i4"), ("name", SPEC)],
+                     id=np.arange(n_super_areas), region_id=np.arange(n_super_areas) // super_areas_per_region,
+                     name=[f"SA-{i:04}".encode() for i in range(n_super_areas)])
+        _write_table(f, "areas", [("id", "i4"), ("super_area_id", "i4"), ("name", SPEC)],
+                     id=np.arange(n_areas), super_area_id=np.arange(n_areas) // areas_per_super_area,
+                     name=[f"A-{i:05}".encode() for i in range(n_areas)])
+        _write_table(f, "population", [("id", "i4"), ("age", "i4"), ("sex", "S1"), ("area_id", "i4")],
+                     id=np.arange(n_people), age=rng.integers(0, 100, n_people),
+                     sex=rng.choice(np.array([b"m", b"f"]), n_people), area_id=rng.integers(0, n_areas, n_people))
+        specs = np.repeat(np.array(list(LOCATIONS), dtype=SPEC), list(LOCATIONS.values()))
+        _write_table(f, "locations", [("id", "i4"), ("spec", SPEC), ("group_id", "i4")],
+                     id=np.arange(len(specs)), spec=specs,
+                     group_id=np.concatenate([np.arange(n) for n in LOCATIONS.values()]))
+
+        # Infections, including reinfections of some of the infected
+        infected = np.flatnonzero(rng.random(n_people) < attack_rate)
+        reinfected = rng.choice(infected, int(len(infected) * reinfection_rate), replace=False)
+        infected_ids = np.concatenate([infected, reinfected])
+        infection_days = rng.integers(0, max(1, n_days - 10), len(infected_ids))
+        _write_events(f, "infections",
+                      [("timestamp", TIMESTAMP), ("location_specs", SPEC), ("location_ids", "i4"), ("infector_ids", "i4"),
+                       ("infected_ids", "i4")],
+                      infection_days, start_date,
+                      location_specs=rng.choice(np.array(INFECTION_SPECS, dtype=SPEC), len(infected_ids)),
+                      location_ids=np.zeros(len(infected_ids), dtype=np.int32),
+                      infector_ids=rng.integers(0, n_people, len(infected_ids)),
+                      infected_ids=infected_ids)
+
+        # Outcomes of the first infection of each person
+        order = np.argsort(infection_days, kind="stable")
+        patients, first = np.unique(infected_ids[order], return_index=True)
+        start = infection_days[order][first]
+        end = start + rng.integers(3, 25, len(patients))
+        finished = end < n_days
+        hospitalized = (rng.random(len(patients)) < hospital_rate) & finished
+        icu = hospitalized & (rng.random(len(patients)) < icu_rate)
+        died = (rng.random(len(patients)) < death_rate) & finished
+        recovered = finished & ~died
+        discharged = hospitalized & ~died
+        admission = np.minimum(start + rng.integers(0, 3, len(patients)), end)
+        hospital_ids = rng.integers(0, LOCATIONS["hospital"] + 1, len(patients))
+
+        hospital_columns = [("timestamp", TIMESTAMP), ("hospital_ids", "i4"), ("patient_ids", "i4")]
+        for table, selected, days in [("hospital_admissions", hospitalized, admission), ("icu_admissions", icu, admission + 1),
+                                     ("discharges", discharged, end)]:
+            _write_events(f, table, hospital_columns, days[selected], start_date,
+                          hospital_ids=hospital_ids[selected], patient_ids=patients[selected])
+        _write_events(f, "deaths",
+                      [("timestamp", TIMESTAMP), ("location_specs", SPEC), ("location_ids", "i4"), ("dead_person_ids", "i4")],
+                      end[died], start_date,
+                      location_specs=np.where(hospitalized[died], b"hospital", b"household").astype(SPEC),
+                      location_ids=np.zeros(died.sum(), dtype=np.int32),
+                      dead_person_ids=patients[died])
+        _write_events(f, "recoveries", [("timestamp", TIMESTAMP), ("recovered_person_ids", "i4")],
+                      end[recovered], start_date, recovered_person_ids=patients[recovered])
+
+
+def write_sites(path: Union[Path, str], n_regions: int):
+    """A geojson of a square per region, on a grid near Cox's Bazar"""
+    side = int(np.ceil(np.sqrt(n_regions)))
+    features = []
+    for i in range(n_regions):
+        x, y = 92.1 + 0.01 * (i % side), 21.0 + 0.01 * (i // side)
+        square = [[x, y], [x + 0.01, y], [x + 0.01, y + 0.01], [x, y + 0.01], [x, y]]
+        features.append({
+            "type": "Feature",
+            "properties": {"region": f"R-{i:03}"},
+            "geometry": {"type": "Polygon", "coordinates": [square]},
+        })
+    with open(path, "w") as fp:
+        json.dump({"type": "FeatureCollection", "features": features}, fp)
+
+
+def write_sweep(outdir: Union[Path, str], n_runs: int = 4, seed: int = 0, **record_kwargs) -> Path:
+    """Write the input of `junevis_create` for a sweep of `n_runs` runs to `outdir`: the records, their
+    `parameter_grid.json` (varying the attack rate) and `sites.geojson`"""
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    attack_rates = np.round(np.linspace(0.1, 0.5, n_runs), 3).tolist()
+    for i, attack_rate in enumerate(attack_rates):
+        write_record(outdir / f"record_{i:03}.h5", attack_rate=attack_rate, seed=seed + i, **record_kwargs)
+    with open(outdir / "parameter_grid.json", "w") as fp:
+        json.dump({"attack_rate": attack_rates, "seed": [seed + i for i in range(n_runs)]}, fp)
+    write_sites(outdir / "sites.geojson", record_kwargs.get("n_regions", 4))
+    return outdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=write_sweep.__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("outdir", type=str, help="Folder to write the records to")
+    parser.add_argument("--n_runs", default=4, type=int, help="Number of records")
+    parser.add_argument("--n_people", default=20_000, type=int, help="Size of the population")
+    parser.add_argument("--n_regions", default=4, type=int, help="Number of regions")
+    parser.add_argument("--n_days", default=120, type=int, help="Length of the simulation in days")
+    parser.add_argument("--seed", default=0, type=int, help="Random seed of the first record")
+    args = parser.parse_args()
+    write_sweep(args.outdir, n_runs=args.n_runs, seed=args.seed, n_people=args.n_people, n_regions=args.n_regions,
+                n_days=args.n_days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+from pathlib import Path
+from typing import *
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class TableCache:
+    """Size-bounded LRU cache for the static tables of a JUNE world (population, geography, locations).
+
+    Every run of a parameter sweep shares the same world, so these tables are identical across record files. Entries are
+    keyed by a checksum of the table contents (see `RecordReader.table_checksum`) rather than by file name, which lets
+    records of the same world share a single cached copy.
+
+    Frames are kept in memory up to `max_bytes`. If `cache_dir` is given, they are also persisted as Parquet files so that
+    later runs (or other worker processes) can skip reading them from the record; the directory is trimmed to
+    `max_disk_bytes` by removing the least recently used files.
+
+    The checksums themselves are remembered per file version (see `checksum`), so each table of a record is only
+    hashed once per process.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 4 * 1024 ** 3,
+        cache_dir: Optional[Union[Path, str]] = None,
+        max_disk_bytes: int = 20 * 1024 ** 3,
+    ):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self._frames = OrderedDict()
+        self._nbytes = {}
+        self._checksums = {}
+
+        if self.cache_dir is not None:
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("Persisting the table cache to disk requires `pyarrow`. Install it with `pip install pyarrow`")
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def checksum(self, path: Union[Path, str], table_name: str, compute: Callable[[], str]) -> str:
+        """Checksum of `table_name` in the file `path`, from `compute` the first time it is asked for that version of
+        the file (its size and modification time)"""
+        stat = os.stat(path)
+        key = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns, table_name)
+        if key not in self._checksums:
+            self._checksums[key] = compute()
+        return self._checksums[key]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._nbytes.values())
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key: str):
+        path = self._disk_path(key)
+        return key in self._frames or (path is not None and path.exists())
+
+    def _disk_path(self, key: str) -> Optional[Path]:
+        return None if self.cache_dir is None else self.cache_dir / f"{key}.parquet"
+
+    def get(self, key: str) -> Optional["pd.DataFrame"]:
+        """Return a shallow copy of the cached frame for `key`, or None. Treat the returned frame as read-only"""
+        if key in self._frames:
+            self._frames.move_to_end(key)
+            return self._frames[key].copy(deep=False)
+
+        path = self._disk_path(key)
+        if path is not None and path.exists():
+            logger.info(f"Loading cached table from {path}")
+            import pandas as pd
+
+            try:
+                df = pd.read_parquet(path)
+                os.utime(path)  # Mark as recently used for disk eviction
+            except FileNotFoundError:  # Evicted by another process in the meantime
+                return None
+            self._remember(key, df)
+            return df.copy(deep=False)
+        return None
+
+    def put(self, key: str, df: "pd.DataFrame"):
+        self._remember(key, df)
+        path = self._disk_path(key)
+        if path is not None and not path.exists():
+            # Write to a temporary name first so concurrent workers never read a partial file
+            tmp_path = path.with_name(f".{path.stem}.{uuid.uuid4().hex}.tmp")
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+
+    def get_or_load(self, key: str, load: Callable[[], "pd.DataFrame"]) -> "pd.DataFrame":
+        df = self.get(key)
+        if df is None:
+            df = load()
+            self.put(key, df)
+            df = df.copy(deep=False)
+        return df
+
+    def clear(self):
+        self._frames.clear()
+        self._nbytes.clear()
+        self._checksums.clear()
+
+    def _remember(self, key: str, df: "pd.DataFrame"):
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        self._frames[key] = df
+        self._nbytes[key] = nbytes
+        self._frames.move_to_end(key)
+        while self.nbytes > self.max_bytes:
+            old_key, _ = self._frames.popitem(last=False)
+            del self._nbytes[old_key]
+
+    def _evict_disk(self):
+        files = []
+        for p in self.cache_dir.glob("*.parquet"):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, p))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            total -= size
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass